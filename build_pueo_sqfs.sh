@@ -22,7 +22,8 @@ PYTHON_DIRS="pyrfdc/pyrfdc/ \
 # scripts
 SCRIPTS="pueo-utils/scripts/build_squashfs \
          pueo-utils/scripts/autoprog.py \
-	 pyfwupd/pyfwupd.py"
+	 pyfwupd/pyfwupd.py \
+	 pyfwupd/fwharness.py"
 
 # binaries
 BINARIES="binaries/xilframe"
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+# Runs pyfwupd's receiving side with all of the hardware faked out,
+# so it can be checked and timed anywhere.
+#
+# - the readback image is a symlink to one of two bank files, and
+#   the readback type path just repoints it
+# - the bank GPIOs tell our fake sender the bank is free again
+# - the event device is a pipe the fake sender writes key events into
+#
+# The sender builds its frames with PyConverter.unconvert, so whatever
+# converter pyfwupd uses has to get the original data back out.
+#
+# --check compares PyConverter against libxilframe on random frames
+# (only useful where libxilframe actually loads, i.e. on the SURF).
+
+import os
+import sys
+import time
+import struct
+import hashlib
+import logging
+import argparse
+import selectors
+import tempfile
+import threading
+import zlib
+from pathlib import Path
+
+from pyfwupd import (LOG_NAME, PYFW, PYFZ, DIGEST_FLAG, Converter, PyConverter,
+                     Event, FrameReceiver, addLoggingLevel)
+
+class FakeBank:
+    def __init__(self, code, path):
+        self.code = code
+        self.path = Path(path)
+        # set when pyfwupd's done with it
+        self.free = threading.Event()
+
+    # pyfwupd sees us as its GPIO
+    def write(self, v):
+        if v:
+            self.free.set()
+
+class FakeReadbackType:
+    """ the readback type path: picks which bank the image shows """
+    def __init__(self, image, banks):
+        self.image = Path(image)
+        self.banks = banks
+
+    def write_text(self, t):
+        tmp = self.image.with_suffix('.new')
+        if os.path.lexists(tmp):
+            tmp.unlink()
+        tmp.symlink_to(self.banks[t].path)
+        os.replace(tmp, self.image)
+
+class FakeHandler:
+    def __init__(self):
+        self.terminate = False
+
+    def set_terminate(self):
+        self.terminate = True
+
+class FakeSender(threading.Thread):
+    def __init__(self, frames, banks, evfd):
+        super().__init__(name='fake-sender', daemon=True)
+        self.frames = frames
+        self.banks = banks
+        self.evfd = evfd
+
+    def run(self):
+        for i, fr in enumerate(self.frames):
+            bank = self.banks[i % 2]
+            bank.free.wait()
+            bank.free.clear()
+            bank.path.write_bytes(fr)
+            os.write(self.evfd, struct.pack(Event.FORMAT, 0, 0, 1, bank.code, 1))
+
+def header(fn, data, compress):
+    """ a PYFW (or PYFZ, zlib) header with an md5 """
+    if compress:
+        h = PYFZ + struct.pack(">I", len(data) | DIGEST_FLAG) + b'\x01'
+    else:
+        h = PYFW + struct.pack(">I", len(data) | DIGEST_FLAG)
+    return h + fn.encode() + b'\x00' + b'\x01'
+
+def makeFrames(fn, payload, compress):
+    data = zlib.compress(payload) if compress else payload
+    h = header(fn, data, compress) + hashlib.md5(payload).digest()
+    stream = h + bytes([(256 - sum(h)) & 0xFF]) + data
+    frames = []
+    for i in range(0, len(stream), Converter.DATA_SIZE):
+        chunk = stream[i:i+Converter.DATA_SIZE]
+        # the last one needs to be longer than what's left, so pad it
+        chunk += b'\x00'*(Converter.DATA_SIZE - len(chunk))
+        frames.append(PyConverter.unconvert(chunk))
+    # exactly full? then the end's in the next frame
+    if len(stream) % Converter.DATA_SIZE == 0:
+        frames.append(PyConverter.unconvert(bytes(Converter.DATA_SIZE)))
+    return frames
+
+def check(n):
+    try:
+        c = Converter()
+    except Exception as e:
+        print("libxilframe not available (%s), nothing to check against" % repr(e))
+        return True
+    p = PyConverter()
+    bad = 0
+    for i in range(n):
+        fr = os.urandom(Converter.FRAME_SIZE)
+        if bytes(c.convert(fr)) != bytes(p.convert(fr)):
+            bad += 1
+    print("%d/%d random frames differ between libxilframe and PyConverter" % (bad, n))
+    return bad == 0
+
+def timeConverter(conv, n):
+    buf = conv.frameBuffer()
+    buf[:] = os.urandom(Converter.FRAME_SIZE)
+    start = time.perf_counter()
+    for i in range(n):
+        conv.convert(buf)
+    return (time.perf_counter() - start)/n
+
+def run(args, conv, logger):
+    work = Path(tempfile.mkdtemp(prefix='fwharness'))
+    banks = { 'A' : FakeBank(30, work / 'bankA'),
+              'B' : FakeBank(31, work / 'bankB') }
+    image = work / 'image'
+    rbType = FakeReadbackType(image, banks)
+    dest = work / 'out.bin'
+    payload = os.urandom(args.size)
+    if args.compress:
+        # half of it compresses away, more or less like a bitstream
+        payload = payload[:args.size//2] + bytes(args.size - args.size//2)
+    frames = makeFrames(str(dest), payload, args.compress)
+
+    sel = selectors.DefaultSelector()
+    handler = FakeHandler()
+    stateA = [30, banks['A'], 'A']
+    stateB = [31, banks['B'], 'B']
+    stateA.append(stateB)
+    stateB.append(stateA)
+    rbType.write_text('A')
+    receiver = FrameReceiver(sel, handler, logger, [stateA, stateB], rbType,
+                             str(image), conv, pipeline=args.pipeline,
+                             journal=work / 'journal', status=work / 'status')
+    evr, evw = os.pipe()
+    evf = open(evr, 'rb', buffering=0)
+    sel.register(evf, selectors.EVENT_READ, receiver.handleEvent)
+    sender = FakeSender(frames, [banks['A'], banks['B']], evw)
+    start = time.perf_counter()
+    # same as pyfwupd: both banks start out free
+    for b in banks.values():
+        b.write(1)
+        b.write(0)
+    sender.start()
+    last = time.monotonic()
+    # the worker doesn't wake us up when it's done, so keep looking
+    while not handler.terminate and not receiver.status.fields['files']:
+        events = sel.select(timeout=0.01)
+        if events:
+            last = time.monotonic()
+        elif time.monotonic() - last > args.timeout:
+            logger.error("stalled, nothing for %d seconds", args.timeout)
+            break
+        for key, mask in events:
+            key.data(key.fileobj, mask)
+    elapsed = time.perf_counter() - start
+    st = dict(receiver.status.fields)
+    receiver.close()
+    ok = dest.exists() and dest.read_bytes() == payload
+    print("%s: %d frames, %d bytes in %.3f s" % ("ok" if ok else "FAILED",
+                                                 len(frames), len(payload), elapsed))
+    print("  %.1f frames/s, %.2f MB/s of file" % (len(frames)/elapsed,
+                                                 len(payload)/elapsed/1e6))
+    print("  convert %.2f ms/frame, write %.2f ms/frame (smoothed)" % (st['convert'],
+                                                                     st['write']))
+    evf.close()
+    os.close(evw)
+    for p in work.iterdir():
+        p.unlink()
+    work.rmdir()
+    return ok and not receiver.horribleProblem
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run pyfwupd's receiver with fake hardware")
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('--size', type=int, default=4*1024*1024,
+                        help='bytes to send')
+    parser.add_argument('-p', '--pipeline', type=int, default=0, metavar='N')
+    parser.add_argument('--compress', action='store_true',
+                        help='send it as PYFZ (zlib)')
+    parser.add_argument('--converter', choices=('c', 'numpy'),
+                        help='default is libxilframe if it loads, otherwise numpy')
+    parser.add_argument('--check', type=int, default=0, metavar='N',
+                        help='compare the converters on N random frames first')
+    parser.add_argument('--timeout', type=int, default=10,
+                        help='give up after this many seconds without a frame')
+    args = parser.parse_args()
+
+    addLoggingLevel('TRACE', logging.DEBUG - 5)
+    addLoggingLevel('DETAIL', logging.INFO - 5)
+    addLoggingLevel('FILE', 100)
+    logging.basicConfig(level=logging.WARNING - 5*args.verbose)
+    logger = logging.getLogger(LOG_NAME)
+
+    if args.check and not check(args.check):
+        sys.exit(1)
+    if args.converter == 'c':
+        conv = Converter()
+    elif args.converter == 'numpy':
+        conv = PyConverter()
+    else:
+        try:
+            conv = Converter()
+        except Exception:
+            conv = PyConverter()
+    print("%s: %.2f ms/frame by itself" % (type(conv).__name__, timeConverter(conv, 20)*1000))
+    sys.exit(0 if run(args, conv, logger) else 1)
@@ -10,6 +10,39 @@
 # The first 32-bit word in the first frame needs to be b'PYFW'
 # followed by a 32-bit length, then followed by a null-terminated
 # string indicating the filename, then lots o data.
+# If the top bit of the length is set, there's an expected digest
+# after the filename: a type byte (1 = md5, 2 = sha256) and then
+# the digest itself. The file's rejected if it doesn't match.
+#
+# b'PYFZ' is the same thing compressed: the length is the compressed
+# length, and there's a method byte (1 = zlib/gzip, 2 = xz/lzma,
+# 3 = zstd, if this Python has it) before the filename. The digest
+# is of the decompressed file.
+#
+# b'PYDL' is a delta against a file that's already here. Same as
+# PYFZ (method 0 = not compressed), but after the filename comes the
+# base filename (null terminated) and its digest (type byte + digest),
+# and the target digest is required. The payload is a stream of ops
+# (see Patcher) which build the new file out of pieces of the base
+# and literal data.
+#
+# b'PYAR' is a tar (plain, gz, bz2 or xz) of lots of files, so small
+# files don't each cost a frame. Header's the same as PYFW, where the
+# filename's just a label, and the digest (of the archive as sent) is
+# required. Entry names are relative to / and have to land under one
+# of the allowed directories (--allow). Nothing gets committed until
+# the whole archive's checked out.
+#
+# Plain PYFW transfers with a digest are resumable. How far they got
+# is kept in a journal (JOURNALPATH), and if we're stopped partway the
+# temp file is kept. pysurfHskd will tell the sender what the journal
+# says. To pick up where it left off, the sender sets bit 30 of the
+# length as well and puts a 4-byte offset (where its data starts) after
+# the digest. Anything we already have gets skipped.
+
+# PYEX scripts don't hold anything up: they run alongside (see
+# ScriptRunner) with their output going into the journal as it comes.
+# pysurfHskd can get the exit status and the end of the output after.
 
 # If you screw up, just restart this guy (eDownloadMode=0
 # then eDownloadMode=1). It completes whatever it's doing when
@@ -18,20 +51,35 @@
 # THIS IS VERSION 2, WHICH USES LIBXILFRAME.SO
 # INSTEADY OF GODAWFUL HACKY CRAP
 
-from pyzynqmp import Bitstream, PyZynqMP
-from signalhandler import SignalHandler
-from gpio import GPIO 
 import os
-import shutil
 import logging
 import argparse
 import selectors
+import select
+import threading
+import queue
+import mmap
+import time
+from collections import deque
 
 import struct
 import signal
 from pathlib import Path
-from hashlib import md5
-from subprocess import Popen, PIPE, TimeoutExpired
+import hashlib
+import json
+import tarfile
+import zlib
+import lzma
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+import re
+from subprocess import Popen, DEVNULL, PIPE, STDOUT
 
 LOG_NAME = 'pyfwupd'
 LOG_LEVEL_OVERRIDE = "/tmp/pyfwupd.loglevel"
@@ -42,13 +90,30 @@ else:
 
 PYFW=b'PYFW'
 PYEX=b'PYEX'
-CURRENT=PyZynqMP.CURRENT
-READBACK_TYPE_PATH=PyZynqMP.READBACK_TYPE_PATH
-READBACK_LEN_PATH=PyZynqMP.READBACK_LEN_PATH
-IMAGE_PATH=PyZynqMP.IMAGE_PATH
+PYFZ=b'PYFZ'
+PYDL=b'PYDL'
+PYAR=b'PYAR'
 EVENTPATH="/dev/input/event0"
 
-TMPPATH="/tmp/pyfwupd.tmp"
+# PYEX scripts go here (by md5) to be run
+SCRIPTPATH="/tmp/pyfwupd.%s.ex"
+# and how the last few went
+RESULTSPATH="/tmp/pyfwupd.results"
+
+# digest type byte in the PYFW/PYFZ/PYDL/PYAR header : (hashlib name, length)
+DIGESTS = { 1 : ('md5', 16),
+            2 : ('sha256', 32) }
+DIGEST_TYPES = { v[0] : k for k, v in DIGESTS.items() }
+DIGEST_FLAG = 0x80000000
+RESUME_FLAG = 0x40000000
+
+JOURNALPATH="/tmp/pyfwupd.journal"
+
+# live status for housekeeping (see Status)
+STATUSPATH="/tmp/pyfwupd.status"
+
+# where PYAR entries are allowed to go
+ARCHIVE_ALLOW=("/home/root", "/tmp")
 
 BANKOFFSET=0x40000
 
@@ -85,33 +150,240 @@ def addLoggingLevel(levelName, levelNum, methodName=None):
     setattr(logging.getLoggerClass(), methodName, logForLevel)
     setattr(logging, methodName, logToRoot)
 
-# utility functions, from a stackexchange
-# post computing the MD5 iteratively. Originally
-# I had planned on NOT doing this on the file
-# because we can just do it iteratively as
-# the data comes in, but this is smarter since
-# we move the latency to the end. You might
-# need to time.sleep(0.5) at the end if you're
-# checking the MD5.
-def hash_bytestr_iter(bytesiter, hasher, ashexstr=False):
-    for block in bytesiter:
-        hasher.update(block)
-    return hasher.hexdigest() if ashexstr else hasher.digest()
-
-def file_as_blockiter(afile, blocksize=65536):
-    with afile:
-        block = afile.read(blocksize)
-        while len(block) > 0:
-            yield block
-            block = afile.read(blocksize)
-
-def filemd5(fn):
-    return hash_bytestr_iter(file_as_blockiter(open(fn, 'rb')),
-                             md5(),
-                             ashexstr=True)
+# Where a file being received goes. It's written into a temp file
+# in the same directory as the destination (so the commit is a rename,
+# not a copy across filesystems) and hashed as it's written, so nobody
+# has to read it back to check it. commit() fsyncs and renames.
+class FileSink:
+    def __init__(self, dest, hashes=('md5',), resume=0, tmp=None):
+        """ resume : pick up a temp file we already have this much of
+            tmp : somewhere else for the temp file (same filesystem!) """
+        self.dest = Path(dest)
+        self.tmp = self.tempPath(dest) if tmp is None else Path(tmp)
+        self.hashers = { h : hashlib.new(h) for h in hashes }
+        self.length = 0
+        if resume:
+            self.f = open(self.tmp, 'r+b')
+            # the hashes have to see what's already there
+            while self.length < resume:
+                b = self.f.read(min(resume - self.length, 1024*1024))
+                if not b:
+                    self.f.close()
+                    raise IOError(f'{self.tmp} is only {self.length} bytes, not {resume}')
+                for h in self.hashers.values():
+                    h.update(b)
+                self.length += len(b)
+            self.f.truncate()
+        else:
+            self.f = open(self.tmp, 'wb')
+
+    @staticmethod
+    def tempPath(dest):
+        dest = Path(dest)
+        return dest.parent / ('.' + dest.name + '.pyfwupd')
+
+    def write(self, data):
+        self.f.write(data)
+        for h in self.hashers.values():
+            h.update(data)
+        self.length += len(data)
+
+    def digest(self, name):
+        return self.hashers[name].digest()
+
+    def hexdigest(self, name):
+        return self.hashers[name].hexdigest()
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self, sync=False):
+        """ leave the temp file where it is """
+        if self.f.closed:
+            return
+        if sync:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        self.f.close()
+
+    def commit(self):
+        self.close(sync=True)
+        os.replace(self.tmp, self.dest)
+        # and make the rename stick
+        dfd = os.open(self.dest.parent, os.O_RDONLY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
+
+    def abort(self):
+        self.f.close()
+        if self.tmp.exists():
+            self.tmp.unlink()
     
+# How far the current resumable transfer has got. It's only good for
+# a restart of pyfwupd, not a reboot, which is fine because the temp
+# file doesn't get fsync'd until it's done either.
+class Journal:
+    def __init__(self, path=JOURNALPATH):
+        self.path = Path(path)
+
+    def load(self):
+        try:
+            return json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # junk, forget it
+            self.clear()
+            return None
+
+    def matches(self, xfer):
+        """ what the journal has for this transfer, or None """
+        j = self.load()
+        if j is None:
+            return None
+        name, digest = xfer.digest
+        if (j['fn'] != xfer.fn or j['hash'] != name or
+            j['digest'] != digest.hex() or j['length'] != xfer.length):
+            return None
+        return j
+
+    def save(self, xfer):
+        name, digest = xfer.digest
+        tmp = self.path.with_suffix('.new')
+        tmp.write_text(json.dumps({ 'fn' : xfer.fn,
+                                    'hash' : name,
+                                    'type' : DIGEST_TYPES[name],
+                                    'digest' : digest.hex(),
+                                    'length' : xfer.length,
+                                    'received' : xfer.sink.length,
+                                    'tmp' : str(xfer.sink.tmp) }))
+        os.replace(tmp, self.path)
+
+    def discard(self):
+        """ throw away an old transfer, temp file and all """
+        j = self.load()
+        if j is not None:
+            try:
+                os.unlink(j['tmp'])
+            except OSError:
+                pass
+        self.clear()
+
+    def clear(self):
+        if self.path.exists():
+            self.path.unlink()
+
+# Live state for housekeeping (eDownloadStatus to pysurfHskd), in a
+# little shared file in tmpfs. Everything's big-endian so it can go
+# out as-is. It's a seqlock: seq is odd while it's being written, so a
+# reader that sees it odd, or sees it change under it, reads again.
+#
+# After seq: state, bank (0 = A, 1 = B), last error, transfer type,
+# frames, bytes remaining, files completed, frames/s, convert and
+# write ms per frame, time of the last frame, our pid, filename.
+class Status:
+    FORMAT = ">IBBBBIIIfffII64s"
+    SIZE = struct.calcsize(FORMAT)
+    STOPPED = 0
+    IDLE = 1
+    RECEIVING = 2
+    MODES = { None : 0, PYFW : 1, PYEX : 2, PYFZ : 3, PYDL : 4, PYAR : 5 }
+    # frames/s is over this many frames
+    RATE_FRAMES = 16
+    # how fast the per-frame times follow along
+    ALPHA = 0.2
+
+    def __init__(self, path=STATUSPATH):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            os.ftruncate(fd, self.SIZE)
+            self.mm = mmap.mmap(fd, self.SIZE)
+        finally:
+            os.close(fd)
+        # the worker thread updates us too
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.fields = { 'state' : self.IDLE,
+                        'bank' : 0,
+                        'error' : 0,
+                        'mode' : 0,
+                        'frames' : 0,
+                        'remaining' : 0,
+                        'files' : 0,
+                        'fps' : 0.0,
+                        'convert' : 0.0,
+                        'write' : 0.0,
+                        'lastFrame' : 0,
+                        'fn' : b'' }
+        self.times = deque(maxlen=self.RATE_FRAMES)
+        with self.lock:
+            self._publish()
+
+    def _publish(self):
+        f = self.fields
+        self.seq += 1
+        self.mm[0:4] = struct.pack(">I", self.seq & 0xFFFFFFFF)
+        self.mm[4:] = struct.pack(self.FORMAT, 0,
+                                  f['state'], f['bank'], f['error'], f['mode'],
+                                  f['frames'] & 0xFFFFFFFF, f['remaining'], f['files'],
+                                  f['fps'], f['convert'], f['write'],
+                                  f['lastFrame'], os.getpid(), f['fn'][:64])[4:]
+        self.seq += 1
+        self.mm[0:4] = struct.pack(">I", self.seq & 0xFFFFFFFF)
+
+    def update(self, **kw):
+        with self.lock:
+            self.fields.update(kw)
+            self._publish()
+
+    def transfer(self, xfer):
+        """ started receiving xfer """
+        self.update(state=self.RECEIVING,
+                    mode=self.MODES.get(xfer.mode, 0),
+                    remaining=xfer.remaining,
+                    fn=xfer.fn.encode())
+
+    def finished(self):
+        """ the current transfer's done """
+        with self.lock:
+            self.fields['files'] += 1
+            self.fields['state'] = self.IDLE
+            self.fields['remaining'] = 0
+            self._publish()
+
+    def frame(self, bank):
+        """ a frame came in on bank """
+        now = time.monotonic()
+        self.times.append(now)
+        with self.lock:
+            f = self.fields
+            f['frames'] += 1
+            f['bank'] = bank
+            f['lastFrame'] = int(time.time())
+            if len(self.times) > 1 and now > self.times[0]:
+                f['fps'] = (len(self.times)-1)/(now - self.times[0])
+            self._publish()
+
+    def frameTimes(self, convert, write):
+        """ how long (seconds) the last frame took to convert and write """
+        with self.lock:
+            f = self.fields
+            f['convert'] += self.ALPHA*(convert*1000 - f['convert'])
+            f['write'] += self.ALPHA*(write*1000 - f['write'])
+            self._publish()
+
+    def close(self):
+        self.update(state=self.STOPPED)
+        self.mm.close()
+
 # Use the xilframe library.
-from ctypes import CDLL, POINTER, c_ubyte, cast
+#
+# Nothing here copies a frame: readFrame reads the readback straight
+# into a ctypes buffer, xilframe reads that directly and writes into
+# outbuf, and everyone looks at outbuf through a memoryview.
+from ctypes import CDLL, POINTER, c_ubyte, Array
 class Converter:
     XILFRAME = "/usr/local/lib/libxilframe.so"
     FRAME_SIZE = 95704
@@ -124,15 +396,104 @@ class Converter:
         self.xf = self.libxf.xilframe
         self.xf.restype = None
         self.xf.argtypes = [ POINTER(c_ubyte), POINTER(c_ubyte) ]
-        self.inbuf = (c_ubyte*self.FRAME_SIZE)()
-        self.inbufp = cast(self.inbuf, POINTER(c_ubyte))
+        self.inbuf = self.frameBuffer()
+        self.outbuf = (c_ubyte*self.DATA_SIZE)()
+        self.data = memoryview(self.outbuf).cast('B')
+
+    @classmethod
+    def frameBuffer(cls):
+        """ a buffer readFrame/convert can use directly """
+        return (c_ubyte*cls.FRAME_SIZE)()
+
+    @classmethod
+    def readFrame(cls, path, buf):
+        """ read a frame from the readback image into buf (a frameBuffer) """
+        mv = memoryview(buf).cast('B')
+        n = 0
+        with open(path, 'rb', buffering=0) as f:
+            while n < cls.FRAME_SIZE:
+                r = f.readinto(mv[n:])
+                if not r:
+                    break
+                n += r
+        if n != cls.FRAME_SIZE:
+            raise IOError(f'short readback: {n} bytes')
+        return n
+
+    def convert(self, fr=None):
+        """ convert a frame (default inbuf) and return a memoryview of
+            the data. It's only good until the next convert! fr can
+            also be a bytes-like, but then it has to be copied in. """
+        if fr is None:
+            fr = self.inbuf
+        elif not isinstance(fr, Array):
+            self.inbuf[0:self.FRAME_SIZE] = fr
+            fr = self.inbuf
+        self.xf(fr, self.outbuf)
+        return self.data
+
+# libxilframe, in NumPy, for when the library isn't around (off-target,
+# see fwharness.py) and to check it against. xilframe() walks 12 columns
+# x 256 rows of 30-byte words in the frame, and for each one
+# xilprocess() picks out 128 of its 240 bits into 16 bytes of data.
+# Both are fixed, so the whole thing is one gather of bits.
+class PyConverter(Converter):
+    # where the words are
+    FRAME_START = 472
+    ROW_STRIDE = 372
+    COLUMNS = ( 0, 30, 60, 90, 120, 150, 192, 222, 252, 282, 312, 342 )
+    ROWS = 256
+    # for each data bit (LSB first), which bit of the word it comes from
+    WORD_BITS = (   0, 132,  12, 144,  24, 156,  36, 168,
+                   60, 192,  72, 204,  84, 216,  96, 228,
+                    6, 138,  18, 150,  30, 162,  42, 174,
+                   66, 198,  78, 210,  90, 222, 102, 234,
+                    3, 135,  15, 147,  27, 159,  39, 171,
+                   63, 195,  75, 207,  87, 219,  99, 231,
+                    9, 141,  21, 153,  33, 165,  45, 177,
+                   69, 201,  81, 213,  93, 225, 105, 237,
+                    2, 134,  14, 146,  26, 158,  38, 170,
+                   62, 194,  74, 206,  86, 218,  98, 230,
+                    8, 140,  20, 152,  32, 164,  44, 176,
+                   68, 200,  80, 212,  92, 224, 104, 236,
+                    5, 137,  17, 149,  29, 161,  41, 173,
+                   65, 197,  77, 209,  89, 221, 101, 233,
+                   11, 143,  23, 155,  35, 167,  47, 179,
+                   71, 203,  83, 215,  95, 227, 107, 239 )
+    _index = None
+
+    def __init__(self):
+        if np is None:
+            raise ImportError("PyConverter needs numpy")
+        self.inbuf = self.frameBuffer()
         self.outbuf = (c_ubyte*self.DATA_SIZE)()
-        self.outbufp = cast(self.outbuf, POINTER(c_ubyte))
+        self.data = memoryview(self.outbuf).cast('B')
+        self.index = self.bitIndex()
+        self.out = np.frombuffer(self.outbuf, dtype=np.uint8)
+        self.xf = self._xilframe
+
+    @classmethod
+    def bitIndex(cls):
+        """ for each bit of the data, which bit of the frame it is """
+        if cls._index is None:
+            words = (cls.FRAME_START +
+                     np.array(cls.COLUMNS)[:,None] +
+                     np.arange(cls.ROWS)[None,:]*cls.ROW_STRIDE).reshape(-1)
+            cls._index = (words[:,None]*8 + np.array(cls.WORD_BITS)[None,:]).reshape(-1)
+        return cls._index
+
+    def _xilframe(self, fr, out):
+        bits = np.unpackbits(np.frombuffer(fr, dtype=np.uint8), bitorder='little')
+        self.out[:] = np.packbits(bits[self.index], bitorder='little')
 
-    def convert(self, fr):
-        self.inbuf[0:self.FRAME_SIZE] = fr
-        self.xf(self.inbufp, self.outbufp)
-        return bytes(self.outbuf)    
+    @classmethod
+    def unconvert(cls, data):
+        """ the other way around: a frame that converts to data, with
+            all the bits nobody looks at zero. For faking readback. """
+        bits = np.zeros(cls.FRAME_SIZE*8, dtype=np.uint8)
+        bits[cls.bitIndex()] = np.unpackbits(np.frombuffer(data, dtype=np.uint8),
+                                             bitorder='little')
+        return np.packbits(bits, bitorder='little').tobytes()
 
 # this is supertrimmed for PUEO
 class Event:
@@ -147,10 +508,949 @@ class Event:
         else:
             self.code = None
 
+# Decompresses a PYFZ file on its way into a FileSink. Output comes
+# out CHUNK at a time, so a frame that decompresses to something
+# enormous never has to be in memory all at once.
+class Inflater:
+    ZLIB = 1
+    LZMA = 2
+    ZSTD = 3
+    CHUNK = 256*1024
+
+    def __init__(self, method, sink):
+        if method == self.ZLIB:
+            # zlib or gzip, whichever it is
+            self.d = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        elif method == self.LZMA:
+            self.d = lzma.LZMADecompressor()
+        elif method == self.ZSTD and zstd is not None:
+            self.d = zstd.ZstdDecompressor()
+        else:
+            raise ValueError("unsupported compression method %d" % method)
+        self.method = method
+        self.sink = sink
+        self.compressed = 0
+
+    def write(self, data):
+        if self.d.eof:
+            raise ValueError("data past the end of the compressed stream")
+        self.compressed += len(data)
+        if self.method == self.ZLIB:
+            while len(data):
+                self.sink.write(self.d.decompress(data, self.CHUNK))
+                data = self.d.unconsumed_tail
+        else:
+            self.sink.write(self.d.decompress(data, self.CHUNK))
+            while not self.d.eof and not self.d.needs_input:
+                self.sink.write(self.d.decompress(b'', self.CHUNK))
+
+    def finish(self):
+        if not self.d.eof:
+            raise ValueError("compressed stream is truncated")
+
+# Builds a file out of a base file that's already here and a stream
+# of ops (big-endian):
+#   0x00                         end
+#   0x01 offset(8) length(4)     copy length bytes from offset in the base
+#   0x02 length(4) data          literal data
+# Ops can be split across frames any which way. Copies come out CHUNK
+# at a time, literals go straight through.
+class Patcher:
+    END = 0
+    COPY = 1
+    LITERAL = 2
+    ARGLEN = { COPY : 12, LITERAL : 4 }
+    CHUNK = 256*1024
+
+    def __init__(self, base, digest, sink):
+        """
+        base : path of the base file
+        digest : (hashlib name, expected digest) of the base
+        sink : where the new file goes
+        """
+        self.fd = os.open(base, os.O_RDONLY | os.O_CLOEXEC)
+        self.sink = sink
+        try:
+            self.baseLength = os.fstat(self.fd).st_size
+            self.checkBase(*digest)
+        except Exception:
+            self.close()
+            raise
+        # op whose arguments we're collecting
+        self.op = None
+        self.args = bytearray()
+        # literal bytes still to come
+        self.literal = 0
+        self.done = False
+        self.copied = 0
+        self.literals = 0
+
+    def checkBase(self, name, expected):
+        h = hashlib.new(name)
+        offset = 0
+        while True:
+            b = os.pread(self.fd, self.CHUNK, offset)
+            if not b:
+                break
+            h.update(b)
+            offset += len(b)
+        if h.digest() != expected:
+            raise ValueError(f'base {name} mismatch: {h.hexdigest()} != {expected.hex()}')
+
+    def copy(self, offset, length):
+        if offset + length > self.baseLength:
+            raise ValueError("copy of %d at %d is past the end of the base" % (length, offset))
+        while length:
+            b = os.pread(self.fd, min(length, self.CHUNK), offset)
+            if not b:
+                raise IOError("short read from base")
+            self.sink.write(b)
+            offset += len(b)
+            length -= len(b)
+            self.copied += len(b)
+
+    def write(self, data):
+        data = memoryview(data)
+        while len(data):
+            if self.literal:
+                n = min(self.literal, len(data))
+                self.sink.write(data[:n])
+                self.literal -= n
+                self.literals += n
+                data = data[n:]
+                continue
+            if self.done:
+                raise ValueError("data after the end of the delta")
+            if self.op is None:
+                self.op = data[0]
+                data = data[1:]
+                if self.op == self.END:
+                    self.done = True
+                    self.op = None
+                elif self.op not in self.ARGLEN:
+                    raise ValueError("bad delta op %d" % self.op)
+                continue
+            need = self.ARGLEN[self.op] - len(self.args)
+            self.args += data[:need]
+            data = data[need:]
+            if len(self.args) < self.ARGLEN[self.op]:
+                continue
+            if self.op == self.COPY:
+                self.copy(*struct.unpack(">QI", self.args))
+            else:
+                self.literal = struct.unpack(">I", self.args)[0]
+            self.op = None
+            self.args.clear()
+
+    def finish(self):
+        self.close()
+        if not self.done:
+            raise ValueError("delta is truncated")
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+# A PYAR archive on its way in. tarfile wants to read() from
+# something, so it runs on its own thread and we feed it through a
+# (short) queue. Each entry is staged in a FileSink next to where it's
+# going: commit() renames them all into place, abort() throws them out.
+# Nothing gets created before that, directories included: a file
+# going into a directory that isn't there yet is staged in the
+# closest one that is, and the directories get made in commit().
+# Looks enough like a FileSink (write, digests, length) for Transfer.
+class Archive:
+    QUEUE_DEPTH = 8
+    CHUNK = 256*1024
+
+    def __init__(self, allow, hashes, logger):
+        self.allow = [ os.path.normpath(a) for a in allow ]
+        self.logger = logger
+        self.hashers = { h : hashlib.new(h) for h in hashes }
+        self.length = 0
+        # dest : FileSink
+        self.staged = {}
+        # directories to make, in the order they showed up
+        self.dirs = []
+        self.error = None
+        self.q = queue.Queue(self.QUEUE_DEPTH)
+        self.buf = memoryview(b'')
+        self.eof = False
+        self.thread = threading.Thread(target=self._extract, name='pyfwupd-archive')
+        self.thread.start()
+
+    def write(self, data):
+        if self.error is not None:
+            raise ValueError("archive extraction failed: " + repr(self.error))
+        # the frame buffer's going to get reused
+        data = bytes(data)
+        for h in self.hashers.values():
+            h.update(data)
+        self.length += len(data)
+        self.q.put(data)
+
+    def digest(self, name):
+        return self.hashers[name].digest()
+
+    def hexdigest(self, name):
+        return self.hashers[name].hexdigest()
+
+    def read(self, n=-1):
+        """ tarfile's end """
+        out = bytearray()
+        while (n < 0 or len(out) < n) and not self.eof:
+            if not len(self.buf):
+                b = self.q.get()
+                if b is None:
+                    self.eof = True
+                    break
+                self.buf = memoryview(b)
+            k = len(self.buf) if n < 0 else min(n - len(out), len(self.buf))
+            out += self.buf[:k]
+            self.buf = self.buf[k:]
+        return bytes(out)
+
+    def destination(self, name):
+        """ where an entry goes, if it's allowed to """
+        dest = os.path.normpath(os.path.join('/', name))
+        # and no sneaking out through a symlink
+        real = os.path.join(os.path.realpath(os.path.dirname(dest)),
+                            os.path.basename(dest))
+        for a in self.allow:
+            if (os.path.commonpath([dest, a]) == a and
+                os.path.commonpath([real, a]) == a):
+                return Path(dest)
+        raise ValueError(f'{name} is not in an allowed directory')
+
+    def _stage(self, tf, m):
+        dest = self.destination(m.name)
+        if m.isdir():
+            if not dest.is_dir():
+                self.dirs.append(dest)
+            return
+        if not m.isreg():
+            raise ValueError(f'{m.name}: only files and directories are allowed')
+        # a later entry for the same file wins
+        old = self.staged.pop(dest, None)
+        if old is not None:
+            old.abort()
+        tmp = None
+        if not dest.parent.is_dir():
+            self.dirs.append(dest.parent)
+            where = dest.parent
+            while not where.is_dir():
+                where = where.parent
+            tmp = where / f'.pyfwupd.{len(self.dirs)}.{len(self.staged)}.{dest.name}'
+        sink = FileSink(dest, (), tmp=tmp)
+        self.staged[dest] = sink
+        f = tf.extractfile(m)
+        while True:
+            b = f.read(self.CHUNK)
+            if not b:
+                break
+            sink.write(b)
+        sink.close(sync=True)
+        # no setuid/setgid/sticky from someone else's tarball
+        os.chmod(sink.tmp, m.mode & 0o777)
+        self.logger.detail(f'staged {dest} ({sink.length} bytes)')
+
+    def _extract(self):
+        try:
+            with tarfile.open(fileobj=self, mode='r|*') as tf:
+                for m in tf:
+                    self._stage(tf, m)
+        except Exception as e:
+            self.error = e
+        # whatever's left (the end padding, or everything after an error)
+        while not self.eof:
+            if self.q.get() is None:
+                self.eof = True
+
+    def finish(self):
+        self.q.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise ValueError("archive extraction failed: " + repr(self.error))
+
+    def commit(self):
+        for d in self.dirs:
+            d.mkdir(parents=True, exist_ok=True)
+        for sink in self.staged.values():
+            sink.commit()
+
+    def abort(self):
+        if self.thread.is_alive():
+            self.q.put(None)
+            self.thread.join()
+        for sink in self.staged.values():
+            sink.abort()
+        self.staged = {}
+
+# A file on its way in. This used to be the curFile list.
+class Transfer:
+    def __init__(self, fn, length, timeout, mode, digest=None, method=None,
+                 base=None, offset=0):
+        """
+        fn : filename (PYFW/PYFZ/PYDL) or the expected md5 (PYEX)
+        length : bytes still to come (as sent, so compressed for PYFZ)
+        timeout : PYEX timeout
+        digest : (hashlib name, expected digest) or None
+        method : PYFZ/PYDL compression method
+        base : PYDL (base filename, (hashlib name, expected digest))
+        offset : where the data starts in the file (resuming)
+        """
+        self.fn = fn
+        self.length = length
+        self.offset = offset
+        self.remaining = length - offset
+        self.timeout = timeout
+        self.mode = mode
+        self.digest = digest
+        self.method = method
+        self.base = base
+        self.sink = None
+        self.inflater = None
+        self.patcher = None
+        # whichever of the above the data goes into first
+        self.out = None
+        # the Journal, if we're resumable
+        self.journal = None
+        # resumed data we already have
+        self.skip = 0
+
+    @property
+    def resumable(self):
+        return self.mode == PYFW and self.digest is not None
+
+    def write(self, data):
+        if self.skip:
+            n = min(self.skip, len(data))
+            self.skip -= n
+            data = data[n:]
+        if len(data):
+            self.out.write(data)
+
+    def finish(self):
+        """ make sure nothing got cut off on the way through """
+        if self.inflater is not None:
+            self.inflater.finish()
+        if self.patcher is not None:
+            self.patcher.finish()
+        if self.mode == PYAR:
+            self.sink.finish()
+
+    def abort(self):
+        if self.patcher is not None:
+            self.patcher.close()
+        if self.sink is not None:
+            self.sink.abort()
+        if self.journal is not None:
+            self.journal.clear()
+            self.journal = None
+
+# A PYEX script being run.
+class Script:
+    def __init__(self, path, md5, timeout):
+        self.path = path
+        self.md5 = md5
+        self.timeout = timeout
+        self.p = None
+        self.pidfd = None
+        self.timer = None
+        self.timedOut = False
+        self.started = None
+        # partial line
+        self.buf = b''
+        self.tail = deque(maxlen=ScriptRunner.TAIL_LINES)
+
+# Runs PYEX scripts without holding up the frames. The output (stdout
+# and stderr) comes back through the selector and goes into the
+# journal a line at a time as it shows up, and a pidfd says when it's
+# exited. Only limit run at once (0 = no limit), the rest wait their
+# turn. A timeout is a Timer that kills it. How the last few went
+# (exit status, how long, end of the output) goes in RESULTSPATH.
+#
+# submit() can be called from anywhere, everything else is the main
+# thread's: whoever submits has to wake it up to call service().
+class ScriptRunner:
+    TAIL_LINES = 16
+    KEEP_RESULTS = 8
+    # how long close() lets them finish
+    CLOSE_WAIT = 10
+
+    def __init__(self, sel, logger, limit=1, results=RESULTSPATH):
+        self.sel = sel
+        self.logger = logger
+        self.limit = limit
+        self.results = Path(results)
+        self.lock = threading.Lock()
+        self.waiting = deque()
+        self.running = []
+        self.submitted = 0
+        # closing: don't start anything else
+        self.stopping = False
+
+    def submit(self, path, md5, timeout):
+        """ moves path out of the way first: the same script can be sent
+            again while this copy's still waiting or running """
+        with self.lock:
+            self.submitted += 1
+            n = self.submitted
+        run = Path(path).with_suffix(f'.{n}.ex')
+        os.replace(path, run)
+        with self.lock:
+            self.waiting.append(Script(run, md5, timeout))
+
+    def service(self):
+        """ start whatever we've got room for """
+        while not self.stopping and (not self.limit or len(self.running) < self.limit):
+            with self.lock:
+                if not len(self.waiting):
+                    return
+                sc = self.waiting.popleft()
+            self._start(sc)
+
+    def _start(self, sc):
+        self.logger.file(f'script {sc.md5} : executing.')
+        try:
+            Path(sc.path).chmod(0o755)
+            sc.p = Popen(sc.path, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT)
+            sc.pidfd = os.pidfd_open(sc.p.pid)
+        except Exception as e:
+            self.logger.error(f'script {sc.md5} : could not start: {repr(e)}')
+            if sc.p is not None:
+                sc.p.kill()
+                sc.p.wait()
+            self._record(sc, None)
+            return
+        sc.started = time.monotonic()
+        os.set_blocking(sc.p.stdout.fileno(), False)
+        self.sel.register(sc.p.stdout, selectors.EVENT_READ,
+                          lambda f, m, sc=sc : self._output(sc))
+        self.sel.register(sc.pidfd, selectors.EVENT_READ,
+                          lambda f, m, sc=sc : self._exited(sc))
+        if sc.timeout:
+            sc.timer = threading.Timer(sc.timeout, self._timeout, args=(sc,))
+            sc.timer.daemon = True
+            sc.timer.start()
+        self.running.append(sc)
+
+    def _timeout(self, sc):
+        sc.timedOut = True
+        sc.p.kill()
+
+    def _lines(self, sc, data):
+        lines = (sc.buf + data).split(b'\n')
+        sc.buf = lines.pop()
+        for l in lines:
+            l = l.decode(errors='replace')
+            sc.tail.append(l)
+            self.logger.file(l)
+
+    def _output(self, sc):
+        try:
+            data = os.read(sc.p.stdout.fileno(), 65536)
+        except BlockingIOError:
+            return
+        if data:
+            self._lines(sc, data)
+        else:
+            # everyone's closed it, we'll hear about the exit
+            self.sel.unregister(sc.p.stdout)
+            sc.p.stdout.close()
+
+    def _exited(self, sc):
+        rc = sc.p.wait()
+        # whatever it left behind
+        if not sc.p.stdout.closed:
+            try:
+                self._lines(sc, os.read(sc.p.stdout.fileno(), 65536))
+            except BlockingIOError:
+                pass
+            self.sel.unregister(sc.p.stdout)
+            sc.p.stdout.close()
+        if sc.buf:
+            self._lines(sc, b'\n')
+        self.sel.unregister(sc.pidfd)
+        os.close(sc.pidfd)
+        if sc.timer is not None:
+            sc.timer.cancel()
+        self.running.remove(sc)
+        self._record(sc, rc)
+        self.service()
+
+    def _record(self, sc, rc):
+        elapsed = time.monotonic() - sc.started if sc.started else 0
+        if sc.started is None:
+            self.logger.file(f'script {sc.md5} : never started')
+        elif sc.timedOut:
+            self.logger.file(f'script {sc.md5} : timed out after {sc.timeout} s, killed')
+        else:
+            self.logger.file(f'script {sc.md5} : exited with {rc} after {elapsed:.1f} s')
+        try:
+            os.unlink(sc.path)
+        except OSError:
+            pass
+        try:
+            results = json.loads(self.results.read_text())
+        except Exception:
+            results = []
+        results.insert(0, { 'md5' : sc.md5,
+                            'returncode' : rc,
+                            'timedOut' : sc.timedOut,
+                            'seconds' : elapsed,
+                            'finished' : time.time(),
+                            'tail' : list(sc.tail) })
+        tmp = self.results.with_suffix('.new')
+        tmp.write_text(json.dumps(results[:self.KEEP_RESULTS]))
+        os.replace(tmp, self.results)
+
+    def close(self, wait=CLOSE_WAIT):
+        """ run everything we've been handed to the end, for up to
+            wait seconds. Anything still going after that gets killed,
+            anything that never got started never will. """
+        deadline = time.monotonic() + wait
+        while True:
+            self.service()
+            if not len(self.running):
+                return
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            sc = self.running[0]
+            fds = [ sc.pidfd ]
+            if not sc.p.stdout.closed:
+                fds.append(sc.p.stdout)
+            ready, _, _ = select.select(fds, [], [], left)
+            if sc.pidfd in ready:
+                self._exited(sc)
+            elif len(ready):
+                self._output(sc)
+        self.stopping = True
+        with self.lock:
+            waiting, self.waiting = self.waiting, deque()
+        for sc in waiting:
+            self.logger.error(f'script {sc.md5} : shutting down, not starting it')
+            self._record(sc, None)
+        for sc in self.running:
+            self.logger.error(f'script {sc.md5} : still running at shutdown, killing it')
+            sc.timedOut = True
+            signal.pidfd_send_signal(sc.pidfd, signal.SIGKILL)
+        while len(self.running):
+            sc = self.running[0]
+            select.select([ sc.pidfd ], [], [])
+            self._exited(sc)
+
+# This used to be a giant closure in main. It handles the
+# button events from the GPIO-keys: each press on the bank we're
+# waiting on means there's a frame in it, so we read it back,
+# acknowledge it, flip banks and deal with the data.
+#
+# Pipelined mode: the main thread only reads the frame back into a
+# free buffer and acknowledges the bank, so the sender can refill it
+# right away. Conversion and writing happen on a worker thread, in
+# order. If the worker falls behind we run out of free buffers and
+# stop acknowledging, which holds off the sender.
+class FrameReceiver:
+    # no header's going to be bigger than this
+    HEADER_MAX = 1024
+
+    def __init__(self, sel, handler, logger, banks, typePath, image, conv,
+                 pipeline=0, hashes=('md5',), journal=JOURNALPATH,
+                 allow=ARCHIVE_ALLOW, status=STATUSPATH, scripts=1):
+        """
+        sel : selector, so the worker can wake us up
+        handler : SignalHandler, we terminate through it on errors
+        banks : [stateA, stateB], each [ code, gpio, readback type, other ]
+        typePath : readback type path
+        image : readback image path
+        conv : Converter
+        pipeline : number of frame buffers for pipelined mode (0 = off)
+        hashes : digests to compute (and log) for every file
+        journal : where to keep track of resumable transfers
+        allow : directories PYAR entries can go in
+        status : where to publish our Status
+        scripts : how many PYEX scripts can run at once (0 = no limit)
+        """
+        self.handler = handler
+        self.logger = logger
+        self.state = banks[0]
+        self.typePath = typePath
+        self.image = image
+        self.conv = conv
+        # start with no file
+        self.curFile = None
+        # start with no horrible errors
+        self.horribleProblem = None
+        self.hashes = hashes
+        self.journal = Journal(journal)
+        self.allow = allow
+        self.status = Status(status)
+        # so the status can say which bank
+        self.bankA = banks[0]
+        # the worker pokes this if it has to terminate us
+        self.rfd, self.wfd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        sel.register(self.rfd, selectors.EVENT_READ, self._wake)
+        self.scripts = ScriptRunner(sel, logger, scripts)
+        self.pipeline = pipeline
+        self.worker = None
+        if pipeline:
+            self.free = queue.Queue()
+            for i in range(pipeline):
+                self.free.put(Converter.frameBuffer())
+            self.work = queue.Queue()
+            self.worker = threading.Thread(target=self._convertWorker,
+                                           name='pyfwupd-convert')
+            self.worker.start()
+            self.logger.detail("pipelined with %d frame buffers" % pipeline)
+
+    def fail(self, code, msg):
+        self.horribleProblem = code
+        self.status.update(error=code)
+        self.logger.error(msg)
+        self.handler.set_terminate()
+        os.write(self.wfd, b'\x01')
+
+    def _wake(self, fd, mask):
+        # gets us out of select so we see terminate, or so we go
+        # start scripts
+        os.read(fd, 64)
+        self.scripts.service()
+
+    def _convertWorker(self):
+        while True:
+            buf = self.work.get()
+            if buf is None:
+                return
+            # once something's gone wrong, just drain
+            if self.horribleProblem is None:
+                try:
+                    self.convertFrame(buf)
+                except Exception as e:
+                    self.fail(5, "Converting frame failed: " + repr(e))
+            self.free.put(buf)
+
+    def handleEvent(self, f, m):
+        eb = f.read(Event.LENGTH)
+        # info
+        self.logger.debug("out of read wait, got %d bytes" % len(eb))
+        self.logger.trace(list(eb))
+        if not eb or len(eb) != Event.LENGTH:
+            self.logger.error("skipping malformed read")
+            return
+        e = Event(eb)
+        if e.code is None:
+            self.logger.debug("skipping separator")
+            return
+        self.logger.detail("processing an event: currently in state %d" % self.state[0])
+        if e.code == self.state[0] and e.value == 0:
+            # this shouldn't happen, it's a clear event for the one we're on
+            self.logger.warning("code %d value %d ????" % (e.code, e.value))
+            return
+        if e.code == self.state[0] and e.value == 1:
+            if self.pipeline:
+                # blocks if the worker's behind
+                buf = self.free.get()
+                self.conv.readFrame(self.image, buf)
+                self.ackBank()
+                self.work.put(buf)
+            else:
+                self.conv.readFrame(self.image, self.conv.inbuf)
+                self.ackBank()
+                self.convertFrame()
+        else:
+            if e.code == self.state[3][0] and e.value == 0:
+                self.logger.detail("release event seen")
+            else:
+                self.logger.warning("code %d value %d ???" % (e.code, e.value))
+
+    def convertFrame(self, buf=None):
+        start = time.perf_counter()
+        data = self.conv.convert(buf)
+        converted = time.perf_counter()
+        self.processData(data)
+        self.status.frameTimes(converted - start, time.perf_counter() - converted)
+
+    def ackBank(self):
+        """ tell the sender this bank's free and go wait on the other """
+        self.status.frame(0 if self.state is self.bankA else 1)
+        self.state[1].write(1)
+        self.state[1].write(0)
+        self.state = self.state[3]
+        self.typePath.write_text(self.state[2])
+
+    def parseHeader(self, data):
+        """ parse the header in the first block of a file. Returns
+            a Transfer and where the data starts """
+        hdr = bytes(data[:self.HEADER_MAX])
+        self.logger.detail("no curFile - parsing first block")
+        self.logger.trace("marker:" + str(list(hdr[0:4])))
+        self.logger.trace("length:" + str(list(hdr[4:8])))
+        self.logger.trace("beginning of fn:" + str(list(hdr[8:12])))
+        if hdr[0:4] not in (PYFW, PYEX, PYFZ, PYDL, PYAR):
+            raise ValueError("communication error: no file, but got " + str(list(hdr[0:4])))
+        if hdr[0:4] in (PYFW, PYFZ, PYDL, PYAR):
+            mode = hdr[0:4]
+            thisTimeout = None
+            thisDigest = None
+            thisMethod = None
+            thisBase = None
+            thisOffset = 0
+            # pyfw's header structure is
+            # (4 bytes) <- length of file, top bit = digest follows,
+            #              bit 30 = resume
+            # (pyfz/pydl only) 1 byte compression method
+            # (null terminated string) <- filename
+            # (pydl only) (null terminated string) <- base filename
+            # (pydl only) 1 byte digest type, then the base's digest
+            # (optional) 1 byte digest type, then the digest
+            # (pyfw resume only) 4 byte offset of this data in the file
+            # 1 byte checksum of the entire header
+            self.logger.debug("%s okay, unpacking header" % mode.decode())
+            thisLen = struct.unpack(">I", hdr[4:8])[0]
+            startFn = 8
+            if mode in (PYFZ, PYDL):
+                thisMethod = hdr[8]
+                startFn = 9
+            # index of the null terminator
+            endFn = hdr[startFn:].index(b'\x00') + startFn
+            thisFn = hdr[startFn:endFn].decode()
+            if mode == PYDL:
+                endBase = hdr[endFn+1:].index(b'\x00') + endFn + 1
+                baseFn = hdr[endFn+1:endBase].decode()
+                baseDigest, endFn = self.parseDigest(hdr, endBase+1)
+                thisBase = (baseFn, baseDigest)
+                # a delta isn't compressed unless it says so
+                if not thisMethod:
+                    thisMethod = None
+                if not thisLen & DIGEST_FLAG:
+                    raise ValueError("delta has no target digest")
+            if mode == PYAR and not thisLen & DIGEST_FLAG:
+                raise ValueError("archive has no digest")
+            if thisLen & DIGEST_FLAG:
+                # and pretend the filename ended after the digest
+                thisDigest, endFn = self.parseDigest(hdr, endFn+1)
+            if thisLen & RESUME_FLAG:
+                if mode != PYFW or thisDigest is None:
+                    raise ValueError("only PYFW with a digest can resume")
+                thisOffset = struct.unpack(">I", hdr[endFn+1:endFn+5])[0]
+                endFn += 4
+            thisLen &= ~(DIGEST_FLAG | RESUME_FLAG)
+            # now sum through the checksum, which is after the null terminator
+            # (so in python you add 2 b/c the end slice index is 1 after your final)
+            cks = sum(hdr[:endFn+2]) % 256
+            if cks != 0:
+                self.logger.error(list(hdr[:endFn+2]))
+                raise ValueError("checksum failed: %2.2x" % cks)
+        else:
+            mode = PYEX
+            thisDigest = None
+            thisMethod = None
+            thisBase = None
+            thisOffset = 0
+            # pyex's header structure is
+            # (4 bytes) <- length of file
+            # (4 bytes) <- timeout
+            # (32 byte null terminated string) <- MD5sum
+            # (1 byte) <- checksum of the header
+            # It doesn't need a filename since it's going to be executed
+            # if the MD5sum matches.
+            self.logger.debug("PYEX okay, unpacking header")
+            thisLen = struct.unpack(">I", hdr[4:8])[0]
+            thisTimeout = struct.unpack(">I", hdr[8:12])[0]
+            if not thisTimeout:
+                thisTimeout = None
+            endFn = hdr[12:].index(b'\x00') + 12
+            cks = sum(hdr[:endFn+2]) % 256
+            if cks != 0:
+                self.logger.error(list(hdr[:endFn+2]))
+                raise ValueError("checksum failed: %2.2x" % cks)
+            thisFn = hdr[12:endFn].decode()
+        return Transfer(thisFn, thisLen, thisTimeout, mode, thisDigest, thisMethod,
+                        thisBase, thisOffset), endFn+2
+
+    @staticmethod
+    def parseDigest(hdr, pos):
+        """ digest type byte at pos, then the digest. Returns
+            (hashlib name, digest) and the index of its last byte """
+        if hdr[pos] not in DIGESTS:
+            raise ValueError("unknown digest type %d" % hdr[pos])
+        name, dlen = DIGESTS[hdr[pos]]
+        return (name, hdr[pos+1:pos+1+dlen]), pos+dlen
+
+    def openSink(self, xfer):
+        """ where this transfer's going: straight next to its destination
+            for PYFW/PYFZ/PYDL, SCRIPTPATH for PYEX.
+            Compressed data goes through an Inflater, deltas through
+            a Patcher, on the way. Archives get an Archive. """
+        hashes = set(self.hashes)
+        if xfer.digest is not None:
+            hashes.add(xfer.digest[0])
+        if xfer.mode == PYAR:
+            xfer.sink = Archive(self.allow, hashes, self.logger)
+            xfer.out = xfer.sink
+            return
+        if xfer.mode == PYEX:
+            if not re.fullmatch('[0-9a-f]{32}', xfer.fn):
+                raise ValueError(f'{xfer.fn} is not an md5sum')
+            dest = SCRIPTPATH % xfer.fn
+        else:
+            dest = xfer.fn
+        resume = 0
+        if xfer.resumable:
+            j = self.journal.matches(xfer)
+            if j is not None and j['tmp'] == str(FileSink.tempPath(dest)):
+                resume = j['received']
+            elif xfer.offset:
+                raise ValueError(f'nothing to resume {xfer.fn} from')
+            else:
+                self.journal.discard()
+            if xfer.offset > resume:
+                raise ValueError(f'resuming {xfer.fn} at {xfer.offset} but only have {resume}')
+            xfer.skip = resume - xfer.offset
+            if resume:
+                self.logger.info(f'resuming {xfer.fn} at {xfer.offset}, have {resume}')
+        try:
+            xfer.sink = FileSink(dest, hashes, resume)
+        except Exception:
+            if resume:
+                self.journal.discard()
+            raise
+        xfer.out = xfer.sink
+        if xfer.resumable:
+            xfer.journal = self.journal
+        try:
+            if xfer.base is not None:
+                xfer.patcher = Patcher(*xfer.base, xfer.out)
+                xfer.out = xfer.patcher
+            if xfer.method is not None:
+                xfer.inflater = Inflater(xfer.method, xfer.out)
+                xfer.out = xfer.inflater
+        except Exception:
+            xfer.abort()
+            raise
+
+    def processData(self, data):
+        """ deal with a converted block (a memoryview, no copies) """
+        dlen = len(data)
+        if self.curFile is None:
+            try:
+                xfer, start = self.parseHeader(data)
+                self.openSink(xfer)
+            except Exception as e:
+                self.fail(2, "First frame failed: " + repr(e))
+                return
+            self.curFile = xfer
+            self.status.transfer(xfer)
+            data = data[start:]
+            dlen = len(data)
+            self.logger.info("beginning " + xfer.fn + " len " + str(xfer.remaining))
+        xfer = self.curFile
+        if dlen > xfer.remaining:
+            try:
+                # xfer.remaining is right: it's # of bytes remaining
+                # and b[0:5] grabs the first 5 bytes
+                xfer.write(data[:xfer.remaining])
+                self.finishFile()
+            except Exception as e:
+                self.fail(3, "Finishing file failed: " + repr(e))
+                return
+            self.curFile = None
+            self.status.finished()
+        else:
+            try:
+                xfer.write(data)
+                if xfer.journal is not None:
+                    xfer.sink.flush()
+                    xfer.journal.save(xfer)
+            except Exception as e:
+                self.fail(4, "Writing to file failed: " + repr(e))
+                return
+            xfer.remaining = xfer.remaining - dlen
+            self.status.update(remaining=xfer.remaining)
+            self.logger.detail("%s: %d bytes, %d remaining" % (xfer.fn, dlen, xfer.remaining))
+
+    def finishFile(self):
+        xfer = self.curFile
+        sink = xfer.sink
+        try:
+            xfer.finish()
+        except Exception:
+            xfer.abort()
+            raise
+        # check it before it goes anywhere
+        if xfer.digest is not None:
+            name, expected = xfer.digest
+            if sink.digest(name) != expected:
+                xfer.abort()
+                raise ValueError(f'{name} failed: {sink.hexdigest(name)} != {expected.hex()}')
+        if xfer.mode in (PYFW, PYFZ, PYDL, PYAR):
+            sink.commit()
+            if xfer.journal is not None:
+                xfer.journal.clear()
+            sums = ' '.join(f'{h}sum {sink.hexdigest(h)}' for h in sorted(sink.hashers))
+            if xfer.patcher is not None:
+                sums += f' ({sink.length} bytes, {xfer.patcher.copied} from {xfer.base[0]})'
+            elif xfer.inflater is not None:
+                sums += f' ({sink.length} bytes from {xfer.inflater.compressed})'
+            elif xfer.mode == PYAR:
+                sums += f' ({len(sink.staged)} files)'
+            self.logger.file(f'completed {xfer.fn} : {sums}')
+        elif xfer.mode == PYEX:
+            # check its md5
+            themd5 = sink.hexdigest('md5')
+            if themd5 != xfer.fn:
+                xfer.abort()
+                raise ValueError(f'md5sum failed: {themd5} != {xfer.fn}')
+            sink.commit()
+            self.logger.file(f'script {themd5} : MD5 matched, queued.')
+            # the main thread starts it
+            self.scripts.submit(sink.dest, themd5, xfer.timeout)
+            os.write(self.wfd, b'\x01')
+
+    def close(self):
+        # finish whatever's already been acknowledged
+        if self.worker is not None:
+            self.work.put(None)
+            self.worker.join()
+        xfer = self.curFile
+        if xfer and xfer.journal is not None:
+            # keep it, the sender can pick up from here
+            xfer.sink.flush()
+            xfer.journal.save(xfer)
+            xfer.sink.close()
+            self.logger.warning(f'file {xfer.fn} is incomplete, keeping {xfer.sink.length} bytes to resume')
+        elif xfer:
+            self.logger.warning("file " + xfer.fn + " is incomplete, deleting temporary!!")
+            xfer.abort()
+        self.scripts.close()
+        self.status.close()
+
 if __name__ == "__main__":
+    # the hardware's only needed when we're really running: everything
+    # above can be used off-target (see fwharness.py)
+    from pyzynqmp import Bitstream, PyZynqMP
+    from signalhandler import SignalHandler
+    from gpio import GPIO
+    CURRENT=PyZynqMP.CURRENT
+    READBACK_TYPE_PATH=PyZynqMP.READBACK_TYPE_PATH
+    READBACK_LEN_PATH=PyZynqMP.READBACK_LEN_PATH
+    IMAGE_PATH=PyZynqMP.IMAGE_PATH
+
     z = PyZynqMP()
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-p', '--pipeline', type=int, default=0, metavar='N',
+                        help='convert/write on a worker thread with N frame buffers')
+    parser.add_argument('--allow', action='append', metavar='DIR',
+                        help='directory archive entries can go in (default %s)' % ' '.join(ARCHIVE_ALLOW))
+    parser.add_argument('--numpy', action='store_true',
+                        help='convert frames with NumPy instead of libxilframe')
+    parser.add_argument('--sha256', action='store_true',
+                        help='compute (and log) sha256 as well as md5 for every file')
+    parser.add_argument('--scripts', type=int, default=1, metavar='N',
+                        help='run at most N PYEX scripts at once (0 = no limit)')
     args = parser.parse_args()
     # just make the first -v count double
     if args.verbose:
@@ -182,7 +1482,6 @@ if __name__ == "__main__":
     gpioB = GPIO(GPIO.get_gpio_pin(13), 'out')
     typePath = Path(READBACK_TYPE_PATH)
     lenPath = Path(READBACK_LEN_PATH)
-    image = Path(IMAGE_PATH)
     
     # okey dokey, starting up
 
@@ -203,175 +1502,24 @@ if __name__ == "__main__":
 
     # start up with bank A mode
     # whenever you enter eDownloadMode you need to start with MARK_A
-    state = stateA
-    logger.detail("currently in state %d" % state[0])
+    logger.detail("currently in state %d" % stateA[0])
     
-    typePath.write_text(state[2])
+    typePath.write_text(stateA[2])
     
-    # start with no file
-    curFile = None
-    # start with no horrible errors
-    horribleProblem = None
-    # open the temporary file...
-    tempFile = open(TMPPATH, "w+b")    
-    # spawn the converter
-    conv = Converter()
-
-    # dear god this is insane
+    receiver = FrameReceiver(sel,
+                             handler,
+                             logger,
+                             [stateA, stateB],
+                             typePath,
+                             IMAGE_PATH,
+                             PyConverter() if args.numpy else Converter(),
+                             pipeline=args.pipeline,
+                             hashes=('md5', 'sha256') if args.sha256 else ('md5',),
+                             allow=args.allow if args.allow else ARCHIVE_ALLOW,
+                             scripts=args.scripts)
+
     with open(EVENTPATH, "rb") as evf:
-        
-        # maybe farm this off into a class
-        # create the event handler function
-        def handleEvent(f, m):
-            # we modify state/curFile, need to mark it as a global
-            global state
-            global curFile
-            global tempFile
-            
-            eb = f.read(Event.LENGTH)
-            # info
-            logger.debug("out of read wait, got %d bytes" % len(eb))
-            logger.trace(list(eb))
-            if not eb or len(eb) != Event.LENGTH:
-                logger.error("skipping malformed read")
-                return
-            e = Event(eb)
-            if e.code is None:
-                logger.debug("skipping separator")
-                return
-            else:
-                logger.detail("processing an event: currently in state %d" % state[0])
-                if e.code == state[0] and e.value == 0:
-                    # this shouldn't happen, it's a clear event for the one we're on
-                    logger.warning("code %d value %d ????" % (e.code, e.value))
-                    return
-                if e.code == state[0] and e.value == 1:
-                    # sooo much of this needs exception handling!!
-                    # this is like, absurdly awful!!
-                    r = image.read_bytes()
-                    state[1].write(1)
-                    state[1].write(0)
-                    state = state[3]
-                    typePath.write_text(state[2])
-                    
-                    data = conv.convert(r)
-                    dlen = BANKLEN
-                    if curFile is None:
-                        logger.detail("no curFile - parsing first block")
-                        logger.trace("marker:" + str(list(data[0:4])))
-                        logger.trace("length:" + str(list(data[4:8])))
-                        logger.trace("beginning of fn:" + str(list(data[8:12])))
-                        try:
-                            if data[0:4] != PYFW and data[0:4] != PYEX:
-                                raise ValueError("communication error: no file, but got " + str(list(data[0:4])))
-                            if data[0:4] == PYFW:
-                                mode = PYFW
-                                thisTimeout = None                                
-                                # pyfw's header structure is
-                                # (4 bytes) <- length of file
-                                # (null terminated string) <- filename
-                                # 1 byte checksum of the entire header
-                                logger.debug("PYFW okay, unpacking header")
-
-                                thisLen = struct.unpack(">I", data[4:8])[0]
-                                # index of the null terminator
-                                endFn = data[8:].index(b'\x00') + 8
-                                # now sum through the checksum, which is after the null terminator
-                                # (so in python you add 2 b/c the end slice index is 1 after your final)
-                                cks = sum(data[:endFn+2]) % 256                                
-                                if cks != 0:
-                                    logger.error(list(data[:endFn+2]))                                
-                                    raise ValueError("checksum failed: %2.2x" % cks)
-                                thisFn = data[8:endFn].decode()
-                                data = data[endFn+2:]
-                                dlen = len(data)
-
-                            elif data[0:4] == PYEX:
-                                mode = PYEX
-                                # pyex's header structure is
-                                # (4 bytes) <- length of file
-                                # (4 bytes) <- timeout
-                                # (32 byte null terminated string) <- MD5sum
-                                # (1 byte) <- checksum of the header
-                                # It doesn't need a filename since it's going to be executed
-                                # if the MD5sum matches.
-                                logger.debug("PYEX okay, unpacking header")
-                                thisLen = struct.unpack(">I", data[4:8])[0]
-                                thisTimeout = struct.unpack(">I", data[8:12])[0]
-                                if not thisTimeout:
-                                    thisTimeout = None
-                                endFn = data[12:].index(b'\x00') + 12
-                                cks = sum(data[:endFn+2]) % 256
-                                if cks != 0:
-                                    logger.error(list(data[:endFn+2]))
-                                    raise ValueError("checksum failed: %2.2x" % cks)
-                                thisFn = data[12:endFn].decode()
-                                data = data[endFn+2:]
-                                dlen = len(data)
-                        except Exception as e:
-                            horribleProblem = 2
-                            logger.error("First frame failed: " + repr(e))
-                            handler.set_terminate()
-                            return
-                        logger.info("beginning " + thisFn + " len " + str(thisLen))
-                        curFile = [thisFn, thisLen, thisTimeout, mode]
-                    if dlen > curFile[1]:
-                        try:
-                            # grr curFile[1] is right: it's # of bytes remaining
-                            # and b[0:5] grabs the first 5 bytes
-                            tempFile.write(data[:curFile[1]])
-                            # close the temporary file
-                            tempFile.close()
-                            if curFile[3] == PYFW:
-                                # move it to its final destination
-                                shutil.move(TMPPATH, curFile[0])
-                                md5 = filemd5(curFile[0])
-                                logger.file(f'completed {curFile[0]} : md5sum {filemd5(curFile[0])}')
-                            elif curFile[3] == PYEX:
-                                # check its md5
-                                themd5 = filemd5(TMPPATH)
-                                if themd5 == curFile[0]:
-                                    logger.file(f'script {themd5} : MD5 matched, executing.')
-                                    # mark it executable
-                                    Path(TMPPATH).chmod(0o755)
-                                    out = ''
-                                    try:
-                                        p = Popen(TMPPATH, stdin=PIPE, stdout=PIPE)
-                                        out = p.communicate(timeout=curFile[2])[0]
-                                    except TimeoutExpired:
-                                        p.kill()
-                                        out = p.communicate()[0]
-                                    for l in out.split(b'\n'):
-                                        logger.file(l.decode())
-                                else:
-                                    raise ValueError(f'md5sum failed: {themd5} != {curFile[0]}')
-                            # and get a new one
-                            tempFile = open(TMPPATH, "w+b")
-                        except Exception as e:
-                            horribleProblem = 3
-                            logger.error("Finishing file failed: " + repr(e))
-                            handler.set_terminate()
-                            return
-                        curFile = None
-                    else:
-                        try:
-                            tempFile.write(data)
-                        except Exception as e:
-                            horribleProblem = 4
-                            logger.error("Writing to file failed: " + repr(e))
-                            handler.set_terminate()
-                            return
-                        curFile[1] = curFile[1] - dlen
-                        logger.detail("%s: %d bytes, %d remaining" % (curFile[0], dlen, curFile[1]))
-                else:
-                    if e.code == state[3][0] and e.value == 0:
-                        logger.detail("release event seen")
-                    else:
-                        logger.warning("code %d value %d ???" % (e.code, e.value))
-                    return
-            return        
-        
-        sel.register(evf, selectors.EVENT_READ, handleEvent)
+        sel.register(evf, selectors.EVENT_READ, receiver.handleEvent)
         # we can now mark things as ready. evf is already open,
         # so when we select below, even if something comes in while
         # we're setting it back to zero, we'll still see it.
@@ -386,18 +1534,14 @@ if __name__ == "__main__":
                 callback = key.data
                 callback(key.fileobj, mask)
 
-    if curFile:
-        logger.warning("file " + curFile[0] + " is incomplete, deleting temporary!!")
-        tempFile.close()
-        os.unlink(TMPPATH)
+    receiver.close()
                 
-    if horribleProblem:
-        logger.error(f'terminating with horrible error {horribleProblem}')
-        exit(horribleProblem)
+    if receiver.horribleProblem:
+        logger.error(f'terminating with horrible error {receiver.horribleProblem}')
+        exit(receiver.horribleProblem)
     else:
         logger.info("terminating normally")
         exit(0)
 
     # we do NOT need to clear psdones, because they autoclear
     # when download mode is turned off.
-    
@@ -5,6 +5,7 @@ from subprocess import Popen, PIPE, TimeoutExpired
 from pathlib import Path
 import pickle
 import struct
+import json
 from threading import Timer
 
 class HskProcessor:
@@ -83,22 +84,23 @@ class HskProcessor:
 
     def eStartState(self, pkt):
         if len(pkt) > 5:
-            self.startup.endState = pkt[4]
+            self.startup.setEndState(pkt[4])
         # we are always at least 2 data bytes
         # in return. 
-        rpkt = bytearray(7)
+        rpkt = bytearray(4)
         rpkt[1] = pkt[0]
         rpkt[0] = self.hsk.myID
         rpkt[2] = 32
-        
-        rpkt[3] = 2
-        rpkt[4] = self.startup.state
-        rpkt[5] = self.startup.endState
+        rpkt.append(self.startup.state)
+        rpkt.append(self.startup.endState)
         if rpkt[4] == 255 and self.startup.fail_msg:
-            msg = self.startup.fail_msg.encode()            
-            rpkt += msg
-            rpkt[3] += len(msg)
-        rpkt[6] = (256 - sum(rpkt[4:])) & 0xFF
+            rpkt += self.startup.fail_msg.encode()
+        elif self.startup.substep:
+            # a long operation is running in this state:
+            # tack on what it is
+            rpkt.append(self.startup.substep)
+        rpkt[3] = len(rpkt[4:])
+        rpkt.append((256 - sum(rpkt[4:])) & 0xFF)
         self.hsk.sendPacket(rpkt)
 
     def eSleep(self, pkt):
@@ -124,6 +126,58 @@ class HskProcessor:
         rpkt[5] = (256 - rpkt[4]) & 0xFF
         self.hsk.sendPacket(rpkt)            
         
+    # clock monitor status (see ClockMonitor.status). A data byte
+    # turns recovery on (bit 0 set) or off. No monitor = no data.
+    def eClockStatus(self, pkt):
+        rpkt = bytearray(4)
+        rpkt[1] = pkt[0]
+        rpkt[0] = self.hsk.myID
+        rpkt[2] = 34
+        if self.monitor is not None:
+            if len(pkt) > 5:
+                self.monitor.recover = bool(pkt[4] & 0x1)
+            rpkt += self.monitor.status()
+        rpkt[3] = len(rpkt[4:])
+        cks = (256 - sum(rpkt[4:])) & 0xFF
+        rpkt.append(cks)
+        self.hsk.sendPacket(rpkt)
+
+    # LMK register dump. Data byte 0 is 0 for a snapshot (one byte per
+    # register the LMK file programs, in address order) or 1 for a diff
+    # against the LMK file (reg hi, reg lo, expected, actual for each
+    # register that's different). The first reply starts with a status
+    # byte: 0 = OK, 1 = busy (startup has the hardware), 2 = no LMK.
+    # Anything that didn't fit comes back on requests with no data,
+    # until you get an empty reply.
+    def eClockDump(self, pkt):
+        rpkt = bytearray(4)
+        rpkt[1] = pkt[0]
+        rpkt[0] = self.hsk.myID
+        rpkt[2] = 35
+        d = pkt[4:-1]
+        if len(d):
+            if self.startup.clock.surfClock is None:
+                self.clockDump = b'\x02'
+            else:
+                r = self.startup.lmkSnapshot()
+                if r is None:
+                    self.clockDump = b'\x01'
+                else:
+                    image, snap = r
+                    if d[0] == 1:
+                        diff = self.startup.clock.surfClock.diffSnapshot(image, snap)
+                        self.clockDump = b'\x00' + b''.join(struct.pack(">HBB", reg, *v)
+                                                            for reg, v in diff.items())
+                    else:
+                        self.clockDump = b'\x00' + snap
+        rd = self.clockDump[:255]
+        self.clockDump = self.clockDump[255:]
+        rpkt += rd
+        rpkt[3] = len(rpkt[4:])
+        cks = (256 - sum(rpkt[4:])) & 0xFF
+        rpkt.append(cks)
+        self.hsk.sendPacket(rpkt)
+
     @staticmethod
     def _getSoftTimestamp(fn: bytes):
         cmd = ["unsquashfs", "-fstime", fn.decode()]
@@ -181,7 +235,7 @@ class HskProcessor:
         self.hsk.sendPacket(rpkt)                    
 
     def eFwParams(self, pkt):
-        # right now we have **3** types of fwparams
+        # right now we have **4** types of fwparams
         # type 0 : align data
         #          - rx_delay (int32 in picoseconds)
         #          - cin_delay (int32 in picoseconds)
@@ -199,6 +253,15 @@ class HskProcessor:
         # type 2 : Eye choice. This allows us to brute-force
         #          our way into finding the firmware parameters
         #          in case something goes horribly wrong.
+        # type 3 : MTS calibration. Different btwn write and read.
+        #          - runs (byte) - read/write. Nonzero runs calibration
+        #                          the next time MTS runs.
+        #          - margin (byte) - read/write
+        #          - successful runs (byte) - read
+        #          - failed runs (byte) - read
+        #          - target latency (int) - read
+        #          - tile 0-3 min/max latency (2x short each) - read
+        #          ----> read length = 24 (0xFFFF if no stats)
         # write length = 5 bytes
         # read length = 21 bytes
         rpkt = bytearray(4)
@@ -251,6 +314,13 @@ class HskProcessor:
                     eyeno = d[0]
                     if eyeno < 3:
                         self.startup.eyeno = eyeno
+            elif ptype == 3:
+                # mts calibration
+                if len(d) < 2:
+                    error_out()
+                else:
+                    self.startup.mts.cal_runs = d[0]
+                    self.startup.mts.cal_margin = d[1]
             else:
                  error_out()
         # response always has the current values
@@ -278,6 +348,23 @@ class HskProcessor:
             rpkt[3] = 1
             eyeno = self.startup.eyeno if self.startup.eyeno else -1
             rpkt += eyeno.to_bytes(1, byteorder='big', signed=True)
+        elif ptype == 3:
+            rpkt[3] = 24
+            mts = self.startup.mts
+            rpkt.append(mts.cal_runs)
+            rpkt.append(mts.cal_margin)
+            # the worker may be adding runs: take what's there now
+            runs = list(mts.cal_latency) if mts.cal_latency else []
+            rpkt.append(min(len(runs), 255))
+            rpkt.append(min(mts.cal_failures, 255))
+            rpkt += mts.target_latency.to_bytes(4, byteorder='big', signed=True)
+            for i in range(4):
+                if len(runs):
+                    lat = [ run[i] for run in runs ]
+                    rpkt += min(lat).to_bytes(2, byteorder='big')
+                    rpkt += max(lat).to_bytes(2, byteorder='big')
+                else:
+                    rpkt += b'\xff'*4
             
         cks = (256 - sum(rpkt[4:])) & 0xFF
         rpkt.append(cks)
@@ -327,6 +414,91 @@ class HskProcessor:
             rpkt.append(cks)
             self.hsk.sendPacket(rpkt)
 
+    # what pyfwupd's resume journal says: nothing if there isn't
+    # anything to resume, otherwise digest type, digest, bytes received
+    # and total length (32 bits each) and the filename.
+    def eDownloadResume(self, pkt):
+        rpkt = bytearray(4)
+        rpkt[1] = pkt[0]
+        rpkt[0] = self.hsk.myID
+        rpkt[2] = 188
+        try:
+            j = json.loads(self.fwJournal.read_text())
+            rpkt.append(j['type'])
+            rpkt += bytes.fromhex(j['digest'])
+            rpkt += struct.pack(">II", j['received'], j['length'])
+            rpkt += j['fn'].encode()[:255-len(rpkt[4:])]
+        except FileNotFoundError:
+            pass
+        rpkt[3] = len(rpkt[4:])
+        cks = (256 - sum(rpkt[4:])) & 0xFF
+        rpkt.append(cks)
+        self.hsk.sendPacket(rpkt)
+
+    # how a PYEX script went, from pyfwupd's results (0 = most recent).
+    # md5 (32 chars), flags (bit 0 = timed out, bit 1 = never started),
+    # exit status (16 bits, signed), run time in ms (32 bits), then the
+    # end of its output. Call again with no data for the rest of it.
+    def eScriptResult(self, pkt):
+        rpkt = bytearray(4)
+        rpkt[1] = pkt[0]
+        rpkt[0] = self.hsk.myID
+        rpkt[2] = 186
+        d = pkt[4:-1]
+        if len(d):
+            self.scriptResult = b''
+            try:
+                results = json.loads(self.fwResults.read_text())
+            except FileNotFoundError:
+                results = []
+            if d[0] < len(results):
+                r = results[d[0]]
+                rc = r['returncode']
+                flags = (0x1 if r['timedOut'] else 0) | (0x2 if rc is None else 0)
+                self.scriptResult = r['md5'].encode()[:32].ljust(32, b'\x00')
+                self.scriptResult += struct.pack(">BhI", flags,
+                                                 max(-32768, min(32767, rc if rc is not None else 0)),
+                                                 int(r['seconds']*1000))
+                self.scriptResult += '\n'.join(r['tail']).encode()
+        rd = self.scriptResult[:255]
+        self.scriptResult = self.scriptResult[255:]
+        rpkt += rd
+        rpkt[3] = len(rpkt[4:])
+        cks = (256 - sum(rpkt[4:])) & 0xFF
+        rpkt.append(cks)
+        self.hsk.sendPacket(rpkt)
+
+    # pyfwupd's live status (see its Status class), minus the
+    # sequence number. Nothing if it's never run.
+    def eDownloadStatus(self, pkt):
+        rpkt = bytearray(4)
+        rpkt[1] = pkt[0]
+        rpkt[0] = self.hsk.myID
+        rpkt[2] = 187
+        rpkt += self._downloadStatus()[:255]
+        rpkt[3] = len(rpkt[4:])
+        cks = (256 - sum(rpkt[4:])) & 0xFF
+        rpkt.append(cks)
+        self.hsk.sendPacket(rpkt)
+
+    def _downloadStatus(self):
+        # it's a seqlock: odd means pyfwupd's in the middle of writing,
+        # and if the sequence changed while we read, read it again
+        try:
+            fd = os.open(self.fwStatus, os.O_RDONLY)
+        except FileNotFoundError:
+            return b''
+        try:
+            for i in range(10):
+                d = os.pread(fd, 256, 0)
+                if len(d) < 4 or d[3] & 0x1:
+                    continue
+                if os.pread(fd, 4, 0) == d[:4]:
+                    return d[4:]
+        finally:
+            os.close(fd)
+        return b''
+
     def eDownloadMode(self, pkt):
         rpkt = bytearray(6)
         rpkt[1] = pkt[0]
@@ -416,8 +588,12 @@ class HskProcessor:
                  logName,
                  terminateFn,
                  softNextFile="/tmp/pueo/next",
+                 fwJournal="/tmp/pyfwupd.journal",
+                 fwStatus="/tmp/pyfwupd.status",
+                 fwResults="/tmp/pyfwupd.results",
                  plxVersionFile=None,
-                 versionFile=None):
+                 versionFile=None,
+                 clockMonitor=None):
         # these need to be actively defined to make them
         # closures - they're methods, not constant functions
         self.hskMap = {
@@ -428,9 +604,14 @@ class HskProcessor:
             18 : self.eIdentify,
             32 : self.eStartState,
             33 : self.eSleep,
+            34 : self.eClockStatus,
+            35 : self.eClockDump,
             128 : self.eFwParams,
             129 : self.eFwNext,
             135 : self.eSoftNext,
+            186 : self.eScriptResult,
+            187 : self.eDownloadStatus,
+            188 : self.eDownloadResume,
             189 : self.eJournal,
             190 : self.eDownloadMode,
             191 : self.eRestart
@@ -440,10 +621,14 @@ class HskProcessor:
         self.zynq = zynq
         self.eeprom = eeprom
         self.startup = startup
+        self.monitor = clockMonitor
         self.logger = logging.getLogger(logName)
         self.terminate = terminateFn
         self.restartCode = None
         self.nextSoft = Path(softNextFile)
+        self.fwJournal = Path(fwJournal)
+        self.fwStatus = fwStatus
+        self.fwResults = Path(fwResults)
         self.nextFw = Path(self.zynq.NEXT)
         self.plxVersion = b''
         if plxVersionFile:
@@ -463,6 +648,8 @@ class HskProcessor:
                 self.logger.error("Exception loading version: %s", repr(e))
         self.version = v            
         self.journal = b''
+        self.clockDump = b''
+        self.scriptResult = b''
 
     def _downloadMode(self, st):
         if st == 0:
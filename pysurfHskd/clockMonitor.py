@@ -0,0 +1,188 @@
+import os
+import time
+import logging
+import selectors
+import struct
+import threading
+from pueoTimer import RepeatTimer
+
+# Keeps an eye on the clocks once we're up.
+#
+# Every interval a RepeatTimer thread reads the LMK status (0xBE)
+# and the PL PLL lock (0x800 bit 14), under the startup handler's
+# hwLock. If someone else has the hardware we just skip that sample.
+# A signal has to read the same new value DEBOUNCE times in a row
+# before we believe it changed.
+#
+# Each signal has a 'bad' level (lost lock, LOS/holdover asserted):
+# going bad counts as an event, and we keep a count and the time of
+# the last one for each. Changes get handed to the main thread
+# through a pipe in the selector, which logs them and (if recovery
+# is on) calls recoverFn when a lock goes away. Startup holds hwLock
+# for its own LMK writes once we're running.
+class ClockMonitor:
+    # name, where, bit, bad level, is a lock (triggers recovery)
+    SIGNALS = ( ( 'PLL1_LCK_DET', 'lmk', 0, 0, True ),
+                ( 'PLL2_LCK_DET', 'lmk', 1, 0, True ),
+                ( 'HOLDOVER_LOS', 'lmk', 2, 1, False ),
+                ( 'HOLDOVER_LOL', 'lmk', 3, 1, False ),
+                # digital lock detect: set is the good one
+                ( 'HOLDOVER_DLD', 'lmk', 4, 0, False ),
+                ( 'LOS', 'lmk', 5, 1, False ),
+                ( 'PL_PLL_LOCK', 'surf', 14, 0, True ) )
+    INTERVAL = 1
+    DEBOUNCE = 2
+
+    def __init__(self,
+                 sel,
+                 startup,
+                 logName,
+                 recoverFn=None,
+                 recover=False,
+                 interval=INTERVAL,
+                 debounce=DEBOUNCE):
+        """
+        sel : selector to register our notification pipe with
+        startup : the StartupHandler (for the hardware and hwLock)
+        recoverFn : called (in the main thread) when a lock is lost and
+                    recover is True
+        """
+        self.logger = logging.getLogger(logName)
+        self.startup = startup
+        self.recoverFn = recoverFn
+        self.recover = recover
+        self.interval = interval
+        self.debounce = debounce
+        self.rfd, self.wfd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.sel = sel
+        sel.register(self.rfd, selectors.EVENT_READ, self._handleEvent)
+        n = len(self.SIGNALS)
+        # debounced value, candidate value and how many times we've seen it
+        self.value = [ None ]*n
+        self._candidate = [ None ]*n
+        self._seen = [ 0 ]*n
+        self.counts = [ 0 ]*n
+        self.lastEvent = [ None ]*n
+        self.samples = 0
+        self.skipped = 0
+        # (index, value, time) waiting for the main thread
+        self._pending = []
+        self._pendingLock = threading.Lock()
+        self.timer = None
+
+    @property
+    def running(self):
+        return self.timer is not None
+
+    def start(self):
+        if self.timer is not None:
+            return
+        self.logger.info("clock monitor started")
+        self.timer = RepeatTimer(self.interval, self._sample)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def close(self):
+        self.stop()
+        self.sel.unregister(self.rfd)
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+    def _read(self):
+        lmk = self.startup.clock.surfClock
+        st = {}
+        st['lmk'] = lmk.status() if lmk is not None else None
+        st['surf'] = self.startup.surf.read(0x800)
+        return st
+
+    def _sample(self):
+        if not self.startup.hwLock.acquire(blocking=False):
+            self.skipped += 1
+            return
+        try:
+            st = self._read()
+        except Exception as e:
+            self.logger.error("clock monitor read failed: %s", repr(e))
+            self.skipped += 1
+            return
+        finally:
+            self.startup.hwLock.release()
+        self.samples += 1
+        now = time.time()
+        changed = False
+        for i, (name, where, bit, bad, lock) in enumerate(self.SIGNALS):
+            if st[where] is None:
+                continue
+            v = (st[where] >> bit) & 0x1
+            if self.value[i] is None:
+                # first look is just where we start
+                self.value[i] = v
+                continue
+            if v == self.value[i]:
+                self._seen[i] = 0
+                continue
+            if v != self._candidate[i]:
+                self._candidate[i] = v
+                self._seen[i] = 0
+            self._seen[i] += 1
+            if self._seen[i] >= self.debounce:
+                self.value[i] = v
+                self._seen[i] = 0
+                if v == bad:
+                    self.counts[i] += 1
+                    self.lastEvent[i] = now
+                with self._pendingLock:
+                    self._pending.append((i, v, now))
+                changed = True
+        if changed:
+            os.write(self.wfd, b'\x01')
+
+    def _handleEvent(self, fd, mask):
+        os.read(fd, 64)
+        with self._pendingLock:
+            pending, self._pending = self._pending, []
+        lost = False
+        for i, v, t in pending:
+            name, _, _, bad, lock = self.SIGNALS[i]
+            if lock:
+                what = "locked" if v else "unlocked"
+            else:
+                what = "active" if v else "inactive"
+            if v == bad:
+                self.logger.error("clock monitor: %s went %s", name, what)
+                if lock:
+                    lost = True
+            else:
+                self.logger.info("clock monitor: %s went %s", name, what)
+        if lost and self.recover and self.recoverFn:
+            self.logger.error("clock monitor: lock lost, recovering")
+            self.stop()
+            self.recoverFn()
+
+    def status(self):
+        """ status for housekeeping:
+            running/recover flags, debounced LMK status byte, PL PLL lock,
+            event count per signal (16 bits), then for the most recent
+            event: signal index (0xFF = none) and age in seconds (32 bits),
+            then the number of samples and skipped samples (32 bits). """
+        flags = (0x1 if self.running else 0) | (0x2 if self.recover else 0)
+        lmkst = 0
+        for i, (name, where, bit, bad, lock) in enumerate(self.SIGNALS):
+            if where == 'lmk' and self.value[i]:
+                lmkst |= 1 << bit
+        plpll = self.value[-1] if self.value[-1] is not None else 0xFF
+        d = bytes([flags, lmkst, plpll])
+        d += struct.pack(">%dH" % len(self.counts), *[ min(c, 0xFFFF) for c in self.counts ])
+        last = [ (t, i) for i, t in enumerate(self.lastEvent) if t is not None ]
+        if len(last):
+            t, i = max(last)
+            d += struct.pack(">BI", i, int(time.time() - t))
+        else:
+            d += struct.pack(">BI", 0xFF, 0)
+        d += struct.pack(">II", self.samples & 0xFFFFFFFF, self.skipped & 0xFFFFFFFF)
+        return d
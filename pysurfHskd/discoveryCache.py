@@ -0,0 +1,81 @@
+import os
+import json
+import logging
+from hashlib import sha256
+from pathlib import Path
+
+# Remembers what we found the last time we went looking for hardware
+# (spidev paths, GPIO numbers) so a daemon restart doesn't have to
+# scan sysfs and rebind drivers again.
+#
+# The cache is in tmpfs and keyed by the boot ID and a hash of the
+# device tree: if either one changed, the whole thing gets tossed.
+# Each entry can also have a cheap check (e.g. does the device node
+# exist) and if that fails we just go find it again.
+class DiscoveryCache:
+    CACHE_FILE = "/tmp/pueo/discovery.json"
+    BOOT_ID = "/proc/sys/kernel/random/boot_id"
+    FDT = "/sys/firmware/fdt"
+
+    def __init__(self, logName, path=None):
+        """ path : defaults to CACHE_FILE (looked up now, not at import) """
+        self.logger = logging.getLogger(logName)
+        self.path = Path(path or self.CACHE_FILE)
+        self.key = self._key()
+        self.entries = {}
+        self.dirty = False
+        try:
+            d = json.loads(self.path.read_text())
+            if d.get('key') == self.key:
+                self.entries = d['entries']
+            else:
+                self.logger.info("discovery cache is from another boot, ignoring")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.info("discovery cache unreadable: %s", repr(e))
+
+    def _key(self):
+        key = {}
+        try:
+            key['boot_id'] = Path(self.BOOT_ID).read_text().strip()
+        except OSError:
+            key['boot_id'] = None
+        try:
+            key['fdt'] = sha256(Path(self.FDT).read_bytes()).hexdigest()
+        except OSError:
+            key['fdt'] = None
+        return key
+
+    @staticmethod
+    def exists(path):
+        return Path(path).exists()
+
+    def get(self, name, find, valid=None):
+        """ return the cached value for name if there is one and
+            valid(value) agrees, otherwise call find() and remember
+            what it says """
+        if name in self.entries:
+            v = self.entries[name]
+            if valid is None or valid(v):
+                self.logger.detail("discovery: %s = %s (cached)", name, v)
+                return v
+            self.logger.info("discovery: cached %s = %s is stale", name, v)
+        v = find()
+        self.logger.detail("discovery: %s = %s", name, v)
+        self.entries[name] = v
+        self.dirty = True
+        return v
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix('.tmp')
+            tmp.write_text(json.dumps({ 'key' : self.key,
+                                        'entries' : self.entries }))
+            os.replace(tmp, self.path)
+            self.dirty = False
+        except OSError as e:
+            self.logger.info("could not save discovery cache: %s", repr(e))
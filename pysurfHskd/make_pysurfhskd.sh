@@ -10,6 +10,10 @@ AUX_FILES="pueoTimer.py \
 	   pyHskHandler.py \
 	   HskProcessor.py \
 	   surfExceptions.py \
+	   rackclkWatchdog.py \
+	   discoveryCache.py \
+	   clockMonitor.py \
+	   surfRegisters.py \
            surfStartupHandler.py"
 
 if [ "$#" -ne 1 ] ; then
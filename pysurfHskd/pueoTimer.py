@@ -1,4 +1,4 @@
-from threading import Timer
+from threading import Timer, Event
 import queue
 import os
 import selectors
@@ -8,19 +8,39 @@ class RepeatTimer(Timer):
         while not self.finished.wait(self.interval):
             self.function(*self.args, **self.kwargs)
 
+class TickFifo(queue.Queue):
+    """ Tick FIFO which wakes up its HskTimer when something's put in it. """
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.timer = None
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        if self.timer is not None:
+            self.timer.arm()
+
 class HskTimer(RepeatTimer):
-    """ Periodic timer which writes to a pipe launching a callback every interval. """
+    """ Periodic timer which writes to a pipe launching a callback every interval.
+        If it's given a TickFifo it goes quiet whenever the FIFO is empty,
+        and starts ticking again (an interval later) when something's put in it. """
     def __init__(self,
                  sel,
                  callback=None,
-                 interval=1):
+                 interval=1,
+                 fifo=None):
         """
         sel : selector used for multiple I/O handling
         callback : function to be called when timer goes off (see printTick)
         interval : time interval to run at (default 1)
+        fifo : TickFifo to go idle on (default None, tick forever)
         """
         self.rfd, self.wfd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC )
         self.tickCount = 0
+        self.fifo = fifo
+        self.armed = Event()
+        self.armed.set()
+        if fifo is not None:
+            fifo.timer = self
         if not callback:
             callback = self.printTick
             
@@ -31,6 +51,25 @@ class HskTimer(RepeatTimer):
             self.tickCount = self.tickCount + 1
 
         super(HskTimer, self).__init__(interval, tickFn)
+
+    def arm(self):
+        self.armed.set()
+
+    def cancel(self):
+        super().cancel()
+        self.armed.set()
+
+    def run(self):
+        while not self.finished.is_set():
+            if self.fifo is not None and self.fifo.empty():
+                # clear, then look again: a put() after this wakes us
+                self.armed.clear()
+                if self.fifo.empty():
+                    self.armed.wait()
+                continue
+            if self.finished.wait(self.interval):
+                break
+            self.function(*self.args, **self.kwargs)
     
     def printTick(self, fd, mask):
         """ dummy callback which just prints the current tick. """
@@ -0,0 +1,209 @@
+import os
+import fcntl
+import struct
+import logging
+import selectors
+from pathlib import Path
+
+def _IOC(dir, type, nr, size):
+    return (dir << 30) | (size << 16) | (type << 8) | nr
+
+# Edge-triggered RACKCLK watchdog.
+#
+# RACKOK (GPIO 4) going low means we lost RACKCLK. We want to
+# find out right away, not whenever the selector happens to
+# wake up, so we get the kernel to hand us an event on the edge.
+# There are 3 ways of doing this, tried in order:
+#
+# 1: a gpio-keys input device on RACKOK (needs a devicetree node
+#    whose name has 'rackclk' in it). Key value follows RACKOK.
+# 2: a line event from the gpiochip character device. No devicetree
+#    changes, but the line can't be exported through sysfs.
+# 3: if neither works, fall back to reading the sysfs GPIO, but
+#    only once a tick instead of every time through the main loop.
+#
+# For 1 and 2, once we're armed we read the current level once:
+# any edge after that shows up as an event, so there's no race.
+class RackclkWatchdog:
+    # input event: ll = struct timespec, H=type, H=code, I=value
+    EVENT_FORMAT = 'llHHI'
+    EVENT_LENGTH = struct.calcsize(EVENT_FORMAT)
+    EV_KEY = 1
+    # gpioevent_request: lineoffset, handleflags, eventflags, consumer_label, fd
+    GPIOEVENT_REQUEST_FORMAT = '=III32si'
+    # gpioevent_data: u64 timestamp, u32 id (+ pad)
+    GPIOEVENT_DATA_FORMAT = '=QI4x'
+    GPIOEVENT_DATA_LENGTH = struct.calcsize(GPIOEVENT_DATA_FORMAT)
+    GPIOHANDLE_REQUEST_INPUT = 0x1
+    GPIOEVENT_REQUEST_FALLING_EDGE = 0x2
+    GPIOEVENT_EVENT_FALLING_EDGE = 0x2
+
+    GPIO_GET_LINEEVENT_IOCTL = _IOC(3, 0xB4, 0x04,
+                                    struct.calcsize(GPIOEVENT_REQUEST_FORMAT))
+    GPIOHANDLE_GET_LINE_VALUES_IOCTL = _IOC(3, 0xB4, 0x08, 64)
+    # EVIOCGKEY(len)
+    KEYBITS_LEN = 96
+    EVIOCGKEY = _IOC(2, ord('E'), 0x18, KEYBITS_LEN)
+
+    def __init__(self,
+                 sel,
+                 pin,
+                 tickFifo,
+                 triggerFn,
+                 logName,
+                 inputName='rackclk',
+                 keyCode=None):
+        """
+        sel : selector to register our event source with
+        pin : sysfs GPIO number of RACKOK (GPIO.get_gpio_pin(4))
+        tickFifo : tick FIFO, used only if we have to poll
+        triggerFn : called (in the main thread) when RACKCLK goes away
+        inputName : gpio-keys input device name to look for
+        keyCode : key code of RACKOK in the gpio-keys device (None = any)
+        """
+        self.logger = logging.getLogger(logName)
+        self.sel = sel
+        self.pin = pin
+        self.tick = tickFifo
+        self.triggerFn = triggerFn
+        self.keyCode = keyCode
+        self.armed = False
+        self.triggered = False
+        self.fd = None
+        self.gpio = None
+        self.mode = None
+
+        dev = self._findInput(inputName)
+        if dev is not None:
+            self.fd = os.open(dev, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+            self.mode = 'input'
+            self.logger.info("RACKCLK watchdog using %s", dev)
+        else:
+            try:
+                self.fd = self._requestLineEvent(pin)
+                self.mode = 'gpiochip'
+                self.logger.info("RACKCLK watchdog using gpiochip line event")
+            except Exception as e:
+                self.logger.info("no line events (%s), RACKCLK watchdog will poll",
+                                 repr(e))
+                from gpio import GPIO
+                self.gpio = GPIO(pin, 'in')
+                self.mode = 'poll'
+        if self.fd is not None:
+            sel.register(self.fd, selectors.EVENT_READ, self._handleEvent)
+
+    @staticmethod
+    def _findInput(name):
+        for ev in Path('/sys/class/input').glob('event*'):
+            try:
+                devName = (ev / 'device' / 'name').read_text().strip()
+            except OSError:
+                continue
+            if name in devName.lower():
+                return '/dev/input/' + ev.name
+        return None
+
+    def _requestLineEvent(self, pin):
+        """ find the gpiochip holding this sysfs GPIO number and ask
+            it for falling edge events """
+        for chip in Path('/sys/class/gpio').glob('gpiochip*'):
+            base = int((chip / 'base').read_text())
+            ngpio = int((chip / 'ngpio').read_text())
+            if base <= pin < base + ngpio:
+                break
+        else:
+            raise FileNotFoundError(f'no gpiochip has GPIO {pin}')
+        cdev = [ d.name for d in (chip / 'device').iterdir() if d.name.startswith('gpiochip') ]
+        if not len(cdev):
+            raise FileNotFoundError(f'no character device for {chip.name}')
+        req = struct.pack(self.GPIOEVENT_REQUEST_FORMAT,
+                          pin - base,
+                          self.GPIOHANDLE_REQUEST_INPUT,
+                          self.GPIOEVENT_REQUEST_FALLING_EDGE,
+                          b'rackclk-watchdog',
+                          0)
+        cfd = os.open('/dev/' + cdev[0], os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            r = fcntl.ioctl(cfd, self.GPIO_GET_LINEEVENT_IOCTL, req)
+        finally:
+            os.close(cfd)
+        fd = struct.unpack(self.GPIOEVENT_REQUEST_FORMAT, r)[4]
+        os.set_blocking(fd, False)
+        return fd
+
+    def read(self):
+        """ current level of RACKOK """
+        if self.mode == 'poll':
+            return self.gpio.read()
+        elif self.mode == 'gpiochip':
+            r = fcntl.ioctl(self.fd, self.GPIOHANDLE_GET_LINE_VALUES_IOCTL, bytes(64))
+            return r[0]
+        else:
+            keys = fcntl.ioctl(self.fd, self.EVIOCGKEY, bytes(self.KEYBITS_LEN))
+            if self.keyCode is not None:
+                return (keys[self.keyCode // 8] >> (self.keyCode % 8)) & 0x1
+            return 1 if any(keys) else 0
+
+    def arm(self):
+        """ start watching. Checks the level once, after that it's all events """
+        self.armed = True
+        self.logger.info("RACKCLK watchdog is now active!")
+        if self.mode == 'poll':
+            self._poll()
+        elif self.read() == 0:
+            self._trigger()
+
+    def _trigger(self):
+        if self.triggered:
+            return
+        self.triggered = True
+        self.logger.info("RACKCLK watchdog has triggered!!")
+        self.triggerFn()
+
+    def _poll(self):
+        if self.triggered:
+            return
+        if self.gpio.read() == 0:
+            self._trigger()
+            return
+        self.tick.put(self._poll)
+
+    def _handleEvent(self, fd, mask):
+        lost = False
+        if self.mode == 'gpiochip':
+            while True:
+                try:
+                    d = os.read(self.fd, self.GPIOEVENT_DATA_LENGTH)
+                except BlockingIOError:
+                    break
+                if len(d) != self.GPIOEVENT_DATA_LENGTH:
+                    break
+                ts, id = struct.unpack(self.GPIOEVENT_DATA_FORMAT, d)
+                self.logger.debug("RACKOK edge %d at %d", id, ts)
+                if id == self.GPIOEVENT_EVENT_FALLING_EDGE:
+                    lost = True
+        else:
+            while True:
+                try:
+                    d = os.read(self.fd, self.EVENT_LENGTH)
+                except BlockingIOError:
+                    break
+                if len(d) != self.EVENT_LENGTH:
+                    break
+                _, _, type, code, value = struct.unpack(self.EVENT_FORMAT, d)
+                if type != self.EV_KEY:
+                    continue
+                if self.keyCode is not None and code != self.keyCode:
+                    continue
+                self.logger.debug("RACKOK key event value %d", value)
+                if value == 0:
+                    lost = True
+        # events before we're armed are just drained
+        if lost and self.armed:
+            self._trigger()
+
+    def close(self):
+        if self.fd is not None:
+            self.sel.unregister(self.fd)
+            os.close(self.fd)
+            self.fd = None
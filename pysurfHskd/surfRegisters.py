@@ -0,0 +1,113 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from pueo.common.bf import bf
+
+# Stands in front of a PueoSURF so we can see what register traffic
+# the startup path actually costs.
+#
+# Everything not defined here goes straight through to the PueoSURF,
+# so it can be used anywhere a PueoSURF is. The SURF's own read/write
+# get swapped out for ours, so the properties (turfio_cin_active,
+# live_seen, etc.) which do their own reads are counted too.
+#
+# On top of that:
+# - the ID (0x0) and DateVersion (0x4) can't change under us,
+#   so they only get read once.
+# - update(addr) does a read-modify-write as a group and only
+#   writes if something actually changed.
+class SurfRegisters:
+    STATIC = ( 0x0, 0x4 )
+
+    def __init__(self, surf, logName, lock=None):
+        """
+        surf : the PueoSURF
+        lock : if given, held across update()'s read-modify-write
+        """
+        self._surf = surf
+        self._logger = logging.getLogger(logName)
+        self._lock = lock
+        self._statLock = threading.Lock()
+        self._cache = {}
+        # address : [ reads, writes, seconds ]
+        self._stats = {}
+        self._hits = 0
+        self._read = surf.read
+        self._write = surf.write
+        surf.read = self.read
+        surf.write = self.write
+
+    def __getattr__(self, name):
+        return getattr(self._surf, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._surf, name, value)
+
+    def _account(self, addr, idx, dt):
+        with self._statLock:
+            s = self._stats.setdefault(addr, [0, 0, 0.0])
+            s[idx] += 1
+            s[2] += dt
+
+    def read(self, addr):
+        if addr in self._cache:
+            self._hits += 1
+            return self._cache[addr]
+        start = time.perf_counter()
+        v = self._read(addr)
+        self._account(addr, 0, time.perf_counter() - start)
+        if addr in self.STATIC:
+            self._cache[addr] = v
+        return v
+
+    def write(self, addr, val):
+        start = time.perf_counter()
+        self._write(addr, val)
+        self._account(addr, 1, time.perf_counter() - start)
+
+    @contextmanager
+    def update(self, addr):
+        """ with surf.update(0xC) as r: r[0] = 1
+            reads addr as a bf, and writes it back on the way out
+            if it changed """
+        if self._lock is not None:
+            self._lock.acquire()
+        try:
+            r = bf(self.read(addr))
+            old = int(r)
+            yield r
+            if int(r) != old:
+                self.write(addr, int(r))
+        finally:
+            if self._lock is not None:
+                self._lock.release()
+
+    def invalidate(self):
+        """ forget the static registers (e.g. after reprogramming the FPGA) """
+        self._cache.clear()
+
+    def stats(self):
+        """ (reads, writes, seconds, cache hits) overall, and the
+            per-address { addr : [ reads, writes, seconds ] } """
+        with self._statLock:
+            per = { k : list(v) for k, v in self._stats.items() }
+        reads = sum(v[0] for v in per.values())
+        writes = sum(v[1] for v in per.values())
+        secs = sum(v[2] for v in per.values())
+        return (reads, writes, secs, self._hits), per
+
+    def resetStats(self):
+        with self._statLock:
+            self._stats = {}
+            self._hits = 0
+
+    def logStats(self, what):
+        (reads, writes, secs, hits), per = self.stats()
+        self._logger.info("%s: %d register reads (+%d cached), %d writes, %.1f ms",
+                          what, reads, hits, writes, secs*1000)
+        for addr, (r, w, t) in sorted(per.items(), key=lambda x : -x[1][2]):
+            self._logger.detail("  %4.4x: %d reads %d writes %.1f ms", addr, r, w, t*1000)
@@ -0,0 +1,598 @@
+#!/usr/bin/env python3
+# Hardware stand-in for pysurfHskd.
+#
+# This fakes up everything testStartup.py wires together
+# (PueoSURF, the LMK on its spidev, the Trenz clock, the clkrst/rackok
+# GPIOs, the SOC EEPROM and the ZynqMP bits) so that the startup
+# state machine and the main loop can run on a normal Linux box.
+#
+# The fake modules get shoved into sys.modules BEFORE anything
+# imports the real ones, so the real s6clk/LMK0461x code runs on
+# top of a simulated LMK register file.
+#
+# usage:
+#    surfSim.py [-c config.json] run
+#        run testStartup.py end-to-end. Housekeeping is on a pty,
+#        the path is printed at startup.
+#    surfSim.py [-c config.json] bench [-n N] [--tick T]
+#        run just the startup handler N times and print bring-up times.
+#
+# pueo-python and pueo-utils need to be checked out (we use
+# bf and signalhandler from them), and pyserial/cobs need to be
+# installed.
+
+import os
+import sys
+import json
+import time
+import types
+import random
+import logging
+import argparse
+from enum import Enum
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+
+# All times are in seconds after whatever starts them.
+DEFAULT_CONFIG = {
+    'socid' : 0x01,
+    'location' : None,
+    # RACKCLK shows up this long after start
+    'rackclk_time' : 0.5,
+    # PLL2 locks this long after the LMK is started up
+    'aclk_lock_time' : 0.3,
+    # PL PLLs lock this long after they're pulled out of reset
+    'pll_lock_time' : 0.05,
+    # align_rxclk blocks for this long
+    'align_time' : 2.0,
+    # RXCLK eye positions (ns) for each eye number
+    'rxclk_eyes' : [ 1.25, 3.75, 6.25 ],
+    # cin active shows up this long after being reset
+    'cin_active_time' : 0.1,
+    # locate_eyecenter blocks for this long and returns this
+    'eye_scan_time' : 3.0,
+    'cin_eye' : [ 0.875, 2 ],
+    'turfio_lock_time' : 0.1,
+    # noop_live shows up this long after training is enabled
+    'live_time' : 1.0,
+    # SYNC gets issued this long after we go live
+    'sync_time' : 1.0,
+    # MTS blocks for this long
+    'mts_time' : 0.5,
+    'mts_latency' : [ 64, 64, 65, 64 ],
+    'mts_jitter' : 1,
+    # failure injection
+    'fail' : {
+        'identify' : False,
+        'aclk_lock' : False,
+        'pll_lock' : False,
+        'eye' : False,
+        'mts' : False,
+        # RACKCLK goes away this long after start (null = never)
+        'rackclk_loss' : None
+    }
+}
+
+logger = logging.getLogger('surfSim')
+
+class SimConfig:
+    def __init__(self, fn=None):
+        self.cfg = json.loads(json.dumps(DEFAULT_CONFIG))
+        if fn:
+            with open(fn) as f:
+                user = json.load(f)
+            fail = user.pop('fail', {})
+            self.cfg.update(user)
+            self.cfg['fail'].update(fail)
+
+    def __getitem__(self, k):
+        return self.cfg[k]
+
+    def fail(self, k):
+        return self.cfg['fail'].get(k)
+
+class SimTimer:
+    """ something that becomes true some time after it's started """
+    def __init__(self, delay, never=False):
+        self.delay = delay
+        self.never = never
+        self.start = None
+
+    def arm(self):
+        self.start = time.monotonic()
+
+    def disarm(self):
+        self.start = None
+
+    def __bool__(self):
+        if self.never or self.start is None:
+            return False
+        return time.monotonic() - self.start >= self.delay
+
+#
+# The LMK. This is at the SPI level: 3 byte transactions,
+# top bit of the first byte is read.
+#
+class SimLMK:
+    # type/id/ver
+    ID = { 3 : 0x06, 4 : 0xD1, 5 : 0x63, 6 : 0x01 }
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.locked = SimTimer(cfg['aclk_lock_time'], cfg.fail('aclk_lock'))
+        self.reset()
+
+    def reset(self):
+        self.regs = {}
+        self.readable = False
+        self.locked.disarm()
+
+    def read(self, addr):
+        if not self.readable:
+            return 0
+        if addr in self.ID:
+            return self.ID[addr]
+        if addr == 0xBE:
+            return 0x3 if self.locked else 0x0
+        if addr == 0x124:
+            return 0x4
+        return self.regs.get(addr, 0)
+
+    def write(self, addr, val):
+        self.regs[addr] = val
+        # SDO isn't enabled until this is set (see surfClockInit)
+        self.readable = (self.regs.get(0x141) == 0x4)
+        if addr == 0x11:
+            if val & 0x1:
+                self.locked.arm()
+            else:
+                self.locked.disarm()
+
+    def transfer(self, txd):
+        txd = bytes(txd)
+        rxd = bytearray(len(txd))
+        addr = ((txd[0] & 0x7F) << 8) | txd[1]
+        if txd[0] & 0x80:
+            for i in range(2, len(txd)):
+                rxd[i] = self.read(addr + i - 2)
+        else:
+            for i in range(2, len(txd)):
+                self.write(addr + i - 2, txd[i])
+        return list(rxd)
+
+#
+# The SURF itself.
+#
+class SimRFdc:
+    class ConverterType(int, Enum):
+        ADC = 0
+        DAC = 1
+
+    class MtsConfig:
+        def __init__(self):
+            self.RefTile = 0
+            self.Tiles = 0
+            self.Target_Latency = -1
+            self.SysRef_Enable = 1
+            self.Latency = [ 0, 0, 0, 0 ]
+
+    class Dev:
+        def __init__(self):
+            self.regs = {}
+
+        def write(self, addr, val):
+            self.regs[addr] = val
+
+        def read(self, addr):
+            return self.regs.get(addr, 0)
+
+    def __init__(self, cfg, lmk):
+        self.cfg = cfg
+        self.lmk = lmk
+        self.mtsAdcConfig = self.MtsConfig()
+        self.dev = self.Dev()
+
+    def MultiConverter_Init(self, ctype, refTile=0):
+        self.mtsAdcConfig = self.MtsConfig()
+        self.mtsAdcConfig.RefTile = refTile
+
+    def MultiConverter_Sync(self, ctype):
+        time.sleep(self.cfg['mts_time'])
+        if self.cfg.fail('mts'):
+            return 1
+        # need SYSREF/PLSYSREF driven, they're the top 6 bits
+        # of 0x3C and the bottom 6 of 0x3D
+        if not (self.lmk.read(0x3C) & 0xFC) or not (self.lmk.read(0x3D) & 0x3F):
+            return 1
+        j = self.cfg['mts_jitter']
+        lat = [ l + random.randint(0, j) for l in self.cfg['mts_latency'] ]
+        tgt = self.mtsAdcConfig.Target_Latency
+        if tgt >= 0:
+            if tgt < max(lat):
+                return 1
+            lat = [ tgt ]*4
+        self.mtsAdcConfig.Latency = lat
+        return 0
+
+class SimSURF:
+    class DateVersion:
+        def __init__(self, val):
+            self.major = (val >> 12) & 0xF
+            self.minor = (val >> 8) & 0xF
+            self.rev = val & 0xFF
+
+        def __str__(self):
+            return f'v{self.major}.{self.minor}.{self.rev} (simulated)'
+
+    def __init__(self, cfg, lmk, rackok):
+        self.cfg = cfg
+        self.lmk = lmk
+        self.rackok = rackok
+        self.regs = { 0x0 : int.from_bytes(b'SURF', 'big'),
+                      0x4 : 0x0010,
+                      0xC : 0,
+                      0x800 : 1<<13 }
+        if cfg.fail('identify'):
+            self.regs[0x0] = 0xDEADBEEF
+        self.start = time.monotonic()
+        self.pllLocked = SimTimer(cfg['pll_lock_time'], cfg.fail('pll_lock'))
+        self.cinActive = SimTimer(cfg['cin_active_time'])
+        self.turfioLocked = SimTimer(cfg['turfio_lock_time'])
+        self.live = SimTimer(cfg['live_time'])
+        self.sync = SimTimer(cfg['sync_time'])
+        self.rfdc = SimRFdc(cfg, lmk)
+        self.rfdc_reset = 1
+        self.turfio_train_enable = 0
+        self._lockReq = 0
+        self.delay = None
+        self.offset = None
+
+    def read(self, addr):
+        v = self.regs.get(addr, 0)
+        if addr == 0xC:
+            v &= ~(1<<31)
+            if self.rackok.read():
+                v |= (1<<31)
+        elif addr == 0x800:
+            v &= ~(1<<14)
+            if self.pllLocked and self.lmk.locked and self.regs[0xC] & 0x1:
+                v |= (1<<14)
+        return v
+
+    def write(self, addr, val):
+        if addr == 0x800:
+            if (self.regs[0x800] & (1<<13)) and not (val & (1<<13)):
+                self.pllLocked.arm()
+            elif val & (1<<13):
+                self.pllLocked.disarm()
+        self.regs[addr] = val
+
+    def align_rxclk(self, userSkew=None, eyeNumber=0):
+        time.sleep(self.cfg['align_time'])
+        if userSkew is not None:
+            return userSkew
+        return self.cfg['rxclk_eyes'][eyeNumber]
+
+    def locate_eyecenter(self, seed=None):
+        time.sleep(self.cfg['eye_scan_time'])
+        if self.cfg.fail('eye'):
+            raise IOError("no eye found (simulated)")
+        return tuple(self.cfg['cin_eye'])
+
+    def setDelay(self, delay):
+        self.delay = delay
+
+    def turfioSetOffset(self, offset):
+        self.offset = offset
+
+    @property
+    def turfio_cin_active(self):
+        return 1 if self.cinActive else 0
+
+    @turfio_cin_active.setter
+    def turfio_cin_active(self, value):
+        # writing resets it
+        self.cinActive.arm()
+
+    @property
+    def turfio_lock_req(self):
+        return self._lockReq
+
+    @turfio_lock_req.setter
+    def turfio_lock_req(self, value):
+        if value and not self._lockReq:
+            self.turfioLocked.arm()
+        self._lockReq = value
+
+    @property
+    def turfio_locked_or_running(self):
+        return 1 if self.turfioLocked else 0
+
+    @property
+    def live_seen(self):
+        if self.turfio_train_enable and self.live.start is None:
+            self.live.arm()
+        if self.live and self.sync.start is None:
+            self.sync.arm()
+        return 1 if self.live else 0
+
+    @property
+    def sync_seen(self):
+        return 1 if self.sync else 0
+
+#
+# Everything else.
+#
+class SimGPIO:
+    # pin numbers in testStartup are get_gpio_pin(n)
+    BASE = 500
+
+    def __init__(self, sim, pin, direction):
+        self.sim = sim
+        self.num = pin - self.BASE
+        self.direction = direction
+
+    @staticmethod
+    def get_gpio_pin(n, *args, **kwargs):
+        return SimGPIO.BASE + n
+
+    def read(self):
+        return self.sim.gpioRead(self.num)
+
+    def write(self, value):
+        self.sim.gpioWrite(self.num, value)
+
+class SimEEPROM:
+    def __init__(self, cfg):
+        self.socid = cfg['socid']
+        loc = cfg['location']
+        self.location = None
+        if loc:
+            self.location = { 'crate' : loc[0].encode(),
+                              'slot' : loc[1].encode() }
+
+class SimZynqMP:
+    def __init__(self, tmpdir):
+        self.CURRENT = str(tmpdir / 'current')
+        self.NEXT = str(tmpdir / 'next')
+        self.dna = '400000000000000000000000'
+        self.mac = '00:0a:35:00:00:00'
+
+    def raw_volts(self):
+        return [ 0x5555 ]*6
+
+    def raw_temps(self):
+        return [ 0x9999 ]*2
+
+class SimSi5395:
+    def __init__(self, gw, addr):
+        self.powered = True
+
+    def identify(self):
+        return [ 0x95, 0x53, 0, 0, 0, 0 ]
+
+    def powerdown(self, value):
+        self.powered = not value
+
+class SURFSimulator:
+    SPIDEV = '/dev/spidev-sim1.0'
+    CLKRST = 3
+    RACKOK = 4
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.start = time.monotonic()
+        self.lmk = SimLMK(cfg)
+        self.rackLoss = SimTimer(cfg.fail('rackclk_loss') or 0,
+                                 never=cfg.fail('rackclk_loss') is None)
+        self.rackLoss.arm()
+        self.rackReady = SimTimer(cfg['rackclk_time'])
+        self.rackReady.arm()
+        self.tmpdir = Path(os.environ.get('TMPDIR', '/tmp')) / f'surfSim.{os.getpid()}'
+        self.tmpdir.mkdir(parents=True, exist_ok=True)
+        self.surf = None
+
+    def gpioRead(self, num):
+        if num == self.RACKOK:
+            return 1 if self.rackReady and not self.rackLoss else 0
+        return 0
+
+    def gpioWrite(self, num, value):
+        if num == self.CLKRST and value:
+            logger.info("LMK reset")
+            self.lmk.reset()
+
+    def modules(self):
+        """ build the fake modules """
+        sim = self
+        mods = {}
+
+        m = types.ModuleType('spi')
+        class SPI:
+            MODE_0 = 0
+            def __init__(self, path):
+                if path != sim.SPIDEV:
+                    raise FileNotFoundError(path)
+                self.path = path
+                self.mode = 0
+                self.bits_per_word = 8
+                self.speed = 500000
+            def transfer(self, txd):
+                return sim.lmk.transfer(txd)
+        m.SPI = SPI
+        mods['spi'] = m
+
+        m = types.ModuleType('gpio')
+        class GPIO(SimGPIO):
+            def __init__(self, pin, direction):
+                super().__init__(sim, pin, direction)
+        m.GPIO = GPIO
+        mods['gpio'] = m
+
+        el = types.ModuleType('electronics')
+        gw = types.ModuleType('electronics.gateways')
+        gw.LinuxDevice = lambda bus : bus
+        dev = types.ModuleType('electronics.devices')
+        dev.Si5395 = SimSi5395
+        el.gateways = gw
+        el.devices = dev
+        mods['electronics'] = el
+        mods['electronics.gateways'] = gw
+        mods['electronics.devices'] = dev
+
+        m = types.ModuleType('pysoceeprom')
+        m.PySOCEEPROM = lambda mode='AUTO' : SimEEPROM(sim.cfg)
+        mods['pysoceeprom'] = m
+
+        m = types.ModuleType('pyzynqmp')
+        m.PyZynqMP = lambda : SimZynqMP(sim.tmpdir)
+        mods['pyzynqmp'] = m
+
+        m = types.ModuleType('pueo.surf')
+        def makeSurf(dev, mode):
+            sim.surf = SimSURF(sim.cfg, sim.lmk,
+                               SimGPIO(sim, SimGPIO.get_gpio_pin(sim.RACKOK), 'in'))
+            return sim.surf
+        m.PueoSURF = makeSurf
+        mods['pueo.surf'] = m
+
+        m = types.ModuleType('pueo.common.wbspi')
+        class WBSPI:
+            @staticmethod
+            def find_device(compat):
+                return '/dev/spidev-sim2.0'
+        m.WBSPI = WBSPI
+        mods['pueo.common.wbspi'] = m
+        return mods
+
+    def install(self):
+        """ install the fake hardware, call before importing anything real """
+        for p in [ REPO, REPO / 'pueo-python', REPO / 'pueo-utils' / 'signalhandler',
+                   REPO / 'pysurfHskd' ]:
+            sys.path.insert(0, str(p))
+        sys.modules.update(self.modules())
+        # the sysfs scan obviously won't find anything
+        import s6clk.s6clk
+        s6clk.s6clk.SURF6Clock.find_lmk = staticmethod(lambda : self.SPIDEV)
+        # and the files come out of the repo/our temp dir
+        from surfStartupHandler import StartupHandler
+        StartupHandler.LMK_FILE = str(REPO / 'base_squashfs' / 'share' / 'SURF6_LMK.txt')
+        StartupHandler.PARAMS_FILE = str(self.tmpdir / 'startup_params.pkl')
+        StartupHandler.RESUME_FILE = str(self.tmpdir / 'startup.json')
+        from discoveryCache import DiscoveryCache
+        DiscoveryCache.CACHE_FILE = str(self.tmpdir / 'discovery.json')
+
+    def installHsk(self):
+        """ put housekeeping on a pty pair. The daemon gets one,
+            you get the other (ptyName) and we shovel bytes between
+            them like a null modem """
+        import pyHskHandler
+        import threading
+        import selectors
+        import tty
+        from serial import Serial
+        m1, s1 = os.openpty()
+        m2, s2 = os.openpty()
+        daemonName = os.ttyname(s1)
+        self.ptyName = os.ttyname(s2)
+        # raw mode on both ends, otherwise the line discipline eats stuff
+        for fd in (s1, s2):
+            tty.setraw(fd)
+        self._ptys = (s1, s2)
+        def nullModem():
+            sel = selectors.DefaultSelector()
+            sel.register(m1, selectors.EVENT_READ, m2)
+            sel.register(m2, selectors.EVENT_READ, m1)
+            while True:
+                for key, mask in sel.select():
+                    os.write(key.data, os.read(key.fileobj, 4096))
+        threading.Thread(target=nullModem, daemon=True).start()
+        def simSerial(port, baud):
+            return Serial(daemonName, baud)
+        pyHskHandler.Serial = simSerial
+
+def addLevel(name, num):
+    def logForLevel(self, message, *args, **kwargs):
+        if self.isEnabledFor(num):
+            self._log(num, message, args, **kwargs)
+    logging.addLevelName(num, name)
+    setattr(logging.getLoggerClass(), name.lower(), logForLevel)
+
+def bench(sim, runs, tick):
+    """ run just the startup handler and time it """
+    import selectors
+    from pueoTimer import HskTimer, TickFifo
+    from surfStartupHandler import StartupHandler
+    from surfExceptions import StartupException
+    from s6clk import SURF6Clock
+    from gpio import GPIO
+    from pueo.surf import PueoSURF
+
+    Done = [ StartupHandler.StartupState.STARTUP_FINISH,
+             StartupHandler.StartupState.STARTUP_FAILURE ]
+    times = []
+    for i in range(runs):
+        sel = selectors.DefaultSelector()
+        tickFifo = TickFifo()
+        sim.rackReady.arm()
+        sim.rackLoss.arm()
+        def runTickFifo(fd, mask):
+            os.read(fd, 1)
+            toDoList = []
+            while not tickFifo.empty():
+                toDoList.append(tickFifo.get())
+            for task in toDoList:
+                task()
+        timer = HskTimer(sel, callback=runTickFifo, interval=tick, fifo=tickFifo)
+        surf = PueoSURF(None, 'SPI')
+        clk = SURF6Clock()
+        clkrst = GPIO(GPIO.get_gpio_pin(sim.CLKRST), 'out')
+        startup = StartupHandler('surfSim', surf, clk, clkrst,
+                                 StartupHandler.StartupState.STARTUP_FINISH,
+                                 tickFifo)
+        def runHandler(fd, mask):
+            os.read(fd, 1)
+            startup.run()
+        sel.register(startup.rfd, selectors.EVENT_READ, runHandler)
+        timer.start()
+        start = time.monotonic()
+        try:
+            startup.run()
+            while startup.state not in Done:
+                for key, mask in sel.select():
+                    key.data(key.fileobj, mask)
+        except StartupException as e:
+            logger.error("startup exception: %s", repr(e))
+        elapsed = time.monotonic() - start
+        timer.cancel()
+        startup.stop()
+        sel.close()
+        logger.info("run %d: state %s after %.3f s", i, startup.state.name, elapsed)
+        times.append(elapsed)
+    print("bring-up: min %.3f mean %.3f max %.3f s over %d runs" %
+          (min(times), sum(times)/len(times), max(times), len(times)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', help='JSON config, overrides DEFAULT_CONFIG')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    sub.add_parser('run')
+    b = sub.add_parser('bench')
+    b.add_argument('-n', '--runs', type=int, default=5)
+    b.add_argument('--tick', type=float, default=1.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sim = SURFSimulator(SimConfig(args.config))
+    sim.install()
+    if args.cmd == 'bench':
+        # testStartup normally adds these
+        addLevel('TRACE', logging.DEBUG-5)
+        addLevel('DETAIL', logging.INFO-5)
+        bench(sim, args.runs, args.tick)
+    else:
+        sim.installHsk()
+        logger.info("housekeeping pty is %s", sim.ptyName)
+        import runpy
+        runpy.run_path(str(REPO / 'pysurfHskd' / 'testStartup.py'), run_name='__main__')
@@ -1,9 +1,15 @@
 from enum import Enum
+import json
 import logging
 import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pueo.common.bf import bf
 from surfExceptions import StartupException
-from dataclasses import dataclass
+from surfRegisters import SurfRegisters
+from dataclasses import dataclass, asdict
 
 # the startup handler actually runs in the main
 # thread. it either writes a byte to a pipe to
@@ -13,8 +19,46 @@ from dataclasses import dataclass
 # expires.
 # the tick FIFO takes closures now
 # god this thing is a headache
+#
+# Stuff that doesn't depend on the hardware (parsing the LMK
+# file, loading saved parameters, setting up the MTS config)
+# gets farmed off to a worker thread as soon as it's allowed
+# to start, so it overlaps with the lock waits. A state that
+# needs one of those results just waits for it: the worker
+# kicks us through the pipe when it finishes. (The MTS setup
+# does go through the RFdc, so it takes hwLock like the rest.)
+#
+# The long blocking hardware operations (programming the LMK,
+# RXCLK alignment, the eye scan, MTS) also run on the worker,
+# holding hwLock, so housekeeping and the watchdog keep going.
+# The state just sits there until the worker kicks it.
 class StartupHandler:
     LMK_FILE = "/usr/local/share/SURF6_LMK.txt"
+    # optional saved alignment/MTS parameters, a pickled dict like
+    # { 'align' : { 'rx_delay' : ..., 'cin_delay' : ..., 'cin_bit' : ... },
+    #   'mts' : { 'target_latency' : ..., 'sysref_enable' : ... },
+    #   'eyeno' : ... }
+    # anything set via housekeeping before it's used wins.
+    # Nothing installs it: if it's not there we just use the defaults.
+    # MTS calibration writes it (and pueo-squashfs keeps it as a local
+    # change), or put one there by hand.
+    PARAMS_FILE = "/usr/local/share/startup_params.pkl"
+    # how often we poll the lock waits, rather than waiting a whole tick
+    LOCK_POLL = 0.05
+    # where we keep track of how far we got, in tmpfs. If the daemon
+    # restarts (hot restart, crash) and the hardware says it's still
+    # up, we pick up from here instead of doing the whole bring-up.
+    # It's JSON, and only believed if it's ours and nobody else can
+    # write it.
+    RESUME_FILE = "/tmp/pueo/startup.json"
+    # LMK status (0xBE) bits that have to be set, and the mask, for
+    # it to count as properly up: PLL1 and PLL2 locked, and not in
+    # holdover (HOLDOVER_LOS/LOL, LOS all clear). See ClockMonitor.
+    LMK_UP = ( 0x03, 0x2F )
+    # if the LMK already holds our image (other than the unused outputs
+    # we turn off, see LMK0461x.PATCHABLE) and is up, don't reset and
+    # reprogram it: just patch the outputs back and go wait for lock.
+    WARM_CLOCK = True
 
     @dataclass
     class MultiTileSync:
@@ -23,6 +67,18 @@ class StartupHandler:
         latency : None
         target_latency : int = -1
         sysref_enable : int = 0
+        # calibration: if cal_runs is nonzero, the next RUN_MTS
+        # runs sync that many times with SYSREF left on, picks
+        # target_latency = worst latency + cal_margin, saves it
+        # and then syncs for real with it.
+        cal_runs : int = 0
+        cal_margin : int = 2
+        # the latencies from each run that worked, as one
+        # (tile 0, 1, 2, 3) tuple per run, and # of failed syncs.
+        # Housekeeping reads this while the worker appends to it:
+        # whole runs only, so it never sees half of one.
+        cal_latency : list = None
+        cal_failures : int = 0
 
     @dataclass
     class Align:
@@ -56,20 +112,45 @@ class StartupHandler:
         def __index__(self) -> int:
             return self.value
 
+    # what the worker is doing, reported through eStartState
+    class LongOp(int, Enum):
+        NONE = 0
+        PROGRAM_LMK = 1
+        ALIGN_RXCLK = 2
+        LOCATE_EYE = 3
+        MTS_SYNC = 4
+        MTS_CALIBRATE = 5
+
+        def __index__(self) -> int:
+            return self.value
+
     def __init__(self,
                  logName,
                  surfDev,
                  surfClock,
                  surfClockReset,
                  autoHaltState,
-                 tickFifo):
+                 tickFifo,
+                 resumeFile=None,
+                 warmClock=WARM_CLOCK):
+        """ resumeFile : None is RESUME_FILE (looked up now, so it can
+                         be moved), '' turns resuming off """
         self.state = self.StartupState.STARTUP_BEGIN
+        self.resumeFile = self.RESUME_FILE if resumeFile is None else resumeFile
+        self.warmClock = warmClock
         self.fail_msg = None
         self.logger = logging.getLogger(logName)
-        self.surf = surfDev
+        # anyone touching the hardware from another thread grabs this
+        self.hwLock = threading.RLock()
+        # all our register traffic is counted, see logStats at the end
+        self.surf = SurfRegisters(surfDev, logName, self.hwLock)
         self.clock = surfClock
         self.clockReset = surfClockReset
         self.endState = autoHaltState        
+        # set when run() stops at endState with nothing queued.
+        # Just being in endState isn't enough: we've already queued
+        # the run that finds that out.
+        self._parked = False
         self.tick = tickFifo
         self.rfd, self.wfd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
 
@@ -80,10 +161,203 @@ class StartupHandler:
                                        latency=None )
         self.align = self.Align()
         self.eyeno = None
+        self.startTime = None
+        self.dateVersion = None
                             
         if self.endState is None:
             self.endState = self.StartupState.STARTUP_BEGIN
 
+        # the prep dependency graph. prepGraph is
+        # name : (state that has to be reached before launching, function)
+        # and prepNeeds is state : prep results it needs before it can run.
+        self.prepGraph = {
+            'lmk' : (self.StartupState.STARTUP_BEGIN, self._prepLmk),
+            'params' : (self.StartupState.STARTUP_BEGIN, self._prepParams),
+            # MTS init only touches the driver config, but the RFdc
+            # needs to be out of reset first.
+            'mts' : (self.StartupState.ALIGN_RXCLK, self._prepMts)
+        }
+        self.prepNeeds = {
+            self.StartupState.RESET_CLOCK : [ 'lmk' ],
+            self.StartupState.PROGRAM_ACLK : [ 'lmk' ],
+            self.StartupState.ALIGN_RXCLK : [ 'params' ],
+            self.StartupState.RUN_MTS : [ 'mts' ]
+        }
+        self.prep = {}
+        self.job = None
+        self.substep = self.LongOp.NONE
+        self._prepLock = threading.Lock()
+        self._prepWaiting = False
+        self.executor = ThreadPoolExecutor(max_workers=2,
+                                           thread_name_prefix='startup')
+
+    def stop(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _prepLmk(self):
+        return self.clock.surfClock.compile(self.LMK_FILE)
+
+    def _prepParams(self):
+        if not os.path.exists(self.PARAMS_FILE):
+            return None
+        with open(self.PARAMS_FILE, 'rb') as f:
+            return pickle.load(f)
+
+    def _prepMts(self):
+        # launched while the RXCLK alignment has the hardware
+        with self.hwLock:
+            # must be reftile = 1 due to clock distribution
+            self.surf.rfdc.MultiConverter_Init(self.surf.rfdc.ConverterType.ADC,
+                                               refTile=1)
+        return True
+
+    def _applyParams(self):
+        """ fill in saved parameters that haven't been set otherwise """
+        try:
+            p = self._prepResult('params')
+        except Exception as e:
+            self.logger.error("could not load %s: %s", self.PARAMS_FILE, repr(e))
+            return
+        if not p:
+            return
+        self.logger.info("applying saved startup parameters")
+        align = p.get('align', {})
+        for k in ('rx_delay', 'cin_delay', 'cin_bit'):
+            if getattr(self.align, k) is None and align.get(k) is not None:
+                setattr(self.align, k, align[k])
+        mts = p.get('mts', {})
+        if self.mts.target_latency == -1 and mts.get('target_latency') is not None:
+            self.mts.target_latency = mts['target_latency']
+        if self.mts.sysref_enable == 0 and mts.get('sysref_enable') is not None:
+            self.mts.sysref_enable = mts['sysref_enable']
+        if self.eyeno is None and p.get('eyeno') is not None:
+            self.eyeno = p['eyeno']
+
+    def _saveParams(self, **kwargs):
+        """ merge stuff into the saved parameters file, e.g. mts={...} """
+        p = {}
+        try:
+            if os.path.exists(self.PARAMS_FILE):
+                with open(self.PARAMS_FILE, 'rb') as f:
+                    p = pickle.load(f)
+            for k, v in kwargs.items():
+                if isinstance(v, dict):
+                    p.setdefault(k, {}).update(v)
+                else:
+                    p[k] = v
+            tmp = self.PARAMS_FILE + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump(p, f)
+            os.replace(tmp, self.PARAMS_FILE)
+        except Exception as e:
+            self.logger.error("could not save %s: %s", self.PARAMS_FILE, repr(e))
+
+    def _syncMts(self, target, sysref):
+        """ one MultiConverter_Sync, returns (result, latencies) """
+        self.surf.rfdc.mtsAdcConfig.Tiles = 0b1111
+        self.surf.rfdc.mtsAdcConfig.Target_Latency = target
+        self.surf.rfdc.mtsAdcConfig.SysRef_Enable = sysref
+        r = self.surf.rfdc.MultiConverter_Sync(self.surf.rfdc.ConverterType.ADC)
+        if r != 0:
+            return r, None
+        return r, [ self.surf.rfdc.mtsAdcConfig.Latency[i] for i in range(4) ]
+
+    def _mtsJob(self):
+        if self.mts.cal_runs:
+            self._calibrateMts()
+        return self._syncMts(self.mts.target_latency,
+                             self.mts.sysref_enable)
+
+    def _calibrateMts(self):
+        """ run sync a bunch with no target and pick one """
+        runs = self.mts.cal_runs
+        self.mts.cal_runs = 0
+        self.mts.cal_latency = []
+        self.mts.cal_failures = 0
+        self.logger.info("MTS calibration: %d runs, margin %d",
+                         runs, self.mts.cal_margin)
+        for i in range(runs):
+            # leave SYSREF on, we're going again
+            r, latency = self._syncMts(-1, 1)
+            if r != 0:
+                self.logger.detail("MTS calibration run %d failed: %d", i, r)
+                self.mts.cal_failures += 1
+                continue
+            self.mts.cal_latency.append(tuple(latency))
+        if not len(self.mts.cal_latency):
+            self.logger.error("MTS calibration: every run failed, keeping target %d",
+                              self.mts.target_latency)
+            return
+        for t in range(4):
+            l = [ run[t] for run in self.mts.cal_latency ]
+            self.logger.info("MTS calibration: tile %d latency min %d max %d mean %.2f",
+                             t, min(l), max(l), sum(l)/len(l))
+        worst = max(max(run) for run in self.mts.cal_latency)
+        self.mts.target_latency = worst + self.mts.cal_margin
+        self.logger.info("MTS calibration: target latency is now %d (%d failures)",
+                         self.mts.target_latency, self.mts.cal_failures)
+        self._saveParams(mts={ 'target_latency' : self.mts.target_latency })
+
+    def _locked(self, fn):
+        with self.hwLock:
+            return fn()
+
+    def _longOp(self, substep, fn):
+        """ run fn on the worker. Returns (False, None) while it's
+            running - you get called again when it finishes - and
+            (True, result) once it's done. Exceptions from fn are
+            thrown here. """
+        if self.job is None:
+            self.logger.trace("launching %s", substep.name)
+            self.substep = substep
+            self.job = self.executor.submit(self._locked, fn)
+            self.job.add_done_callback(lambda f : self._runImmediate())
+            return False, None
+        if not self.job.done():
+            return False, None
+        job = self.job
+        self.job = None
+        self.substep = self.LongOp.NONE
+        return True, job.result()
+
+    def _prepDone(self, fut):
+        # called from the worker: only kick the state machine
+        # if it's actually sitting there waiting on us, otherwise
+        # we'd end up with two runs queued.
+        with self._prepLock:
+            if self._prepWaiting:
+                self._prepWaiting = False
+                self._runImmediate()
+
+    def _launchPrep(self):
+        for name, (after, fn) in self.prepGraph.items():
+            if name not in self.prep and self.state >= after:
+                self.logger.trace("launching prep %s", name)
+                fut = self.executor.submit(fn)
+                self.prep[name] = fut
+                fut.add_done_callback(self._prepDone)
+
+    def _prepReady(self):
+        """ True if everything this state needs is done """
+        for name in self.prepNeeds.get(self.state, []):
+            with self._prepLock:
+                if not self.prep[name].done():
+                    self._prepWaiting = True
+                    return False
+        return True
+
+    def _prepResult(self, name):
+        """ exceptions thrown in the prep get thrown here """
+        return self.prep[name].result()
+
+    def setEndState(self, state):
+        """ change where we stop, and get going again if we were parked
+            there (otherwise we're already scheduled, leave it alone) """
+        self.endState = state
+        if self._parked:
+            self._parked = False
+            self._runImmediate()
+
     def _runNextTick(self):
         if not self.tick.full():
             self.tick.put(self.run)
@@ -95,30 +369,172 @@ class StartupHandler:
         nb = os.write(self.wfd, toWrite)
         if nb != len(toWrite):
             raise RuntimeError("could not write to pipe!")
+
+    def lmkSnapshot(self):
+        """ (image, snapshot) of the LMK for diagnostics, or None if
+            a long operation has the hardware right now """
+        lmk = self.clock.surfClock
+        image = lmk.compile(self.LMK_FILE)
+        if not self.hwLock.acquire(blocking=False):
+            return None
+        try:
+            return image, lmk.snapshot(image)
+        finally:
+            self.hwLock.release()
+
+    def _checkClock(self, image):
+        """ True if the LMK can be used as-is (after patching outputs) """
+        lmk = self.clock.surfClock
+        try:
+            st = lmk.status()
+            if st & self.LMK_UP[1] != self.LMK_UP[0]:
+                self.logger.detail("LMK not locked (%2.2x), reprogramming", st)
+                return False
+            diff = lmk.verify(image)
+        except Exception as e:
+            self.logger.info("could not verify LMK: %s", repr(e))
+            return False
+        if not len(diff):
+            self.logger.info("LMK is already programmed and locked")
+            return True
+        for r, (want, have) in diff.items():
+            self.logger.detail("LMK register %3.3x: %2.2x should be %2.2x", r, have, want)
+        if not set(diff) <= lmk.PATCHABLE:
+            self.logger.info("LMK differs in %d registers, reprogramming", len(diff))
+            return False
+        lmk.patch(diff)
+        self.logger.info("LMK is locked, patched %d output registers", len(diff))
+        return True
+
+    def _runSoon(self, delay=LOCK_POLL):
+        t = threading.Timer(delay, self._runImmediate)
+        t.daemon = True
+        t.start()
+
+    def _fail(self, msg):
+        self.state = self.StartupState.STARTUP_FAILURE
+        self.fail_msg = msg
+        self._runNextTick()
         
+    def _saveResume(self):
+        if not self.resumeFile:
+            return
+        try:
+            d = { 'state' : int(self.state),
+                  'dateversion' : self.dateVersion,
+                  'align' : asdict(self.align),
+                  'mts' : { 'target_latency' : self.mts.target_latency,
+                            'sysref_enable' : self.mts.sysref_enable,
+                            'latency' : self.mts.latency },
+                  'eyeno' : self.eyeno }
+            os.makedirs(os.path.dirname(self.resumeFile), exist_ok=True)
+            tmp = self.resumeFile + '.tmp'
+            # never follow whatever someone else left there
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600)
+            with open(fd, 'w') as f:
+                # what comes back from pueo-python can be NumPy scalars
+                json.dump(d, f, default=lambda o : o.item())
+            os.replace(tmp, self.resumeFile)
+        except Exception as e:
+            self.logger.error("could not save resume state: %s", repr(e))
+
+    def _checkResume(self):
+        """ figure out if we can skip ahead: returns the state to
+            resume at, or None to do a full bring-up """
+        if not self.resumeFile or not os.path.exists(self.resumeFile):
+            return None
+        try:
+            with open(self.resumeFile, 'r') as f:
+                st = os.fstat(f.fileno())
+                if st.st_uid != os.geteuid() or st.st_mode & 0o022:
+                    self.logger.error("resume state isn't ours, ignoring it")
+                    return None
+                d = json.load(f)
+        except Exception as e:
+            self.logger.error("could not load resume state: %s", repr(e))
+            return None
+        saved = self.StartupState(d['state'])
+        self.logger.info("previous run got to %s", saved.name)
+        if saved == self.StartupState.STARTUP_FAILURE or saved < self.StartupState.ALIGN_RXCLK:
+            return None
+        if d['dateversion'] != self.dateVersion:
+            self.logger.info("firmware changed, not resuming")
+            return None
+        # clocks: ACLK enabled, PL PLLs locked, LMK all the way up.
+        # The clock monitor's recovery is a restart, so anything it
+        # thinks is bad has to mean a full bring-up here.
+        if not bf(self.surf.read(0xC))[0] or not bf(self.surf.read(0x800))[14]:
+            self.logger.info("ACLK/PLLs not running, not resuming")
+            return None
+        st = self.clock.surfClock.status()
+        if st & self.LMK_UP[1] != self.LMK_UP[0]:
+            self.logger.info("LMK not locked (status %2.2x), not resuming", st)
+            return None
+        # restore what we found last time
+        for k, v in d['align'].items():
+            setattr(self.align, k, v)
+        for k, v in d['mts'].items():
+            setattr(self.mts, k, v)
+        self.eyeno = d['eyeno']
+        # links: if they're up we can go right back to where we were,
+        # otherwise redo alignment with what we found last time
+        if saved >= self.StartupState.WAIT_SYNC:
+            if self.surf.turfio_locked_or_running and self.surf.live_seen:
+                return saved
+            # past MTS the SYSREF dividers might be shut down, and
+            # nothing but a clock reset brings them back
+            if saved > self.StartupState.RUN_MTS:
+                self.logger.info("links not up after MTS, not resuming")
+                return None
+            self.logger.info("links not up, redoing alignment")
+        return self.StartupState.ALIGN_RXCLK
+
     def run(self):
+        prev = self.state
+        try:
+            self._run()
+        finally:
+            if self.state != prev:
+                self._saveResume()
+
+    def _run(self):
         # whatever dumb debugging
         self.logger.trace("startup state: %s", self.state)
         # endState is used to allow us to single-step
         # so if you set startup to 0 in the EEPROM, you can
         # set the end state via HSK and single-step through
         # startup.
+        # We don't requeue ourselves here: the tick goes idle
+        # until setEndState kicks us.
         if self.state == self.endState or self.state == self.StartupState.STARTUP_FAILURE:
-            self._runNextTick()
+            self._parked = True
+            return
+        self._launchPrep()
+        if not self._prepReady():
+            # prep's done callback will kick us
+            self.logger.trace("state %s waiting on prep", self.state)
             return
         elif self.state == self.StartupState.STARTUP_BEGIN:
+            self.startTime = time.monotonic()
             id = self.surf.read(0).to_bytes(4,'big')
             if id != b'SURF':
                 self.logger.error("failed identifying SURF: %s", id.hex())
                 raise StartupException("firmware identify error")
             else:
-                dv = self.surf.DateVersion(self.surf.read(0x4))
+                self.dateVersion = self.surf.read(0x4)
+                dv = self.surf.DateVersion(self.dateVersion)
                 self.logger.info("this is SURF %s", str(dv))
                 # cool you're a surf turn on an LED or some'n
-                r = bf(self.surf.read(0xC))
-                r[1] = 1
-                self.surf.write(0xC, int(r))
-                self.state = self.StartupState.WAIT_CLOCK
+                with self.surf.update(0xC) as r:
+                    r[1] = 1
+                resume = self._checkResume()
+                if resume is not None:
+                    self.logger.info("hardware is still up, resuming at %s", resume.name)
+                    self.state = resume
+                else:
+                    self.state = self.StartupState.WAIT_CLOCK
                 self._runImmediate()
                 return
         elif self.state == self.StartupState.WAIT_CLOCK:
@@ -132,13 +548,19 @@ class StartupHandler:
                 self._runImmediate()
                 return
         elif self.state == self.StartupState.RESET_CLOCK:
-            if not os.path.exists(self.LMK_FILE):
-                self.logger.error("failed locating %s", self.LMK_FILE)
-                self.state = self.StartupState.STARTUP_FAILURE
-                self.fail_msg = f'Could not find LMK file {self.LMK_FILE}'
-                self._runNextTick()
+            try:
+                self._prepResult('lmk')
+            except Exception as e:
+                self.logger.error("failed loading %s: %s", self.LMK_FILE, repr(e))
+                self._fail(f'Could not load LMK file {self.LMK_FILE}')
+                return
+            if self.warmClock and self._checkClock(self._prepResult('lmk')):
+                self.state = self.StartupState.WAIT_ACLK_LOCK
+                self._runImmediate()
+                return
             self.clockReset.write(1)
             self.clockReset.write(0)
+            self.clock.surfClock.invalidate()
             self.state = self.StartupState.RESET_CLOCK_DELAY
             self._runNextTick()
             return
@@ -148,10 +570,15 @@ class StartupHandler:
             self._runNextTick()
             return
         elif self.state == self.StartupState.PROGRAM_ACLK:
-            # debugging
-            st = self.clock.surfClock.status()
-            self.logger.detail("Clock status before programming: %2.2x", st)
-            self.clock.surfClock.configure(self.LMK_FILE)
+            if self.job is None:
+                # debugging
+                st = self.clock.surfClock.status()
+                self.logger.detail("Clock status before programming: %2.2x", st)
+            image = self._prepResult('lmk')
+            done, _ = self._longOp(self.LongOp.PROGRAM_LMK,
+                                   lambda : self.clock.surfClock.configure(image=image))
+            if not done:
+                return
             self.state = self.StartupState.WAIT_ACLK_LOCK
             self._runImmediate()
             return
@@ -159,19 +586,21 @@ class StartupHandler:
             st = self.clock.surfClock.status()
             self.logger.detail("Clock status now: %2.2x", st)
             if st & 0x2 == 0:
-                self._runNextTick()
+                self._runSoon()
                 return
             else:
                 self.logger.info("ACLK is ready.")
-                # shut down unused clocks
-                self.clock.surfClock.driveClock(self.clock.lmk_map['MGT'],
-                                               self.clock.surfClock.DriveMode.POWERDOWN)
-                self.clock.surfClock.driveClock(self.clock.lmk_map['EXT'],
-                                               self.clock.surfClock.DriveMode.POWERDOWN)
-                self.clock.surfClock.clockDividerEnable(self.clock.lmk_map['MGT'], False)
-                self.clock.surfClock.clockDividerEnable(self.clock.lmk_map['EXT'], False)
-                # feedback's output can be turned off
-                self.clock.surfClock.driveClock(5, self.clock.surfClock.DriveMode.POWERDOWN)
+                # shut down unused clocks, all in one go
+                lmk = self.clock.surfClock
+                with lmk.transaction():
+                    lmk.driveClock(self.clock.lmk_map['MGT'],
+                                   lmk.DriveMode.POWERDOWN)
+                    lmk.driveClock(self.clock.lmk_map['EXT'],
+                                   lmk.DriveMode.POWERDOWN)
+                    lmk.clockDividerEnable(self.clock.lmk_map['MGT'], False)
+                    lmk.clockDividerEnable(self.clock.lmk_map['EXT'], False)
+                    # feedback's output can be turned off
+                    lmk.driveClock(5, lmk.DriveMode.POWERDOWN)
                 # you do NOT need to issue SYNC. I honestly don't know why, but you don't:
                 # it's probably because they're all part of the SYNC group. This is also
                 # good because if we DID issue sync we'd have to wait for it to lock
@@ -181,20 +610,18 @@ class StartupHandler:
                 return
         elif self.state == self.StartupState.ENABLE_ACLK:
             # write 1 to enable CE on ACLK BUFGCE
-            rv = bf(self.surf.read(0xC))
-            rv[0] = 1
-            self.surf.write(0xC, int(rv))
+            with self.surf.update(0xC) as rv:
+                rv[0] = 1
             # write 0 to pull PLLs out of reset
-            rv = bf(self.surf.read(0x800))
-            rv[13] = 0
-            self.surf.write(0x800, int(rv))
+            with self.surf.update(0x800) as rv:
+                rv[13] = 0
             self.state = self.StartupState.WAIT_PLL_LOCK
             self._runImmediate()
             return
         elif self.state == self.StartupState.WAIT_PLL_LOCK:
             rv = bf(self.surf.read(0x800))
             if not rv[14]:
-                self._runNextTick()
+                self._runSoon()
                 return
             # pull RFdc out of reset now that ACLK is OK
             self.surf.rfdc_reset = 0
@@ -202,10 +629,18 @@ class StartupHandler:
             self._runImmediate()
             return
         elif self.state == self.StartupState.ALIGN_RXCLK:
-            if self.align.rx_delay:
-                self.logger.info(f'Applying RXCLK alignment {self.align.rx_delay}')
+            if self.job is None:
+                self._applyParams()
+                if self.align.rx_delay:
+                    self.logger.info(f'Applying RXCLK alignment {self.align.rx_delay}')
             targetEye = self.eyeno if self.eyeno else 0
-            self.align.rx_delay = self.surf.align_rxclk(userSkew=self.align.rx_delay, eyeNumber=targetEye)
+            skew = self.align.rx_delay
+            done, rx_delay = self._longOp(self.LongOp.ALIGN_RXCLK,
+                                          lambda : self.surf.align_rxclk(userSkew=skew,
+                                                                         eyeNumber=targetEye))
+            if not done:
+                return
+            self.align.rx_delay = rx_delay
             self.logger.info(f'RXCLK aligned at offset {self.align.rx_delay}')
             # reset the active indicator
             self.surf.turfio_cin_active = 0
@@ -223,8 +658,13 @@ class StartupHandler:
         elif self.state == self.StartupState.LOCATE_EYE:
             if self.align.cin_delay is None:
                 # Seed locating the eye center with the RXCLK shift.
+                seed = self.align.rx_delay*1000.0
                 try:
-                    delay, bit = self.surf.locate_eyecenter(seed=self.align.rx_delay*1000.0)
+                    done, r = self._longOp(self.LongOp.LOCATE_EYE,
+                                           lambda : self.surf.locate_eyecenter(seed=seed))
+                    if not done:
+                        return
+                    delay, bit = r
                 except Exception as e:
                     self.logger.error(f'Locating eye center failed! {repr(e)}')
                     self.state = self.StartupState.STARTUP_FAILURE
@@ -284,36 +724,41 @@ class StartupHandler:
             self._runNextTick()
             return
         elif self.state == self.StartupState.MTS_STARTUP:
-            self.clock.surfClock.driveClock(self.clock.lmk_map['SYSREF'],
-                                            self.clock.surfClock.DriveMode.HSDS_8)
-            self.clock.surfClock.driveClock(self.clock.lmk_map['PLSYSREF'],
-                                            self.clock.surfClock.DriveMode.HSDS_8)
+            # the clock monitor's reading the LMK by now
+            with self.hwLock:
+                self.clock.surfClock.driveClock(self.clock.lmk_map['SYSREF'],
+                                                self.clock.surfClock.DriveMode.HSDS_8)
+                self.clock.surfClock.driveClock(self.clock.lmk_map['PLSYSREF'],
+                                                self.clock.surfClock.DriveMode.HSDS_8)
             self.state = self.StartupState.RUN_MTS
             # give it a sec
             self._runNextTick()
             return
         elif self.state == self.StartupState.RUN_MTS:
-            # must be reftile = 1 due to clock distribution
-            self.surf.rfdc.MultiConverter_Init(self.surf.rfdc.ConverterType.ADC,
-                                               refTile=1)
-            self.surf.rfdc.mtsAdcConfig.Tiles = 0b1111
-            self.surf.rfdc.mtsAdcConfig.Target_Latency = self.mts.target_latency
-            self.surf.rfdc.mtsAdcConfig.SysRef_Enable = self.mts.sysref_enable
-            r = self.surf.rfdc.MultiConverter_Sync(self.surf.rfdc.ConverterType.ADC)
+            # the first time through the init was prepped already,
+            # reruns need to redo it.
+            if self.job is None:
+                if 'mts' in self.prepGraph:
+                    self._prepResult('mts')
+                    del self.prepGraph['mts']
+                    del self.prepNeeds[self.StartupState.RUN_MTS]
+                else:
+                    self._prepMts()
+            op = self.LongOp.MTS_CALIBRATE if self.mts.cal_runs else self.LongOp.MTS_SYNC
+            done, res = self._longOp(op, self._mtsJob)
+            if not done:
+                return
+            r, latency = res
             if r == 0:
                 self.logger.info("MTS succeeded:")
-                self.mts.latency = [ 0, 0, 0, 0 ]
-                self.mts.latency[0] = self.surf.rfdc.mtsAdcConfig.Latency[0]
-                self.mts.latency[1] = self.surf.rfdc.mtsAdcConfig.Latency[1]
-                self.mts.latency[2] = self.surf.rfdc.mtsAdcConfig.Latency[2]
-                self.mts.latency[3] = self.surf.rfdc.mtsAdcConfig.Latency[3]
+                self.mts.latency = latency
                 for i in range(4):
                     self.logger.info(f'Tile {i} latency: {self.mts.latency[i]}')
                 self.state = self.StartupState.MTS_SHUTDOWN
             else:
                 self.logger.info("MTS failed?!?")
                 self.state = self.StartupState.STARTUP_FAILURE
-                self.fail_msg = 'MTS failure {r}'
+                self.fail_msg = f'MTS failure {r}'
             self._runImmediate()
             return
         elif self.state == self.StartupState.MTS_SHUTDOWN:
@@ -329,24 +774,32 @@ class StartupHandler:
                 self.state = self.StartupState.RUN_MTS
                 self._runNextTick()
                 return
-            self.clock.surfClock.driveClock(self.clock.lmk_map['SYSREF'],
-                                            self.clock.surfClock.DriveMode.POWERDOWN)
-            self.clock.surfClock.driveClock(self.clock.lmk_map['PLSYSREF'],
-                                            self.clock.surfClock.DriveMode.POWERDOWN)
-            # 7/8 have a common clkdiv
-            self.clock.surfClock.clockDividerEnable(self.clock.lmk_map['SYSREF'], False)
-            # shut it all down, folks
-            self.clock.surfClock.en_buf_clk_top = False
-            self.clock.surfClock.en_buf_sync_top = False
-            self.clock.surfClock.en_buf_sync_bottom = False
-            # and shut the DAC down.
-            # I could do this through their tools!
-            # But I'm not going to!            
-            self.surf.rfdc.dev.write(0x4008, 0x3)
-            self.surf.rfdc.dev.write(0x4004, 0x1)
+            # this all goes out as one batch of only the registers that changed
+            # (holding hwLock, the clock monitor's running)
+            lmk = self.clock.surfClock
+            with self.hwLock:
+                with lmk.transaction():
+                    lmk.driveClock(self.clock.lmk_map['SYSREF'],
+                                   lmk.DriveMode.POWERDOWN)
+                    lmk.driveClock(self.clock.lmk_map['PLSYSREF'],
+                                   lmk.DriveMode.POWERDOWN)
+                    # 7/8 have a common clkdiv
+                    lmk.clockDividerEnable(self.clock.lmk_map['SYSREF'], False)
+                    # shut it all down, folks
+                    lmk.en_buf_clk_top = False
+                    lmk.en_buf_sync_top = False
+                    lmk.en_buf_sync_bottom = False
+                # and shut the DAC down.
+                # I could do this through their tools!
+                # But I'm not going to!            
+                self.surf.rfdc.dev.write(0x4008, 0x3)
+                self.surf.rfdc.dev.write(0x4004, 0x1)
             self.state = self.StartupState.STARTUP_FINISH
+            self.logger.info("startup finished in %.2f s",
+                             time.monotonic() - self.startTime)
+            self.surf.logStats("startup")
             self._runNextTick()
             return
         elif self.state == self.StartupState.STARTUP_FINISH:
-            self._runNextTick()
+            # nothing left to do, and nothing to wait for
             return
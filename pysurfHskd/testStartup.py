@@ -7,12 +7,15 @@ import struct
 import selectors
 import signal
 from pathlib import Path
-from pueoTimer import HskTimer
+from pueoTimer import HskTimer, TickFifo
 from signalhandler import SignalHandler
 from pyHskHandler import HskHandler
 from surfStartupHandler import StartupHandler
 from HskProcessor import HskProcessor
 from surfExceptions import StartupException
+from rackclkWatchdog import RackclkWatchdog
+from discoveryCache import DiscoveryCache
+from clockMonitor import ClockMonitor
 
 from pysoceeprom import PySOCEEPROM
 from pyzynqmp import PyZynqMP
@@ -22,7 +25,6 @@ from pueo.common.bf import bf
 from s6clk import SURF6Clock
 from gpio import GPIO
 
-import queue
 import logging
 
 LOG_NAME = "testStartup"
@@ -77,18 +79,27 @@ if p.exists():
 zynq = PyZynqMP()
 currentFw = Path(zynq.CURRENT)
 
-surf = PueoSURF(WBSPI.find_device('osu,surf6revB'),'SPI')
-clk = SURF6Clock()
+# everything we have to go find, remembered from last time if we can
+discovery = DiscoveryCache(LOG_NAME)
+surf = PueoSURF(discovery.get('wbspi',
+                              lambda : WBSPI.find_device('osu,surf6revB'),
+                              discovery.exists),
+                'SPI')
+clk = SURF6Clock(lmkPath=discovery.get('lmk',
+                                       lambda : SURF6Clock.find_lmk() or '',
+                                       lambda p : p == '' or discovery.exists(p)))
 clk.trenzClock.powerdown(True)
-clkrst = GPIO(GPIO.get_gpio_pin(3),'out')
+clkrst = GPIO(discovery.get('clkrst', lambda : GPIO.get_gpio_pin(3)),'out')
 
-# get the rackclk indicator
-rackok = GPIO(GPIO.get_gpio_pin(4), 'in')
+# get the rackclk indicator: the watchdog handles it
+rackokPin = discovery.get('rackok', lambda : GPIO.get_gpio_pin(4))
+discovery.save()
 
 # create the selector first
 sel = selectors.DefaultSelector()
 # now create our tick FIFO
-tickFifo = queue.Queue()
+# the timer only ticks while there's something in it
+tickFifo = TickFifo()
 # create a function for processing the tick FIFO
 def runTickFifo(fd, mask):
     tick = os.read(fd, 1)
@@ -111,7 +122,7 @@ def runTickFifo(fd, mask):
             
         
 # they all take the selector now
-timer = HskTimer(sel, callback=runTickFifo, interval=1)
+timer = HskTimer(sel, callback=runTickFifo, interval=1, fifo=tickFifo)
 # this new version takes the selector
 handler = SignalHandler(sel)
 # spawn up the hsk handler
@@ -134,6 +145,38 @@ def runHandler(fd, mask):
 # double sigh    
 sel.register(startup.rfd, selectors.EVENT_READ, runHandler)
 
+# we go boom when rackclk disappears, making sure to eliminate
+# the current firmware to ensure it gets reprogrammed.
+def rackclkLost():
+    # Removing the current FW ensures that it gets reprogrammed.
+    # Kill the clock.
+    clkrst.write(1)
+    clkrst.write(0)
+    if currentFw.exists():
+        currentFw.unlink()
+    handler.set_terminate()
+
+# the watchdog is edge-triggered off the selector now: it only
+# gets armed once we're past WAIT_CLOCK below.
+watchdog = RackclkWatchdog(sel,
+                           rackokPin,
+                           tickFifo,
+                           rackclkLost,
+                           LOG_NAME)
+
+# once the clocks are supposed to be locked, keep watching them.
+# Recovery (off unless turned on through housekeeping) is just a
+# hot restart (same software, see the exit codes at the bottom):
+# startup sees the clock isn't locked and redoes it.
+def clockLost():
+    processor.restartCode = processor.bmKeepCurrentSoft
+    handler.set_terminate()
+
+monitor = ClockMonitor(sel,
+                       startup,
+                       LOG_NAME,
+                       recoverFn=clockLost)
+
 # this is all pretty clean now
 timer.start()
 
@@ -144,7 +187,8 @@ processor = HskProcessor(hsk,
                          LOG_NAME,
                          handler.set_terminate,
                          plxVersionFile="/etc/petalinux/version",
-                         versionFile="/usr/local/share/version.pkl")
+                         versionFile="/usr/local/share/version.pkl",
+                         clockMonitor=monitor)
                          
 ######################            
 hsk.start(callback=processor.basicHandler)
@@ -167,10 +211,6 @@ except Exception as e:
     handler.set_terminate()    
 
 
-# if watchdog is true, we go boom when rackclk disappears,
-# making sure to eliminate the current firmware to ensure
-# it gets reprogrammed.
-watchdog = False
 # terminate is now inside the handler
 while not handler.terminate:
     events = sel.select()
@@ -191,31 +231,21 @@ while not handler.terminate:
             logger.error(traceback.format_exc())
             
             handler.set_terminate()
-    # NOTE: there's a race worry here, need to think about this.
-    # I probably want to get rid of the null byte generator,
-    # bite the bullet, and add a second gpio-keys interface
-    # picking off GPIO 4. Then when the watchdog runs I can just
-    # have it go psycho up/down/up/down etc. until I see one
-    # of the goddamn events.
-    #
-    # But this isn't a worry right now anyway since we don't sleep!
-    if not watchdog:
+    # no hardware access here, just a compare: the watchdog
+    # itself is an event source in the selector.
+    if not watchdog.armed and not handler.terminate:
         if startup.state > startup.StartupState.WAIT_CLOCK:
-            logger.info("RACKCLK watchdog is now active!")
-            watchdog = True
-    else:
-        if rackok.read() == 0:
-            logger.info("RACKCLK watchdog has triggered!!")
-            # Removing the current FW ensures that it gets reprogrammed.
-            # Kill the clock.
-            clkrst.write(1)
-            clkrst.write(0)
-            if currentFw.exists():
-                currentFw.unlink()
-            handler.set_terminate()
+            watchdog.arm()
+    if not monitor.running and not handler.terminate:
+        if (startup.state > startup.StartupState.WAIT_PLL_LOCK and
+            startup.state != startup.StartupState.STARTUP_FAILURE):
+            monitor.start()
 
 logger.info("Terminating!")
 timer.cancel()
+watchdog.close()
+monitor.close()
+startup.stop()
 hsk.stop()
 processor.stop()
 
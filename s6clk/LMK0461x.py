@@ -1,10 +1,39 @@
 import spi
 
 from enum import Enum
+from pathlib import Path
+from contextlib import contextmanager
+from hashlib import sha256
+import ctypes
+import fcntl
+import os
 import re
 import struct
 import time
 
+class LMKImage:
+    """ A compiled LMK register image: the 3-byte SPI writes
+        in programming order, ready to go. """
+    def __init__(self, registers, hash=None):
+        self.registers = list(registers)
+        self.hash = hash
+        self.data = b''.join(struct.pack('>I', v)[1:] for v in self.registers)
+
+    @property
+    def addresses(self):
+        return [ (v >> 8) & 0x7FFF for v in self.registers ]
+
+    @property
+    def values(self):
+        return [ v & 0xFF for v in self.registers ]
+
+    def __len__(self):
+        return len(self.registers)
+
+    @classmethod
+    def frombytes(cls, data, hash=None):
+        return cls([ int.from_bytes(data[i:i+3], 'big') for i in range(0, len(data), 3) ],
+                   hash)
 
 class LMK0461x(spi.SPI):
     class DriveMode(Enum):
@@ -39,28 +68,257 @@ class LMK0461x(spi.SPI):
                       9 : 0x40,
                       10 : 0x42 }
     
-    def __init__(self, path='/dev/spidev1.0'):
+    # compiled images live here keyed by the hash of the file,
+    # in tmpfs so they survive daemon restarts
+    IMAGE_CACHE = "/tmp/pueo/lmkcache"
+    _images = {}
+
+    # batched transfers: SPI_IOC_MESSAGE(N) with one 3-byte
+    # transfer per register, CS dropped between each
+    SPI_IOC_TRANSFER_FORMAT = '=QQIIHBBBBBB'
+    SPI_IOC_TRANSFER_SIZE = struct.calcsize(SPI_IOC_TRANSFER_FORMAT)
+    # spidev limits messages to 4096 bytes by default, and
+    # the ioctl size field is only 14 bits
+    MAX_BATCH = 256
+
+    # registers the shadow never holds: IDs, strobes, lock detect
+    # clear and status. Reads and writes always go to the chip.
+    VOLATILE = { 0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06,
+                 0x11, 0x14, 0xAD, 0xBE, 0x124 }
+
+    # registers we can rewrite on a running chip without having to
+    # reset and reprogram it: the drives and divider enables of the
+    # outputs nobody cares about the phase of (MGT, EXT, feedback,
+    # which startup turns off anyway) and the SYNC setup SURF6Clock
+    # fiddles with. NOT the SYSREF outputs, their divider or the
+    # buffer enables: turning those back on without a reset and SYNC
+    # leaves SYSREF's phase wherever it lands.
+    PATCHABLE = { 0x34, 0x35, 0x36, 0x39, 0x141, 0x142 }
+
+    def __init__(self, path='/dev/spidev1.0', shadow=False):
+        """ shadow=True keeps a copy of every register we've read or
+            written (after configure() that's all of them) so the
+            read-modify-writes don't have to go to the chip. """
         super().__init__(path)
         self.mode = self.MODE_0
         self.bits_per_word = 8
         self.speed = 500000
+        self.shadowEnabled = shadow
+        self.shadow = {}
+        # inside a transaction: pending writes, and what those
+        # registers held when the transaction started
+        self._pending = None
+        self._original = None
+        # our own handle for the batched ioctls
+        try:
+            self._batchFd = os.open(path, os.O_RDWR | os.O_CLOEXEC)
+        except OSError:
+            self._batchFd = None
+
+    @staticmethod
+    def SPI_IOC_MESSAGE(n):
+        # _IOW('k', 0, char[n*32])
+        return (1 << 30) | ((n*LMK0461x.SPI_IOC_TRANSFER_SIZE) << 16) | (ord('k') << 8)
+
+    def transferMany(self, msgs, read=False):
+        """ do a bunch of separate transfers (CS deasserted between each)
+            in as few ioctls as possible. msgs is a list of byte strings.
+            If read is True, returns the list of received bytes. """
+        if self._batchFd is None:
+            rv = [ bytes(self.transfer(list(m))) for m in msgs ]
+            return rv if read else None
+        rv = []
+        for start in range(0, len(msgs), self.MAX_BATCH):
+            chunk = msgs[start:start+self.MAX_BATCH]
+            txb = [ ctypes.create_string_buffer(bytes(m), len(m)) for m in chunk ]
+            rxb = [ ctypes.create_string_buffer(len(m)) for m in chunk ] if read else None
+            xfers = bytearray()
+            for i, m in enumerate(chunk):
+                last = (i == len(chunk)-1)
+                xfers += struct.pack(self.SPI_IOC_TRANSFER_FORMAT,
+                                     ctypes.addressof(txb[i]),
+                                     ctypes.addressof(rxb[i]) if read else 0,
+                                     len(m),
+                                     self.speed,
+                                     0,
+                                     8,
+                                     0 if last else 1,
+                                     0, 0, 0, 0)
+            # has to be mutable: ioctl copies anything immutable into a
+            # 1024 byte buffer first, which is only 32 transfers
+            fcntl.ioctl(self._batchFd, self.SPI_IOC_MESSAGE(len(chunk)), xfers, True)
+            if read:
+                rv += [ b.raw for b in rxb ]
+        return rv if read else None
 
     # we *always* do single-byte transactions
     def readRegister(self, regNum):
-        txd = [ 0x80 | ((regNum >> 8) & 0xFF), regNum & 0xFF, 0x00 ]
-        rv = self.transfer(txd)
-        return rv[2]
+        if self._pending is not None and regNum in self._pending:
+            return self._pending[regNum]
+        if self.shadowEnabled and regNum in self.shadow:
+            val = self.shadow[regNum]
+        else:
+            txd = [ 0x80 | ((regNum >> 8) & 0xFF), regNum & 0xFF, 0x00 ]
+            rv = self.transfer(txd)
+            val = rv[2]
+            if self.shadowEnabled and regNum not in self.VOLATILE:
+                self.shadow[regNum] = val
+        if self._original is not None:
+            self._original.setdefault(regNum, val)
+        return val
 
     def writeRegister(self, regNum, val):
-        txd = [ ((regNum >> 8) & 0xFF), regNum & 0xFF, val & 0xFF]
+        val &= 0xFF
+        if self._pending is not None:
+            if regNum not in self.VOLATILE:
+                if self.shadowEnabled and regNum in self.shadow:
+                    self._original.setdefault(regNum, self.shadow[regNum])
+                self._pending[regNum] = val
+                return
+            # strobes have to land after whatever came before them
+            self._flush()
+        txd = [ ((regNum >> 8) & 0xFF), regNum & 0xFF, val]
         self.transfer(txd)
-        
+        if self.shadowEnabled and regNum not in self.VOLATILE:
+            self.shadow[regNum] = val
+
+    @contextmanager
+    def transaction(self):
+        """ group register updates. Writes inside are held and reads
+            see the held values; on the way out only the registers that
+            actually changed get written, all in one batch. If the block
+            raises the held writes are dropped. Nesting is allowed, the
+            outermost one does the writing. """
+        if self._pending is not None:
+            yield self
+            return
+        self._pending = {}
+        self._original = {}
+        try:
+            yield self
+            self._flush()
+        finally:
+            self._pending = None
+            self._original = None
+
+    def _flush(self):
+        writes = { r: v for r, v in self._pending.items()
+                   if self._original.get(r) != v }
+        self._pending.clear()
+        self._original.clear()
+        if not len(writes):
+            return
+        self.transferMany([ bytes([ (r >> 8) & 0xFF, r & 0xFF, v ])
+                            for r, v in writes.items() ])
+        if self.shadowEnabled:
+            self.shadow.update(writes)
+
+    def readRegisterList(self, regs):
+        """ read a list of registers from the chip (never the shadow)
+            in one batch. Returns a list of values. """
+        msgs = [ bytes([ 0x80 | ((r >> 8) & 0xFF), r & 0xFF, 0 ]) for r in regs ]
+        return [ rx[2] for rx in self.transferMany(msgs, read=True) ]
+
+    def resync(self, regs=None):
+        """ reload the shadow from the chip: by default everything it
+            holds. Returns { reg : (shadow, chip) } for anything that
+            didn't match. """
+        regs = list(self.shadow) if regs is None else [ r for r in regs if r not in self.VOLATILE ]
+        if not len(regs):
+            return {}
+        vals = self.readRegisterList(regs)
+        diff = { r: (self.shadow[r], v) for r, v in zip(regs, vals)
+                 if r in self.shadow and self.shadow[r] != v }
+        self.shadow.update(zip(regs, vals))
+        return diff
+
+    def expected(self, image):
+        """ what the registers should hold after configure(image=image),
+            as { reg : value }, without the volatile ones """
+        exp = {}
+        for r, v in zip(image.addresses, image.values):
+            if r not in self.VOLATILE:
+                exp[r] = v
+        exp.update(self.CONFIGURE_EXTRA)
+        return exp
+
+    def verify(self, image):
+        """ read back everything the image programs (see snapshot) and
+            return { reg : (expected, actual) } for whatever differs.
+            Empty means the chip already holds the image. """
+        snap = self.snapshot(image)
+        if self.shadowEnabled:
+            self.shadow.update((r, v) for r, v in zip(self.snapshotRegisters(image), snap)
+                               if r not in self.VOLATILE)
+        return self.diffSnapshot(image, snap)
+
+    # snapshots: streaming reads get merged across gaps this small
+    SNAPSHOT_GAP = 4
+
+    @staticmethod
+    def snapshotRegisters(image):
+        """ the registers a snapshot holds, in the order it holds them """
+        return sorted(set(image.addresses))
+
+    def snapshot(self, image):
+        """ read every register the image programs (volatile ones too)
+            into a bytes, one per register, in snapshotRegisters() order.
+            Done as a few streaming reads in one batch. """
+        regs = self.snapshotRegisters(image)
+        runs = []
+        for r in regs:
+            if len(runs) and r - (runs[-1][0] + runs[-1][1]) <= self.SNAPSHOT_GAP:
+                runs[-1][1] = r - runs[-1][0] + 1
+            else:
+                runs.append([r, 1])
+        msgs = [ bytes([ 0x80 | ((a >> 8) & 0xFF), a & 0xFF ]) + bytes(n) for a, n in runs ]
+        vals = {}
+        for (a, n), rx in zip(runs, self.transferMany(msgs, read=True)):
+            for i in range(n):
+                vals[a+i] = rx[2+i]
+        return bytes(vals[r] for r in regs)
+
+    def diffSnapshot(self, image, snap):
+        """ compare a snapshot against what configure(image=image) leaves
+            behind: { reg : (expected, actual) } for whatever differs """
+        exp = self.expected(image)
+        return { r: (exp[r], v) for r, v in zip(self.snapshotRegisters(image), snap)
+                 if r in exp and exp[r] != v }
+
+    def patch(self, diff):
+        """ write the expected values from a verify() diff. Returns
+            the number of registers written. """
+        with self.transaction():
+            for r, (want, _) in diff.items():
+                self.writeRegister(r, want)
+        return len(diff)
+
+    def invalidate(self):
+        """ forget the shadow: call after anything that resets the chip
+            behind our back (e.g. the clock reset line). """
+        self.shadow.clear()
+
+    def _loadShadow(self, registers, extra=()):
+        if not self.shadowEnabled:
+            return
+        self.shadow.clear()
+        for v in registers:
+            r = (v >> 8) & 0x7FFF
+            if r not in self.VOLATILE:
+                self.shadow[r] = v & 0xFF
+        self.shadow.update(extra)
+
+    def readRegisters(self, start, n):
+        """ stream n consecutive registers out in one transfer
+            (the address auto-increments). Never from the shadow. """
+        txd = [ 0x80 | ((start >> 8) & 0xFF), start & 0xFF ] + [0]*n
+        rv = self.transfer(txd)
+        return list(rv[2:])
+
     def identify(self, verbose=False):
-        # Clock ID is in registers 3/4/5/6. 4/5 can be read in 1 go
-        # This might be a spidev issue or something? Dunno
-        type = self.readRegister(3)
-        id = (self.readRegister(4) << 8) | self.readRegister(5)
-        ver = self.readRegister(6)
+        # Clock ID is in registers 3/4/5/6, read them all in 1 go
+        type, idh, idl, ver = self.readRegisters(3, 4)
+        id = (idh << 8) | idl
         if verbose:
             print("Type %2.2x ID %4.4x ver %2.2x" %
                   ( type, id, ver ))
@@ -138,7 +396,7 @@ class LMK0461x(spi.SPI):
         self.writeRegister(reg, newVal)
     
     def status(self, verbose=False):
-        clkin = self.readRegister(0x124)
+        clkin, st = self.readRegisterList([0x124, 0xBE])
         if verbose:
             if (clkin & 0xF) == 0x4:
                 print("CLKIN0 selected")
@@ -147,7 +405,6 @@ class LMK0461x(spi.SPI):
             else:
                 print("Unknown Clock Input Source!!")
             
-        st = self.readRegister(0xBE)
         if verbose:
             print("Status: %2.2x" % st)
             if st & 0x20:
@@ -171,14 +428,68 @@ class LMK0461x(spi.SPI):
         self.writeRegister(0x14, w)
         self.writeRegister(0x14, r)        
     
-    def configure(self, ticsFilename):
+    @staticmethod
+    def loadTics(ticsFilename):
+        """ parse a TICS Pro register export into a list of 24-bit writes """
         registers = []
         with open(ticsFilename, 'r') as f:
             lines = [l.rstrip("\n") for l in f]
-            registers = []
             for i in lines:
                 m = re.search('[\t]*(0x[0-9A-F]*)', i)
                 registers.append(int(m.group(1),16),)
+        return registers
+
+    @classmethod
+    def compile(cls, ticsFilename):
+        """ get the compiled LMKImage for a TICS file. Only parsed
+            once: after that it comes out of the cache by file hash """
+        raw = Path(ticsFilename).read_bytes()
+        h = sha256(raw).hexdigest()
+        if h in cls._images:
+            return cls._images[h]
+        cacheFile = Path(cls.IMAGE_CACHE) / (h + '.img')
+        if cacheFile.exists():
+            img = LMKImage.frombytes(cacheFile.read_bytes(), h)
+        else:
+            img = LMKImage(cls.loadTics(ticsFilename), h)
+            try:
+                cacheFile.parent.mkdir(parents=True, exist_ok=True)
+                tmp = cacheFile.with_suffix('.tmp')
+                tmp.write_bytes(img.data)
+                os.replace(tmp, cacheFile)
+            except OSError:
+                pass
+        cls._images[h] = img
+        return img
+
+    # what configure() writes after the image, for the shadow
+    CONFIGURE_EXTRA = { 0x85 : 0x00, 0xF6 : 0x02 }
+
+    def configure(self, ticsFilename=None, registers=None, image=None, batched=True):
+        """ program the LMK from a TICS file, an already-parsed
+            register list (see loadTics) or a compiled LMKImage (see compile).
+            batched=False does it the old way, one ioctl per register. """
+        if not batched:
+            if registers is None:
+                registers = image.registers if image else self.loadTics(ticsFilename)
+            self._configureSingle(registers)
+            return
+        if image is None:
+            image = LMKImage(registers) if registers is not None else self.compile(ticsFilename)
+        d = image.data
+        # same sequence as below, just all in one go:
+        # set startup = 0
+        msgs = [ b'\x00\x11\x00' ]
+        # program all registers
+        msgs += [ d[i:i+3] for i in range(0, len(d), 3) ]
+        # PLL2 LD WINDW SIZE, PLL2 DLD EN, startup, clear lock detect
+        msgs += [ b'\x00\x85\x00', b'\x00\xF6\x02', b'\x00\x11\x01', b'\x00\xAD\x30' ]
+        self.transferMany(msgs)
+        time.sleep(0.02)
+        self.transfer([0x00, 0xAD, 0x00])
+        self._loadShadow(image.registers, self.CONFIGURE_EXTRA)
+
+    def _configureSingle(self, registers):
         # the overall programming sequence is:
         # set startup = 0
         self.transfer([0x00, 0x11, 0x00])
@@ -198,4 +509,5 @@ class LMK0461x(spi.SPI):
         self.transfer([0x00, 0xAD, 0x30])
         time.sleep(0.02)
         self.transfer([0x00, 0xAD, 0x00])
-        
+        self._loadShadow(registers, self.CONFIGURE_EXTRA)
+
@@ -0,0 +1,241 @@
+# ClockBuilder Pro register plans for the Si5395 (Trenz clock).
+#
+# The plan is a CSV of 16-bit address, data with comments splitting
+# it up into a preamble, a delay (for calibration to finish), the
+# actual registers and a postamble. The top byte of the address
+# is the page, which gets selected by writing register 0x01.
+#
+# We compile that once into I2C bursts: one page select whenever
+# the page changes, and one write per run of consecutive addresses
+# (the Si5395 auto-increments). The body of the SURFFWD plan is
+# ~600 registers, which is ~1200 transactions byte-at-a-time,
+# and under 100 as bursts.
+#
+# The delay isn't a sleep: start() writes the preamble and hands
+# back a deadline, and finish() writes the rest once it's passed.
+# So someone with other things to do (the startup state machine)
+# can go do them.
+#
+# Compiled plans are cached as JSON, named by the plan's hash, in a
+# directory only we can write to. Anything that doesn't check out
+# (wrong owner, writable by anyone else, wrong hash inside) gets
+# ignored and the plan just gets parsed again.
+
+from pathlib import Path
+from hashlib import sha256
+import fcntl
+import os
+import json
+import re
+import stat
+import time
+
+class Si5395Plan:
+    SECTIONS = ( 'preamble', 'registers', 'postamble' )
+    # what we wait if the plan doesn't say
+    DEFAULT_DELAY = 0.3
+    # compiled plans, keyed by the hash of the file
+    PLAN_CACHE = "/var/cache/pueo/si5395"
+    _plans = {}
+    # a burst is reg + data, keep it well under what anyone will take
+    MAX_BURST = 128
+
+    def __init__(self, sections, delay=DEFAULT_DELAY, hash=None):
+        """ sections is { name : [ (addr, data), ... ] } """
+        self.sections = sections
+        self.delay = delay
+        self.hash = hash
+        self.bursts = { k : self.makeBursts(v) for k, v in sections.items() }
+
+    def __len__(self):
+        return sum(len(v) for v in self.sections.values())
+
+    @classmethod
+    def makeBursts(cls, writes):
+        """ turn [ (addr, data) ] into [ (page, reg, bytes) ], merging
+            consecutive addresses in the same page. Order is kept. """
+        bursts = []
+        for addr, data in writes:
+            page = (addr >> 8) & 0xFF
+            reg = addr & 0xFF
+            if len(bursts):
+                lp, lr, ld = bursts[-1]
+                if lp == page and lr + len(ld) == reg and len(ld) < cls.MAX_BURST:
+                    ld.append(data)
+                    continue
+            bursts.append((page, reg, bytearray([data])))
+        return [ (p, r, bytes(d)) for p, r, d in bursts ]
+
+    @classmethod
+    def parse(cls, planFilename, hash=None):
+        sections = { k : [] for k in cls.SECTIONS }
+        delay = cls.DEFAULT_DELAY
+        # anything before a 'Start' comment is junk (the header)
+        cur = None
+        with open(planFilename, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('#'):
+                    m = re.match(r'#\s*Start configuration (\w+)', line)
+                    if m and m.group(1) in sections:
+                        cur = sections[m.group(1)]
+                    elif re.match(r'#\s*End configuration', line):
+                        cur = None
+                    m = re.match(r'#\s*Delay (\d+) msec', line)
+                    if m:
+                        delay = int(m.group(1))/1000.0
+                    continue
+                if cur is None or not len(line):
+                    continue
+                addr, data = line.split(',')
+                cur.append((int(addr, 16), int(data, 16)))
+        return cls(sections, delay, hash)
+
+    @classmethod
+    def cacheDir(cls):
+        """ the cache directory, made if it's not there. None if we
+            can't trust it: it and its parent have to be directories
+            owned by us that nobody else can write to """
+        d = Path(cls.PLAN_CACHE)
+        try:
+            d.mkdir(mode=0o700, parents=True, exist_ok=True)
+            for p in ( d, d.parent ):
+                st = os.lstat(p)
+                if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid()
+                    or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+                    return None
+        except OSError:
+            return None
+        return d
+
+    @classmethod
+    def fromCache(cls, cacheFile, hash):
+        """ the plan in a cache file, or None if it's not a valid one
+            for this hash """
+        try:
+            d = json.loads(cacheFile.read_text())
+            if d['hash'] != hash:
+                return None
+            sections = {}
+            for k in cls.SECTIONS:
+                sections[k] = [ (int(a), int(v)) for a, v in d['sections'][k] ]
+                if not all(0 <= a <= 0xFFFF and 0 <= v <= 0xFF for a, v in sections[k]):
+                    return None
+            return cls(sections, float(d['delay']), hash)
+        except (OSError, ValueError, TypeError, KeyError):
+            return None
+
+    @classmethod
+    def compile(cls, planFilename):
+        """ get the compiled plan for a file. Only parsed once: after
+            that it comes out of the cache by file hash """
+        raw = Path(planFilename).read_bytes()
+        h = sha256(raw).hexdigest()
+        if h in cls._plans:
+            return cls._plans[h]
+        cacheDir = cls.cacheDir()
+        cacheFile = cacheDir / (h + '.json') if cacheDir else None
+        plan = cls.fromCache(cacheFile, h) if cacheFile else None
+        if plan is None:
+            plan = cls.parse(planFilename, h)
+            if cacheFile:
+                try:
+                    tmp = cacheFile.with_suffix('.tmp')
+                    tmp.write_text(json.dumps({ 'hash' : h,
+                                                'delay' : plan.delay,
+                                                'sections' : plan.sections }))
+                    os.replace(tmp, cacheFile)
+                except OSError:
+                    pass
+        cls._plans[h] = plan
+        return plan
+
+class Si5395Loader:
+    I2C_SLAVE = 0x0703
+    PAGE_REGISTER = 0x01
+
+    def __init__(self, bus, address=0x69):
+        self.fd = os.open('/dev/i2c-%d' % bus, os.O_RDWR | os.O_CLOEXEC)
+        fcntl.ioctl(self.fd, self.I2C_SLAVE, address)
+        # we don't know what page it's on until we set it
+        self.page = None
+        self.plan = None
+        self.deadline = None
+        self.transactions = 0
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write(self, data):
+        os.write(self.fd, data)
+        self.transactions += 1
+
+    def writeBursts(self, bursts):
+        for page, reg, data in bursts:
+            if page != self.page:
+                self._write(bytes([self.PAGE_REGISTER, page]))
+                self.page = page
+            self._write(bytes([reg]) + data)
+
+    def start(self, plan):
+        """ write the preamble. Returns the deadline (time.monotonic)
+            before which finish() shouldn't be called. """
+        self.plan = plan
+        self.page = None
+        self.transactions = 0
+        self.writeBursts(plan.bursts['preamble'])
+        self.deadline = time.monotonic() + plan.delay
+        return self.deadline
+
+    def ready(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def finish(self, wait=False):
+        """ write the registers and the postamble. If the delay hasn't
+            passed, either wait it out (wait=True) or complain """
+        remaining = self.deadline - time.monotonic()
+        if remaining > 0:
+            if not wait:
+                raise RuntimeError("Si5395 plan finished %.3f s early" % remaining)
+            time.sleep(remaining)
+        self.writeBursts(self.plan.bursts['registers'])
+        self.writeBursts(self.plan.bursts['postamble'])
+        self.deadline = None
+        return self.transactions
+
+    def load(self, plan):
+        """ the whole thing, blocking through the delay """
+        self.start(plan)
+        return self.finish(wait=True)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="compile (and optionally load) a Si5395 plan")
+    parser.add_argument('planfile', nargs='?',
+                        default='/usr/local/share/Si5395-RevA-SURFFWD-Registers.txt')
+    parser.add_argument('--load', action='store_true',
+                        help='actually program the Trenz clock with it')
+    parser.add_argument('--bus', type=int, default=1)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    plan = Si5395Plan.compile(args.planfile)
+    print("compiled %d writes in %.3f ms, delay %.3f s" %
+          (len(plan), (time.perf_counter()-start)*1000, plan.delay))
+    for k in Si5395Plan.SECTIONS:
+        b = plan.bursts[k]
+        print("  %s: %d writes, %d bursts over %d pages" %
+              (k, len(plan.sections[k]), len(b), len(set(p for p, _, _ in b))))
+    if args.load:
+        with Si5395Loader(args.bus) as ldr:
+            start = time.perf_counter()
+            n = ldr.load(plan)
+            print("loaded in %.3f s, %d I2C transactions" % (time.perf_counter()-start, n))
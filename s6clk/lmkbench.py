@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# Benchmark LMK programming: old path (parse every time, one
+# ioctl per register) vs. compiled image + batched transfers.
+#
+# THIS REPROGRAMS THE LMK! Don't run it on a SURF that's
+# supposed to be doing anything.
+#
+# usage: python3 -m s6clk.lmkbench [-n runs] [ticsfile]
+
+import argparse
+import time
+
+from .s6clk import SURF6Clock
+from .LMK0461x import LMK0461x
+
+def timeit(fn, runs):
+    t = []
+    for i in range(runs):
+        start = time.perf_counter()
+        fn()
+        t.append(time.perf_counter() - start)
+    return min(t), sum(t)/len(t)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    parser.add_argument('ticsfile', nargs='?', default='/usr/local/share/SURF6_LMK.txt')
+    args = parser.parse_args()
+
+    clk = SURF6Clock()
+    lmk = clk.surfClock
+    if lmk is None:
+        print("no LMK found")
+        exit(1)
+
+    results = {
+        'parse (loadTics)' :
+            timeit(lambda : LMK0461x.loadTics(args.ticsfile), args.runs),
+        'compile (cached)' :
+            timeit(lambda : LMK0461x.compile(args.ticsfile), args.runs),
+        'program, old path' :
+            timeit(lambda : lmk.configure(args.ticsfile, batched=False), args.runs),
+        'program, batched' :
+            timeit(lambda : lmk.configure(image=LMK0461x.compile(args.ticsfile)), args.runs)
+    }
+    for k, (tmin, tmean) in results.items():
+        print("%-20s: min %8.3f ms mean %8.3f ms" % (k, tmin*1000, tmean*1000))
+    if lmk._batchFd is None:
+        print("NOTE: could not open spidev for batching, batched path fell back to single transfers")
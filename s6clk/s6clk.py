@@ -1,6 +1,7 @@
 # There are 2 possible clocks on the SURF6.
 # we wrote the LMK module
 from .LMK0461x import LMK0461x
+from .Si5395Plan import Si5395Plan, Si5395Loader
 
 from electronics.gateways import LinuxDevice
 from electronics.devices import Si5395
@@ -10,12 +11,15 @@ import spi
 
 import os
 import time
+import logging
 import glob
 import re
 import struct
 from pathlib import Path
 from collections import defaultdict
 
+logger = logging.getLogger(__name__)
+
 class SURF6Clock:
     # 5 is intentionally left off here, it cannot
     # be shut down!!
@@ -34,21 +38,29 @@ class SURF6Clock:
         'PLSYSREF' : 7
     }
     
+    # ClockBuilder plan for the Trenz clock in forwarded-clock mode
+    TRENZ_PLAN = "/usr/local/share/Si5395-RevA-SURFFWD-Registers.txt"
+    TRENZ_ADDRESS = 0x69
+
     class Revision(Enum):
         REVA = 'Rev A'
         REVB = 'Rev B/C'
         
-    def __init__(self, trenzClockBus=1):
+    def __init__(self, trenzClockBus=1, lmkPath=None):
+        """ lmkPath is the LMK's spidev if you already know it
+            (e.g. from the discovery cache): '' means there isn't one.
+            If it's None we go look. """
+        self.trenzClockBus = trenzClockBus
         self.gw = LinuxDevice(trenzClockBus)
-        self.trenzClock = Si5395(self.gw, 0x69)
-        surfClockPath = self._find_lmk()
-        if surfClockPath is None:
-            print("no LMK04610 found, assuming rev A")
+        self.trenzClock = Si5395(self.gw, self.TRENZ_ADDRESS)
+        surfClockPath = self.find_lmk() if lmkPath is None else lmkPath
+        if not surfClockPath:
+            logger.info("no LMK04610 found, assuming rev A")
             self.rev = self.Revision.REVA
             self.surfClock = None
         else:
             self.rev = self.Revision.REVB
-            self.surfClock = LMK0461x(surfClockPath)
+            self.surfClock = LMK0461x(surfClockPath, shadow=True)
             # we need to configure the LMK properly
             # first to talk to it.
             # We occasionally switch SYNC behavior so
@@ -60,6 +72,23 @@ class SURF6Clock:
         self.surfClock.writeRegister(0x141, 0x4)
         self.surfClock.writeRegister(0x142, 0x30)
 
+    def startTrenzPlan(self, planFile=TRENZ_PLAN):
+        """ start loading a plan into the Trenz clock. Returns the loader:
+            call its finish() once ready() says the delay is over, then
+            close() it. """
+        ldr = Si5395Loader(self.trenzClockBus, self.TRENZ_ADDRESS)
+        try:
+            ldr.start(Si5395Plan.compile(planFile))
+        except Exception:
+            ldr.close()
+            raise
+        return ldr
+
+    def loadTrenzPlan(self, planFile=TRENZ_PLAN):
+        """ load a plan into the Trenz clock, blocking through the delay """
+        with self.startTrenzPlan(planFile) as ldr:
+            return ldr.finish(wait=True)
+
     def identify(self):
         if self.rev == self.Revision.REVB:
             id = self.surfClock.identify()
@@ -71,21 +100,23 @@ class SURF6Clock:
                'G' if id[4] == 0 else "?",
                'M' if id[5] == 0 else "?"))
             
-    def _find_lmk(self):
+    @staticmethod
+    def find_lmk():
+        """ find the LMK on the SPI bus and make sure spidev has it.
+            Returns the spidev path, or None if there's no LMK. """
         for dev in Path('/sys/bus/spi/devices').glob('*'):
-            print("checking", dev)
             # Xilinx's original method for this was stupid
             fullCompatible = (dev / 'of_node' / 'compatible').read_text().rstrip('\x00')
-            print(fullCompatible)
+            logger.debug("checking %s: %s", dev, fullCompatible)
             if fullCompatible == "ti,lmk0461x":
-                print("yup")
-                if ( dev / 'driver').exists():
-                    ( dev / 'driver' / 'unbind').write_text(dev.name)
+                devname = "/dev/spidev"+dev.name[3:]
+                drv = dev / 'driver'
+                if drv.exists() and drv.resolve().name == 'spidev' and Path(devname).exists():
+                    logger.debug("%s already bound to spidev", dev.name)
+                    return devname
+                if drv.exists():
+                    ( drv / 'unbind').write_text(dev.name)
                 ( dev / 'driver_override').write_text('spidev')
                 Path('/sys/bus/spi/drivers/spidev/bind').write_text(dev.name)
-                devname = "/dev/spidev"+dev.name[3:]
                 return devname
-            else:
-                print("nope")
         return None
-    
@@ -0,0 +1,74 @@
+# The tests run on a normal Linux box: the hardware comes from
+# pysurfHskd/surfSim.py, same as the simulator. Anything that needs
+# pueo-python (the startup handler) is skipped if the submodule
+# isn't checked out.
+
+import sys
+import logging
+from pathlib import Path
+
+import pytest
+
+REPO = Path(__file__).resolve().parent.parent
+for p in [ REPO, REPO / 'pueo-python', REPO / 'pueo-utils' / 'signalhandler',
+           REPO / 'pysurfHskd', REPO / 'pyfwupd' ]:
+    if str(p) not in sys.path:
+        sys.path.insert(0, str(p))
+
+import surfSim
+
+# the daemons add these
+for name, num in ( ('TRACE', logging.DEBUG-5), ('DETAIL', logging.INFO-5), ('FILE', 100) ):
+    if not hasattr(logging.getLoggerClass(), name.lower()):
+        surfSim.addLevel(name, num)
+
+@pytest.fixture(scope='session')
+def simulator():
+    """ the simulated hardware, with its fake modules in sys.modules """
+    sim = surfSim.SURFSimulator(surfSim.SimConfig())
+    sys.modules.update(sim.modules())
+    return sim
+
+@pytest.fixture(scope='session')
+def sim(simulator):
+    """ the simulator installed for the startup handler """
+    pytest.importorskip('pueo.common.bf')
+    simulator.install()
+    return simulator
+
+@pytest.fixture
+def lmk(simulator):
+    """ an LMK0461x talking to a freshly reset simulated LMK """
+    from s6clk.LMK0461x import LMK0461x
+    simulator.lmk.reset()
+    l = LMK0461x(simulator.SPIDEV, shadow=True)
+    # the readback enable, see SURF6Clock.surfClockInit
+    l.writeRegister(0x141, 0x4)
+    l.writeRegister(0x142, 0x30)
+    return l
+
+@pytest.fixture
+def image(lmk, tmp_path, monkeypatch):
+    """ the real LMK image, compiled without touching the cache """
+    monkeypatch.setattr(type(lmk), 'IMAGE_CACHE', str(tmp_path))
+    monkeypatch.setattr(type(lmk), '_images', {})
+    return lmk.compile(REPO / 'base_squashfs' / 'share' / 'SURF6_LMK.txt')
+
+def unusedOff(lmk):
+    """ what startup turns off once ACLK is up """
+    with lmk.transaction():
+        lmk.driveClock(1, lmk.DriveMode.POWERDOWN)
+        lmk.driveClock(2, lmk.DriveMode.POWERDOWN)
+        lmk.clockDividerEnable(1, False)
+        lmk.clockDividerEnable(2, False)
+        lmk.driveClock(5, lmk.DriveMode.POWERDOWN)
+
+def sysrefOff(lmk):
+    """ what startup turns off after MTS """
+    with lmk.transaction():
+        lmk.driveClock(6, lmk.DriveMode.POWERDOWN)
+        lmk.driveClock(7, lmk.DriveMode.POWERDOWN)
+        lmk.clockDividerEnable(6, False)
+        lmk.en_buf_clk_top = False
+        lmk.en_buf_sync_top = False
+        lmk.en_buf_sync_bottom = False
@@ -0,0 +1,75 @@
+import os
+import threading
+import selectors
+import types
+
+import pytest
+
+from clockMonitor import ClockMonitor
+
+class Startup:
+    """ what the monitor reads: LMK status and the SURF's 0x800 """
+    def __init__(self):
+        self.hwLock = threading.RLock()
+        # PLL1/PLL2 locked, DLD
+        self.lmk = 0x13
+        self.pll = 1
+        self.clock = types.SimpleNamespace(surfClock=self)
+        self.surf = self
+
+    def status(self):
+        return self.lmk
+
+    def read(self, addr):
+        return self.pll << 14
+
+@pytest.fixture
+def monitor():
+    sel = selectors.DefaultSelector()
+    lost = []
+    m = ClockMonitor(sel, Startup(), 'test', recoverFn=lambda : lost.append(1),
+                     recover=True)
+    m.lost = lost
+    m.sel = sel
+    yield m
+    m.close()
+
+def sample(m, n=ClockMonitor.DEBOUNCE):
+    for i in range(n):
+        m._sample()
+    for key, mask in m.sel.select(timeout=0):
+        key.data(key.fileobj, mask)
+
+def counts(m):
+    return { s[0] : c for s, c in zip(m.SIGNALS, m.counts) if c }
+
+def test_locked_is_quiet(monitor):
+    sample(monitor, 5)
+    assert counts(monitor) == {}
+    assert monitor.lost == []
+
+def test_dld_dropping_is_bad(monitor):
+    sample(monitor)
+    monitor.startup.lmk = 0x03
+    sample(monitor)
+    assert counts(monitor) == { 'HOLDOVER_DLD' : 1 }
+    # and coming back isn't
+    monitor.startup.lmk = 0x13
+    sample(monitor)
+    assert counts(monitor) == { 'HOLDOVER_DLD' : 1 }
+    assert monitor.lost == []
+
+def test_pll1_lost_recovers(monitor):
+    sample(monitor)
+    monitor.startup.lmk = 0x12
+    sample(monitor)
+    assert counts(monitor) == { 'PLL1_LCK_DET' : 1 }
+    assert monitor.lost == [ 1 ]
+
+def test_debounce(monitor):
+    sample(monitor)
+    monitor.startup.pll = 0
+    sample(monitor, monitor.debounce - 1)
+    monitor.startup.pll = 1
+    sample(monitor, 3)
+    assert counts(monitor) == {}
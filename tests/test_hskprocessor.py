@@ -0,0 +1,127 @@
+import os
+import types
+import struct
+import threading
+
+import pytest
+
+from HskProcessor import HskProcessor
+
+class Hsk:
+    myID = 0x9
+    def sendPacket(self, pkt):
+        self.pkt = bytes(pkt)
+
+@pytest.fixture
+def hp():
+    """ just enough of an HskProcessor to answer commands """
+    hp = HskProcessor.__new__(HskProcessor)
+    hp.hsk = Hsk()
+    hp.startup = types.SimpleNamespace(state=3, endState=254, substep=0,
+                                       fail_msg=None,
+                                       setEndState=lambda s : None)
+    return hp
+
+def command(hp, fn, cmd, data=b''):
+    """ send a command to fn, return the reply's data after checking
+        the framing """
+    pkt = bytearray([ 0x1, hp.hsk.myID, cmd, len(data) ]) + data
+    pkt.append((256 - sum(pkt[4:])) & 0xFF)
+    fn(pkt)
+    r = hp.hsk.pkt
+    assert r[0] == hp.hsk.myID and r[1] == 0x1 and r[2] == cmd
+    assert r[3] == len(r) - 5
+    assert sum(r[4:]) & 0xFF == 0
+    return r[4:-1]
+
+def test_start_state(hp):
+    assert command(hp, hp.eStartState, 32) == bytes([ 3, 254 ])
+
+def test_start_state_substep(hp):
+    hp.startup.substep = 2
+    assert command(hp, hp.eStartState, 32) == bytes([ 3, 254, 2 ])
+
+def test_start_state_failed(hp):
+    hp.startup.state = 255
+    hp.startup.fail_msg = 'MTS failure 1'
+    assert command(hp, hp.eStartState, 32) == bytes([ 255, 254 ]) + b'MTS failure 1'
+
+def mtsCal(hp, **kw):
+    mts = dict(cal_runs=0, cal_margin=2, cal_latency=None, cal_failures=0,
+               target_latency=-1)
+    mts.update(kw)
+    hp.startup.mts = types.SimpleNamespace(**mts)
+    d = command(hp, hp.eFwParams, 128, b'\x03')
+    assert len(d) == 24
+    return d
+
+def test_mts_cal_none(hp):
+    d = mtsCal(hp)
+    assert d[2] == 0 and d[8:] == b'\xff'*16
+
+def test_mts_cal_started(hp):
+    # calibration's started but no run has finished
+    d = mtsCal(hp, cal_latency=[], cal_runs=0)
+    assert d[2] == 0 and d[8:] == b'\xff'*16
+
+def test_mts_cal_runs(hp):
+    d = mtsCal(hp, cal_latency=[ (10, 12, 14, 16), (11, 12, 13, 18) ],
+               cal_failures=1, target_latency=20)
+    assert d[2:4] == bytes([ 2, 1 ])
+    assert int.from_bytes(d[4:8], 'big') == 20
+    assert d[8:] == b''.join(a.to_bytes(2, 'big') + b.to_bytes(2, 'big')
+                             for a, b in ( (10, 11), (12, 12), (13, 14), (16, 18) ))
+
+@pytest.fixture
+def status(hp, tmp_path):
+    """ pyfwupd's side of the download status, published where hp looks """
+    from pyfwupd import Status
+    hp.fwStatus = str(tmp_path / 'status')
+    st = Status(hp.fwStatus)
+    yield st
+    st.close()
+
+def downloadStatus(hp):
+    return command(hp, hp.eDownloadStatus, 187)
+
+def test_download_status_never_ran(hp, tmp_path):
+    hp.fwStatus = str(tmp_path / 'status')
+    assert downloadStatus(hp) == b''
+
+def test_download_status(hp, status):
+    status.update(frames=7, remaining=1234, fn=b'/tmp/x')
+    d = downloadStatus(hp)
+    assert len(d) == status.SIZE - 4
+    f = struct.unpack(status.FORMAT, bytes(4) + d)
+    assert f[1:4] == (status.IDLE, 0, 0)
+    assert f[5:7] == (7, 1234)
+    assert f[-2] == os.getpid()
+    assert f[-1].rstrip(b'\x00') == b'/tmp/x'
+
+def test_download_status_mid_write(hp, status):
+    # what a reader sees partway through _publish
+    status.mm[0:4] = struct.pack(">I", status.seq + 1)
+    assert downloadStatus(hp) == b''
+
+def test_download_status_consistent(hp, status):
+    # frames and remaining always go together, so a torn read shows up
+    done = threading.Event()
+    def writer():
+        i = 0
+        while not done.is_set():
+            i += 1
+            status.update(frames=i, remaining=i)
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        seen = 0
+        for _ in range(2000):
+            d = hp._downloadStatus()
+            if d:
+                f = struct.unpack(status.FORMAT, bytes(4) + d)
+                assert f[5] == f[6]
+                seen += 1
+        assert seen
+    finally:
+        done.set()
+        t.join()
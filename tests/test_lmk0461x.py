@@ -0,0 +1,80 @@
+import os
+import errno
+import ctypes
+import struct
+import fcntl
+
+import pytest
+
+from conftest import unusedOff, sysrefOff
+
+@pytest.fixture
+def spidev(lmk, simulator, monkeypatch):
+    """ a spidev for the batched path: the ioctl is checked the way
+        the kernel would see it, then run against the simulated LMK.
+        Returns the number of transfers in each ioctl. """
+    batches = []
+    real = fcntl.ioctl
+    fd = os.open('/dev/null', os.O_RDWR)
+    def ioctl(f, req, arg, mutate=True):
+        if f != fd:
+            return real(f, req, arg, mutate)
+        # the real thing gets the buffer first: it's what
+        # has to get through, /dev/null just says no afterwards
+        with pytest.raises(OSError) as e:
+            real(f, req, arg, mutate)
+        assert e.value.errno == errno.ENOTTY
+        size = (req >> 16) & 0x3FFF
+        assert len(arg) == size
+        n = size // lmk.SPI_IOC_TRANSFER_SIZE
+        for i in range(n):
+            x = struct.unpack_from(lmk.SPI_IOC_TRANSFER_FORMAT, arg,
+                                   i*lmk.SPI_IOC_TRANSFER_SIZE)
+            tx, rx, ln = x[0], x[1], x[2]
+            rxd = simulator.lmk.transfer(ctypes.string_at(tx, ln))
+            if rx:
+                ctypes.memmove(rx, bytes(rxd), ln)
+        batches.append(n)
+    monkeypatch.setattr(fcntl, 'ioctl', ioctl)
+    lmk._batchFd = fd
+    yield batches
+    os.close(fd)
+
+def test_batch_gets_to_the_kernel(lmk):
+    # a full batch is way past what ioctl will copy for an immutable buffer
+    lmk._batchFd = os.open('/dev/null', os.O_RDWR)
+    try:
+        with pytest.raises(OSError) as e:
+            lmk.transferMany([ b'\x00\x00\x00' ]*lmk.MAX_BATCH)
+        assert e.value.errno == errno.ENOTTY
+    finally:
+        os.close(lmk._batchFd)
+
+def test_configure_batched(lmk, image, spidev):
+    lmk.configure(image=image)
+    assert max(spidev) > 32
+    lmk.invalidate()
+    assert lmk.verify(image) == {}
+
+def test_batched_read(lmk, spidev):
+    lmk.writeRegister(0x40, 0x5A)
+    lmk.writeRegister(0x41, 0xA5)
+    regs = [ 0x40, 0x41 ]*40
+    assert lmk.readRegisterList(regs) == [ 0x5A, 0xA5 ]*40
+    assert spidev == [ 80 ]
+
+def test_unused_outputs_patchable(lmk, image):
+    lmk.configure(image=image)
+    unusedOff(lmk)
+    diff = lmk.verify(image)
+    assert len(diff) and set(diff) <= lmk.PATCHABLE
+    assert lmk.patch(diff) == len(diff)
+    assert lmk.verify(image) == {}
+
+def test_sysref_not_patchable(lmk, image):
+    lmk.configure(image=image)
+    unusedOff(lmk)
+    sysrefOff(lmk)
+    diff = lmk.verify(image)
+    assert { 0x3C, 0x6E } <= set(diff)
+    assert not set(diff) <= lmk.PATCHABLE
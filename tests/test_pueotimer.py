@@ -0,0 +1,77 @@
+import os
+import time
+import selectors
+
+import pytest
+
+from pueoTimer import HskTimer, TickFifo
+
+INTERVAL = 0.01
+
+@pytest.fixture
+def timer():
+    """ an HskTimer on a TickFifo, running what's in the FIFO on each
+        tick the way the daemon does """
+    sel = selectors.DefaultSelector()
+    fifo = TickFifo()
+    def runFifo(fd, mask):
+        os.read(fd, 1)
+        todo = []
+        while not fifo.empty():
+            todo.append(fifo.get())
+        for fn in todo:
+            fn()
+    t = HskTimer(sel, callback=runFifo, interval=INTERVAL, fifo=fifo)
+    def service(ticks):
+        end = time.monotonic() + ticks*INTERVAL
+        while (left := end - time.monotonic()) > 0:
+            for key, mask in sel.select(timeout=left):
+                key.data(key.fileobj, mask)
+    t.service = service
+    t.start()
+    yield t
+    t.cancel()
+    t.join(1)
+    assert not t.is_alive()
+
+def test_idle_when_empty(timer):
+    timer.service(20)
+    assert timer.tickCount == 0
+
+def test_put_wakes(timer):
+    ran = []
+    timer.service(5)
+    timer.fifo.put(lambda : ran.append(1))
+    timer.service(5)
+    assert ran == [ 1 ]
+    # and it goes quiet again (maybe one more tick in flight)
+    n = timer.tickCount
+    timer.service(20)
+    assert timer.tickCount <= n + 1
+
+def test_requeue_keeps_ticking(timer):
+    ran = []
+    def again():
+        ran.append(1)
+        if len(ran) < 5:
+            timer.fifo.put(again)
+    timer.fifo.put(again)
+    timer.service(50)
+    assert len(ran) == 5
+    assert timer.tickCount <= 6
+
+def test_cancel_while_idle(timer):
+    timer.service(5)
+    start = time.monotonic()
+    timer.cancel()
+    timer.join(1)
+    assert not timer.is_alive() and time.monotonic() - start < 0.5
+
+def test_no_fifo_ticks_forever():
+    sel = selectors.DefaultSelector()
+    t = HskTimer(sel, callback=lambda fd, mask : None, interval=INTERVAL)
+    t.start()
+    time.sleep(10*INTERVAL)
+    t.cancel()
+    t.join(1)
+    assert t.tickCount > 2
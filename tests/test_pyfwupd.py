@@ -0,0 +1,252 @@
+import io
+import os
+import json
+import time
+import struct
+import hashlib
+import logging
+import tarfile
+import selectors
+
+import pytest
+
+import pyfwupd
+
+logger = logging.getLogger('test')
+
+def tarball(entries):
+    """ entries : (name, data or None for a directory, mode) """
+    b = io.BytesIO()
+    with tarfile.open(fileobj=b, mode='w') as tf:
+        for name, data, mode in entries:
+            ti = tarfile.TarInfo(name)
+            ti.mode = mode
+            if data is None:
+                ti.type = tarfile.DIRTYPE
+                tf.addfile(ti)
+            else:
+                ti.size = len(data)
+                tf.addfile(ti, io.BytesIO(data))
+    return b.getvalue()
+
+@pytest.fixture
+def staged(tmp_path):
+    """ an Archive with a directory tree and a setuid file staged """
+    root = str(tmp_path).lstrip('/')
+    a = pyfwupd.Archive([ str(tmp_path) ], ('md5',), logger)
+    a.write(tarball([ (root + '/new', None, 0o755),
+                      (root + '/new/deeper/x', b'x'*1000, 0o4755),
+                      (root + '/top', b'top', 0o644) ]))
+    a.finish()
+    return a
+
+def everything(d):
+    return sorted(str(p.relative_to(d)) for p in d.rglob('*'))
+
+def test_archive_stages_nothing_visible(tmp_path, staged):
+    # just the temp files, no directories
+    assert all(n.startswith('.') and '/' not in n for n in everything(tmp_path))
+
+def test_archive_abort(tmp_path, staged):
+    staged.abort()
+    assert everything(tmp_path) == []
+
+def test_archive_commit(tmp_path, staged):
+    staged.commit()
+    assert everything(tmp_path) == [ 'new', 'new/deeper', 'new/deeper/x', 'top' ]
+    assert (tmp_path / 'new/deeper/x').read_bytes() == b'x'*1000
+    assert os.stat(tmp_path / 'new/deeper/x').st_mode & 0o7777 == 0o755
+
+def test_archive_outside_allowed(tmp_path):
+    a = pyfwupd.Archive([ str(tmp_path / 'ok') ], ('md5',), logger)
+    a.write(tarball([ (str(tmp_path).lstrip('/') + '/evil', b'x', 0o644) ]))
+    with pytest.raises(ValueError):
+        a.finish()
+    a.abort()
+    assert everything(tmp_path) == []
+
+@pytest.fixture
+def scripts(tmp_path):
+    sel = selectors.DefaultSelector()
+    r = pyfwupd.ScriptRunner(sel, logger, 1, results=tmp_path / 'results')
+    r.sel = sel
+    def submit(text, timeout=0):
+        p = tmp_path / 'script'
+        p.write_text('#!/bin/sh\n' + text)
+        r.submit(p, hashlib.md5(text.encode()).hexdigest(), timeout)
+    r.add = submit
+    return r
+
+def results(r):
+    return { x['md5'] : x for x in json.loads(r.results.read_text()) }
+
+def test_scripts_run_one_at_a_time(scripts):
+    scripts.add('echo one; sleep 0.2')
+    scripts.add('echo two')
+    scripts.service()
+    assert len(scripts.running) == 1 and len(scripts.waiting) == 1
+    scripts.close()
+    assert sorted(x['tail'][0] for x in results(scripts).values()) == [ 'one', 'two' ]
+
+def test_scripts_same_script_twice(scripts):
+    # each copy gets its own file, so the first one finishing
+    # doesn't take the second one's away
+    scripts.add('exit 3')
+    scripts.add('exit 3')
+    scripts.close()
+    assert scripts.submitted == 2
+    assert [ x['returncode'] for x in json.loads(scripts.results.read_text()) ] == [ 3, 3 ]
+
+def test_scripts_close_gives_up(scripts):
+    scripts.add('echo hung; sleep 60')
+    scripts.add('echo never')
+    start = time.monotonic()
+    scripts.close(wait=0.3)
+    assert time.monotonic() - start < 5
+    r = results(scripts)
+    hung = [ x for x in r.values() if x['tail'] == [ 'hung' ] ][0]
+    assert hung['timedOut'] and hung['returncode'] == -9
+    never = [ x for x in r.values() if x['tail'] == [] ][0]
+    assert never['returncode'] is None
+    assert list(scripts.results.parent.glob('script*')) == []
+
+class Handler:
+    terminate = False
+    def set_terminate(self):
+        self.terminate = True
+
+@pytest.fixture
+def receiver(tmp_path):
+    """ a FrameReceiver fed blocks directly, journal and status in tmp_path.
+        receiver.restart() is pyfwupd being stopped and started again. """
+    live = []
+    def start():
+        r = pyfwupd.FrameReceiver(selectors.DefaultSelector(), Handler(), logger,
+                                  [ None, None ], None, None, None,
+                                  journal=tmp_path / 'journal',
+                                  status=tmp_path / 'status')
+        r.restart = lambda : (live.pop().close(), start())[1]
+        live.append(r)
+        return r
+    yield start()
+    live.pop().close()
+
+PAYLOAD = bytes(range(256))*40
+
+def pyfw(fn, offset=None, payload=PAYLOAD):
+    """ a PYFW header with an md5, resuming at offset if it's not None """
+    flags = pyfwupd.DIGEST_FLAG | (0 if offset is None else pyfwupd.RESUME_FLAG)
+    h = (pyfwupd.PYFW + struct.pack(">I", len(payload) | flags) + fn.encode() +
+         b'\x00\x01' + hashlib.md5(payload).digest())
+    if offset is not None:
+        h += struct.pack(">I", offset)
+    return h + bytes([ (256 - sum(h)) & 0xFF ])
+
+def send(r, *blocks):
+    for b in blocks:
+        r.processData(memoryview(b))
+    return r.horribleProblem
+
+def journal(tmp_path):
+    return json.loads((tmp_path / 'journal').read_text())
+
+def test_journal_interrupted(tmp_path, receiver):
+    dest = tmp_path / 'out'
+    assert send(receiver, pyfw(str(dest)) + PAYLOAD[:4000]) is None
+    assert journal(tmp_path)['received'] == 4000
+    receiver.restart()
+    # kept for later
+    assert journal(tmp_path)['received'] == 4000
+    assert pyfwupd.FileSink.tempPath(dest).stat().st_size == 4000
+    assert not dest.exists()
+
+@pytest.mark.parametrize('offset', [ 0, 1000, 4000 ])
+def test_journal_resume(tmp_path, receiver, offset):
+    dest = tmp_path / 'out'
+    send(receiver, pyfw(str(dest)) + PAYLOAD[:4000])
+    r = receiver.restart()
+    # whatever's sent again before 4000 gets skipped
+    assert send(r, pyfw(str(dest), offset) + PAYLOAD[offset:], b'\x00') is None
+    assert dest.read_bytes() == PAYLOAD
+    assert not (tmp_path / 'journal').exists()
+
+def test_journal_resume_past_end(tmp_path, receiver):
+    dest = tmp_path / 'out'
+    send(receiver, pyfw(str(dest)) + PAYLOAD[:4000])
+    r = receiver.restart()
+    assert send(r, pyfw(str(dest), 5000) + PAYLOAD[5000:]) == 2
+    # still there to try again properly
+    assert journal(tmp_path)['received'] == 4000
+
+def test_journal_resume_nothing(tmp_path, receiver):
+    assert send(receiver, pyfw(str(tmp_path / 'out'), 1000) + PAYLOAD[1000:]) == 2
+
+def test_journal_resume_other_file(tmp_path, receiver):
+    dest = tmp_path / 'out'
+    send(receiver, pyfw(str(dest)) + PAYLOAD[:4000])
+    r = receiver.restart()
+    other = PAYLOAD[::-1]
+    assert send(r, pyfw(str(dest), 1000, other) + other[1000:]) == 2
+
+def test_journal_fresh_start_discards(tmp_path, receiver):
+    dest = tmp_path / 'out'
+    send(receiver, pyfw(str(dest)) + PAYLOAD[:4000])
+    r = receiver.restart()
+    other = PAYLOAD[::-1]
+    assert send(r, pyfw(str(dest), payload=other) + other, b'\x00') is None
+    assert dest.read_bytes() == other
+    assert not (tmp_path / 'journal').exists()
+
+def test_journal_junk(tmp_path, receiver):
+    (tmp_path / 'journal').write_text('{ nope')
+    assert receiver.journal.load() is None
+    assert not (tmp_path / 'journal').exists()
+
+@pytest.fixture
+def pyconv():
+    pytest.importorskip('numpy')
+    return pyfwupd.PyConverter()
+
+def test_pyconverter_table():
+    pytest.importorskip('numpy')
+    P = pyfwupd.PyConverter
+    assert len(set(P.WORD_BITS)) == 128 and max(P.WORD_BITS) < 240
+    idx = P.bitIndex()
+    assert len(idx) == P.DATA_SIZE*8 == len(set(idx.tolist()))
+    assert idx.min() >= P.FRAME_START*8 and idx.max() < P.FRAME_SIZE*8
+
+@pytest.mark.parametrize('byte, bit, data', [
+    # word 0's bit 0 is data bit 0
+    (472, 0, 0),
+    # WORD_BITS[1] = 132
+    (472 + 16, 4, 1),
+    # the last data bit of the first word, WORD_BITS[127] = 239
+    (472 + 29, 7, 127),
+    # next row down is the next 16 bytes
+    (472 + 372, 0, 16*8),
+    # next column over comes after all 256 rows
+    (472 + 30, 0, 256*16*8),
+    # the gap between columns 5 and 6
+    (472 + 192, 0, 6*256*16*8),
+])
+def test_pyconverter_bit(pyconv, byte, bit, data):
+    fr = bytearray(pyconv.FRAME_SIZE)
+    fr[byte] = 1 << bit
+    out = bytearray(pyconv.DATA_SIZE)
+    out[data // 8] = 1 << (data % 8)
+    assert bytes(pyconv.convert(fr)) == out
+
+def test_pyconverter_roundtrip(pyconv):
+    data = os.urandom(pyconv.DATA_SIZE)
+    fr = pyconv.unconvert(data)
+    assert len(fr) == pyconv.FRAME_SIZE
+    assert bytes(pyconv.convert(fr)) == data
+
+def test_pyconverter_ignores_the_rest(pyconv):
+    fr = os.urandom(pyconv.FRAME_SIZE)
+    data = bytes(pyconv.convert(fr))
+    # flip every bit it doesn't read
+    used = pyconv.unconvert(b'\xff'*pyconv.DATA_SIZE)
+    flipped = bytes(a ^ (~u & 0xFF) for a, u in zip(fr, used))
+    assert flipped != fr
+    assert bytes(pyconv.convert(flipped)) == data
@@ -0,0 +1,70 @@
+import os
+import json
+
+import pytest
+
+from conftest import REPO
+
+PLANFILE = REPO / 'base_squashfs' / 'share' / 'Si5395-RevA-SURFFWD-Registers.txt'
+
+@pytest.fixture
+def Plan(simulator, tmp_path, monkeypatch):
+    """ Si5395Plan with its cache in tmp_path and nothing remembered """
+    from s6clk.Si5395Plan import Si5395Plan
+    monkeypatch.setattr(Si5395Plan, 'PLAN_CACHE', str(tmp_path / 'pueo' / 'si5395'))
+    monkeypatch.setattr(Si5395Plan, '_plans', {})
+    return Si5395Plan
+
+def unburst(bursts):
+    return [ ((p << 8) | (r + i), d) for p, r, data in bursts for i, d in enumerate(data) ]
+
+def test_parse(Plan):
+    plan = Plan.parse(PLANFILE)
+    assert plan.delay == 0.3
+    assert all(len(plan.sections[k]) for k in Plan.SECTIONS)
+    # nothing from the header or the comments
+    assert len(plan) == sum(1 for l in open(PLANFILE)
+                            if l.strip().startswith('0x'))
+    for k in Plan.SECTIONS:
+        assert unburst(plan.bursts[k]) == plan.sections[k]
+    assert len(plan.bursts['registers']) < len(plan.sections['registers']) // 4
+
+def test_bursts():
+    from s6clk.Si5395Plan import Si5395Plan
+    writes = [ (0x0B24, 1), (0x0B25, 2), (0x0C00, 3), (0x0B26, 4), (0x0B26, 5) ]
+    assert Si5395Plan.makeBursts(writes) == [ (0x0B, 0x24, b'\x01\x02'),
+                                              (0x0C, 0x00, b'\x03'),
+                                              (0x0B, 0x26, b'\x04'),
+                                              (0x0B, 0x26, b'\x05') ]
+
+def test_cache(Plan):
+    plan = Plan.compile(PLANFILE)
+    cached, = (Plan.cacheDir()).iterdir()
+    assert cached.name == plan.hash + '.json'
+    Plan._plans.clear()
+    again = Plan.compile(PLANFILE)
+    assert again is not plan
+    assert again.sections == plan.sections and again.delay == plan.delay
+
+def test_cache_wrong_hash(Plan):
+    plan = Plan.compile(PLANFILE)
+    cached = Plan.cacheDir() / (plan.hash + '.json')
+    d = json.loads(cached.read_text())
+    d['hash'] = '0'*64
+    d['sections']['registers'] = []
+    cached.write_text(json.dumps(d))
+    Plan._plans.clear()
+    assert Plan.compile(PLANFILE).sections == plan.sections
+
+def test_cache_garbage(Plan):
+    plan = Plan.compile(PLANFILE)
+    (Plan.cacheDir() / (plan.hash + '.json')).write_bytes(b'\x80\x04garbage')
+    Plan._plans.clear()
+    assert Plan.compile(PLANFILE).sections == plan.sections
+
+def test_cache_not_ours(Plan):
+    d = Plan.cacheDir()
+    os.chmod(d, 0o777)
+    assert Plan.cacheDir() is None
+    plan = Plan.compile(PLANFILE)
+    assert len(plan) and list(d.iterdir()) == []
@@ -0,0 +1,158 @@
+import os
+import pickle
+
+import pytest
+
+pytest.importorskip('pueo.common.bf')
+
+from surfStartupHandler import StartupHandler
+from conftest import unusedOff, sysrefOff
+
+State = StartupHandler.StartupState
+
+class Surf:
+    """ just the bits of a PueoSURF _checkResume looks at """
+    def __init__(self):
+        # ACLK enabled, PL PLLs locked
+        self.regs = { 0xC : 0x1, 0x800 : 1<<14 }
+        self.turfio_locked_or_running = 1
+        self.live_seen = 1
+
+    def read(self, addr):
+        return self.regs.get(addr, 0)
+
+    def write(self, addr, val):
+        self.regs[addr] = val
+
+class Lmk:
+    def __init__(self):
+        # PLL1/PLL2 locked, DLD
+        self.st = 0x13
+
+    def status(self):
+        return self.st
+
+class Clock:
+    def __init__(self):
+        self.surfClock = Lmk()
+
+@pytest.fixture
+def startup(tmp_path):
+    s = StartupHandler('test', Surf(), Clock(), None, State.STARTUP_FINISH, None,
+                       resumeFile=str(tmp_path / 'startup.json'))
+    s.dateVersion = 0x10
+    yield s
+    s.stop()
+
+def saved(s, state, **kw):
+    s.state = state
+    for k, v in kw.items():
+        setattr(s, k, v)
+    s._saveResume()
+    s.state = State.STARTUP_BEGIN
+
+def test_nothing_saved(startup):
+    assert startup._checkResume() is None
+
+@pytest.mark.parametrize('state', [ State.WAIT_SYNC, State.RUN_MTS,
+                                    State.MTS_SHUTDOWN, State.STARTUP_FINISH ])
+def test_links_up(startup, state):
+    saved(startup, state)
+    assert startup._checkResume() == state
+
+@pytest.mark.parametrize('state, resume', [ (State.LOCATE_EYE, State.ALIGN_RXCLK),
+                                            (State.WAIT_SYNC, State.ALIGN_RXCLK),
+                                            (State.RUN_MTS, State.ALIGN_RXCLK),
+                                            # SYSREF can be gone: start over
+                                            (State.MTS_SHUTDOWN, None),
+                                            (State.STARTUP_FINISH, None) ])
+def test_links_down(startup, state, resume):
+    saved(startup, state)
+    startup.surf.live_seen = 0
+    assert startup._checkResume() == resume
+
+def test_restores_alignment(startup):
+    startup.align.rx_delay = 3.75
+    startup.eyeno = 1
+    saved(startup, State.STARTUP_FINISH)
+    startup.align.rx_delay = None
+    startup.eyeno = None
+    startup._checkResume()
+    assert startup.align.rx_delay == 3.75
+    assert startup.eyeno == 1
+
+@pytest.mark.parametrize('st', [ 0x00,
+                                 # PLL1 lost (what the clock monitor restarts on)
+                                 0x12,
+                                 0x11,
+                                 # holdover
+                                 0x17, 0x1B, 0x33 ])
+def test_lmk_not_up(startup, st):
+    saved(startup, State.STARTUP_FINISH)
+    startup.clock.surfClock.st = st
+    assert startup._checkResume() is None
+
+def test_dld_not_needed(startup):
+    saved(startup, State.STARTUP_FINISH)
+    startup.clock.surfClock.st = 0x03
+    assert startup._checkResume() == State.STARTUP_FINISH
+
+@pytest.mark.parametrize('reg, val', [ (0xC, 0), (0x800, 0) ])
+def test_fpga_clocks_down(startup, reg, val):
+    saved(startup, State.STARTUP_FINISH)
+    startup.surf.regs[reg] = val
+    assert startup._checkResume() is None
+
+def test_firmware_changed(startup):
+    saved(startup, State.STARTUP_FINISH)
+    startup.dateVersion = 0x11
+    assert startup._checkResume() is None
+
+def test_numpy_values(startup):
+    np = pytest.importorskip('numpy')
+    startup.align.rx_delay = np.float64(3.75)
+    startup.mts.latency = tuple(np.int32(x) for x in (40, 41, 42, 43))
+    saved(startup, State.STARTUP_FINISH)
+    startup.mts.latency = None
+    assert startup._checkResume() == State.STARTUP_FINISH
+    assert startup.align.rx_delay == 3.75
+    assert startup.mts.latency == [ 40, 41, 42, 43 ]
+
+def test_writable_by_others(startup):
+    saved(startup, State.STARTUP_FINISH)
+    os.chmod(startup.resumeFile, 0o666)
+    assert startup._checkResume() is None
+
+def test_not_json(startup):
+    with open(startup.resumeFile, 'wb') as f:
+        pickle.dump({ 'state' : State.STARTUP_FINISH }, f)
+    assert startup._checkResume() is None
+
+@pytest.mark.parametrize('state', [ State.WAIT_PLL_LOCK, State.STARTUP_FAILURE ])
+def test_too_early_or_failed(startup, state):
+    saved(startup, state)
+    assert startup._checkResume() is None
+
+@pytest.fixture
+def warm(startup, lmk, image, simulator, monkeypatch):
+    """ startup with the simulated LMK programmed and locked """
+    monkeypatch.setattr(simulator.lmk.locked, 'delay', 0)
+    lmk.configure(image=image, batched=False)
+    startup.clock.surfClock = lmk
+    return startup
+
+def test_warm_clock(warm, lmk, image):
+    unusedOff(lmk)
+    assert warm._checkClock(image)
+    assert lmk.verify(image) == {}
+
+def test_warm_clock_after_mts(warm, lmk, image):
+    unusedOff(lmk)
+    sysrefOff(lmk)
+    assert not warm._checkClock(image)
+
+def test_warm_clock_holdover(warm, image, simulator, monkeypatch):
+    read = simulator.lmk.read
+    # still locked, but HOLDOVER_LOS
+    monkeypatch.setattr(simulator.lmk, 'read', lambda a : 0x07 if a == 0xBE else read(a))
+    assert not warm._checkClock(image)